@@ -0,0 +1,516 @@
+import hashlib
+import http.client
+import json
+import numpy as np
+import os
+import queue
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+from Instruments import fileBytes
+
+### Helpers for requesting reachable trees from AccessMap outside of the QGIS main thread
+### Nothing in this file imports QGIS, so it can also be used from plain Python scripts
+
+## Change ACCESSMAP_URL to point at a different AccessMap server (e.g. the stub in "Benchmark.py")
+ACCESSMAP_URL = 'http://incremental-alpha.westus.cloudapp.azure.com/api/v1/routing/reachable_tree/custom.json'
+
+# Parameters sent to AccessMap for each reachable tree
+QUERY_KEYS = ('lon', 'lat', 'uphill', 'downhill', 'avoidCurbs', 'streetAvoidance', 'max_cost')
+
+
+# Builds the query string in the same order as the original "ReachableTree" script
+def build_query(lon, lat, uphill, downhill, avoidCurbs, streetAvoidance, max_cost):
+    return ('?lon='+str(lon)+'&lat='+str(lat)+'&uphill='+str(uphill)+'&downhill='+str(downhill)+
+            '&avoidCurbs='+str(avoidCurbs)+'&streetAvoidance='+str(streetAvoidance)+'&max_cost='+str(max_cost))
+
+
+# Pool of keep-alive HTTP connections to a single AccessMap server
+# Each worker thread borrows a connection for one request and returns it afterwards,
+# so at most "size" connections are ever opened
+class ConnectionPool:
+
+    def __init__(self, url=ACCESSMAP_URL, size=8, timeout=60):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path
+        self.url = url
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    # Sends a GET request for the query string and returns (status code, result)
+    # A successful response is handed to consume(response) if given, otherwise the result is the whole body
+    # Error responses are always read whole
+    def get(self, query, consume=None):
+        with self.slots:
+            try:
+                conn = self.idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                conn = self.connect()
+                reused = False
+            try:
+                conn.request('GET', self.path + query, headers={'Connection': 'keep-alive'})
+                r = conn.getresponse()
+            except (http.client.HTTPException, OSError) as e:
+                # Server may have closed an idle connection - retry once on a fresh connection
+                # A new connection failing, or any timeout, is raised as is so slow servers are not waited on twice
+                conn.close()
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+                conn = self.connect()
+                try:
+                    conn.request('GET', self.path + query, headers={'Connection': 'keep-alive'})
+                    r = conn.getresponse()
+                except BaseException:
+                    conn.close()
+                    raise
+            try:
+                if r.status == 200 and consume is not None:
+                    result = consume(r)
+                else:
+                    result = r.read()
+            except BaseException:
+                conn.close()
+                raise
+            # Only connections whose response was read to the end can be reused
+            if r.will_close or not r.isclosed():
+                conn.close()
+            else:
+                self.idle.put(conn)
+            return r.status, result
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# Requests one reachable tree
+# "request" is a dict holding the QUERY_KEYS
+# Without a cache, returns (data, message) with the parsed response
+# With a cache, the response is streamed into the cache and (files, message) is returned instead
+# Either way the first value is None, and message explains why, if AccessMap returned no tree
+# Errors other than 422 are raised the same way urlopen raises them
+# With a recorder (see Instruments.py), request time and bytes received go to its "accessmap http" stage
+def fetch_tree(pool, request, cache=None, recorder=None):
+    query = build_query(*[request[key] for key in QUERY_KEYS])
+    start = time.perf_counter()
+    if cache is None:
+        status, result = pool.get(query)
+    else:
+        status, result = pool.get(query, lambda r: cache.put_stream(request, r))
+    if recorder is not None:
+        received = len(result) if isinstance(result, bytes) else fileBytes(result[0])
+        recorder.add('accessmap http', time.perf_counter() - start, read=received)
+
+    if status == 422:
+        return None, 'Validation error: ' + result.decode()
+    if status != 200:
+        raise HTTPError(pool.url + query, status, result.decode(errors='replace'), None, None)
+
+    if cache is not None:
+        return result
+
+    with recorder.stage('json') if recorder is not None else nullcontext():
+        data = json.loads(result)
+
+    if not "edges" in data:
+        return None, 'No results were returned from AccessMap: ' + str(data)
+
+    return data, None
+
+
+# Requests many reachable trees at once over a shared connection pool
+# "requests" is a list of dicts holding the QUERY_KEYS, plus any other keys the caller needs (e.g. name, profile)
+# Yields (request, data or files, message) in the order the responses complete - see fetch_tree
+# A shared ConnectionPool can be given to cap requests across many calls (url and timeout are then the pool's)
+def fetch_trees(requests, url=ACCESSMAP_URL, concurrency=8, timeout=60, cache=None, recorder=None, pool=None):
+    shared = pool is not None
+    if not shared:
+        pool = ConnectionPool(url, size=concurrency, timeout=timeout)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(fetch_tree, pool, request, cache, recorder): request for request in requests}
+            try:
+                for future in as_completed(futures):
+                    result, message = future.result()
+                    yield futures[future], result, message
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        if not shared:
+            pool.close()
+
+
+## Members of a reachable tree response that are written to their own json files
+TREE_MEMBERS = ('edges', 'node_costs', 'origin')
+
+# Bytes read from the socket at a time while streaming a response
+CHUNK_SIZE = 64 * 1024
+
+# Largest top-level value outside TREE_MEMBERS kept in memory (only used to report AccessMap errors)
+OTHER_VALUE_LIMIT = 64 * 1024
+
+# Complete strings are skipped in one match, a lone quote means the string continues into the next chunk
+COMPLETE_STRING = re.compile(rb'"(?:[^"\\]|\\.)*"', re.DOTALL)
+VALUE_TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"|["{}\[\],]', re.DOTALL)
+NESTED_TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"|["{}\[\]]', re.DOTALL)
+STRING_SPECIAL = re.compile(rb'["\\]')
+
+
+# Change in nesting depth of each byte outside strings
+DEPTH_STEP = np.zeros(256, dtype=np.int8)
+DEPTH_STEP[list(b'{[')] = 1
+DEPTH_STEP[list(b'}]')] = -1
+
+
+# Splits a reachable tree response into one file per TREE_MEMBERS while it is being read
+# The raw bytes of each member are copied straight to its file, so the whole document is never held in memory
+# Feed the response in chunks, then call close() to get (files, message) like fetch_tree
+class TreeSplitter:
+
+    def __init__(self, files):
+        self.files = dict(zip(TREE_MEMBERS, files))
+        self.written = []
+        self.others = {}
+        self.state = 'start'
+        self.key = bytearray()
+        self.target = None
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.text = bytearray()
+
+    def feed(self, chunk):
+        i = 0
+        while i < len(chunk):
+            if self.state == 'value':
+                i = self.scan_value(chunk, i)
+                continue
+
+            c = chunk[i:i+1]
+            if self.state == 'start':
+                if c == b'{':
+                    self.state = 'key_or_end'
+                elif not c.isspace():
+                    # Not a json object - keep the start of it for the error message
+                    self.state = 'invalid'
+                    continue
+            elif self.state == 'key_or_end':
+                if c == b'"':
+                    self.state = 'key'
+                    self.key = bytearray()
+                elif c == b'}':
+                    self.state = 'done'
+            elif self.state == 'key':
+                if self.escape:
+                    self.escape = False
+                elif c == b'\\':
+                    self.escape = True
+                elif c == b'"':
+                    self.state = 'colon'
+                    i += 1
+                    continue
+                self.key += c
+            elif self.state == 'colon':
+                if c == b':':
+                    self.state = 'value_start'
+            elif self.state == 'value_start':
+                if not c.isspace():
+                    self.begin_value()
+                    continue
+            elif self.state == 'invalid':
+                self.text += chunk[i:i + OTHER_VALUE_LIMIT - len(self.text)]
+                return
+            i += 1
+
+    # Copies bytes of the current top-level value until it ends, returns the position after it
+    # Most chunks lie inside nested values, where only the depth matters - those are skipped in bulk
+    def scan_value(self, chunk, i):
+        start = i
+        skipped = False
+        while i < len(chunk):
+            if self.depth and not self.in_string and not self.escape and not skipped:
+                skipped = True
+                if self.skip_nested(chunk, i):
+                    i = len(chunk)
+                    break
+            if self.escape:
+                self.escape = False
+                i += 1
+            elif self.in_string:
+                m = STRING_SPECIAL.search(chunk, i)
+                if m is None:
+                    i = len(chunk)
+                    break
+                i = m.end()
+                if chunk[m.start()] == ord('\\'):
+                    self.escape = True
+                else:
+                    self.in_string = False
+            else:
+                # Commas only matter at the top level of the value
+                m = (NESTED_TOKEN if self.depth else VALUE_TOKEN).search(chunk, i)
+                if m is None:
+                    i = len(chunk)
+                    break
+                i = m.start()
+                c = chunk[i]
+                if c == ord('"'):
+                    if m.end() - i == 1:
+                        self.in_string = True
+                    i = m.end()
+                    continue
+                elif c in b'{[':
+                    self.depth += 1
+                elif self.depth == 0:
+                    # A comma or the closing brace of the top-level object ends the value
+                    self.write(chunk[start:i])
+                    self.end_value()
+                    self.state = 'key_or_end' if c == ord(',') else 'done'
+                    return i + 1
+                else:
+                    self.depth -= 1
+                i += 1
+        self.write(chunk[start:i])
+        return i
+
+    # Takes the rest of the chunk at once if the current value does not end in it, returning whether it did
+    # Complete strings are taken out, a leftover quote opens a string that continues into the next chunk,
+    # and the brackets left are summed to find the lowest depth reached
+    def skip_nested(self, chunk, i):
+        rest = COMPLETE_STRING.sub(b'', chunk[i:])
+        quote = rest.find(b'"')
+        tail = b''
+        if quote >= 0:
+            rest, tail = rest[:quote], rest[quote + 1:]
+        depths = np.cumsum(DEPTH_STEP[np.frombuffer(rest, dtype=np.uint8)], dtype=np.int64)
+        if len(depths) and self.depth + depths.min() <= 0:
+            return False
+        if len(depths):
+            self.depth += int(depths[-1])
+        if quote >= 0:
+            self.in_string = True
+            # An odd run of backslashes at the end escapes the first byte of the next chunk
+            self.escape = (len(tail) - len(tail.rstrip(b'\\'))) % 2 == 1
+        return True
+
+    def begin_value(self):
+        self.key = json.loads(b'"' + bytes(self.key) + b'"')
+        self.state = 'value'
+        self.depth = 0
+        if self.key in self.files:
+            self.target = open(self.files[self.key] + '.tmp', 'wb')
+        else:
+            self.target = bytearray()
+
+    def write(self, data):
+        if isinstance(self.target, bytearray):
+            self.target += data[:OTHER_VALUE_LIMIT - len(self.target)]
+        else:
+            self.target.write(data)
+
+    def end_value(self):
+        if isinstance(self.target, bytearray):
+            try:
+                self.others[self.key] = json.loads(self.target)
+            except ValueError:
+                self.others[self.key] = self.target.decode(errors='replace')
+        else:
+            self.target.close()
+            self.written.append(self.key)
+        self.target = None
+
+    # Moves the member files into place, or removes them if AccessMap returned no tree
+    def close(self):
+        if self.state == 'invalid':
+            message = 'No results were returned from AccessMap: ' + self.text.decode(errors='replace')
+        elif self.state != 'done':
+            self.discard()
+            raise ValueError('Reachable tree response from AccessMap ended early')
+        elif not "edges" in self.written:
+            message = 'No results were returned from AccessMap: ' + str(self.others)
+        elif len(self.written) < len(TREE_MEMBERS):
+            missing = [member for member in TREE_MEMBERS if member not in self.written]
+            message = 'Incomplete reachable tree from AccessMap, missing: ' + ', '.join(missing)
+        else:
+            for member in TREE_MEMBERS:
+                os.replace(self.files[member] + '.tmp', self.files[member])
+            return tuple(self.files[member] for member in TREE_MEMBERS), None
+
+        self.discard()
+        return None, message
+
+    def discard(self):
+        if self.target is not None and not isinstance(self.target, bytearray):
+            self.target.close()
+        for member in TREE_MEMBERS:
+            if os.path.exists(self.files[member] + '.tmp'):
+                os.remove(self.files[member] + '.tmp')
+
+
+# Normalizes the request parameters so equivalent requests share a cache entry
+# (e.g. avoidCurbs True/1 and max_cost 900/900.0 are the same request)
+def normalize_query(request, url=ACCESSMAP_URL):
+    query = {'url': url}
+    for key in QUERY_KEYS:
+        value = request[key]
+        if key == 'avoidCurbs':
+            query[key] = int(bool(value))
+        else:
+            query[key] = round(float(value), 7)
+    # Reverse walksheds are only computed locally (see "WalkGraph.py") - other requests keep their old keys
+    if request.get('reverse'):
+        query['reverse'] = 1
+    return query
+
+
+# Cache url of walksheds computed from a local network file (see "WalkGraph.py")
+# The file's size and modification time are part of it, so a regenerated network does not reuse older walksheds
+def network_url(network_file):
+    stat = os.stat(network_file)
+    return (os.path.abspath(network_file) + '?size=' + str(stat.st_size)
+            + '&mtime=' + str(stat.st_mtime_ns))
+
+
+# Content-addressed cache of reachable tree responses on disk
+# Each entry is stored as one json file per TREE_MEMBERS, named by the hash of the normalized query
+# Least recently used entries are removed once the cache is larger than max_bytes,
+# and entries older than ttl seconds are refetched (ttl of 0 or None never expires)
+class ResponseCache:
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, ttl=None, url=ACCESSMAP_URL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.url = url
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, request):
+        query = normalize_query(request, self.url)
+        return hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest()
+
+    def files(self, key):
+        return tuple(os.path.join(self.directory, key + '.' + member + '.json') for member in TREE_MEMBERS)
+
+    # Returns the cached (edges, node_costs, origin) file paths, or None on a miss
+    def get(self, request):
+        files = self.files(self.key(request))
+        try:
+            stats = [os.stat(file) for file in files]
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        now = time.time()
+        if self.ttl and now - min(stat.st_mtime for stat in stats) > self.ttl:
+            self.misses += 1
+            return None
+
+        # Access time marks recent use for eviction, modification time keeps the entry's age for the ttl
+        for file, stat in zip(files, stats):
+            os.utime(file, (now, stat.st_mtime))
+        self.hits += 1
+        return files
+
+    # Writes a response into the cache and returns its file paths
+    def put(self, request, data):
+        files = self.files(self.key(request))
+        for file, member in zip(files, TREE_MEMBERS):
+            # Write to a temporary file first so an interrupted run never leaves half an entry behind
+            with open(file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(data[member], f)
+            os.replace(file + '.tmp', file)
+        return files
+
+    # Streams an http response into the cache and returns (files, message) like fetch_tree
+    def put_stream(self, request, response):
+        splitter = TreeSplitter(self.files(self.key(request)))
+        try:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                splitter.feed(chunk)
+        except BaseException:
+            splitter.discard()
+            raise
+        return splitter.close()
+
+    # Writes the nested isochrone bands of a cached tree (see WalkGraph.band_tree) beside it and returns
+    # their file paths in the same order as the tree's. Band files are only written again once the tree is
+    # newer than them (e.g. refetched after the ttl), and are evicted along with the tree they came from
+    def put_bands(self, files, bands):
+        from WalkGraph import band_tree
+
+        key = os.path.basename(files[0]).split('.')[0]
+        label = '-'.join(format(band, 'g') for band in sorted(bands))
+        band_files = tuple(os.path.join(self.directory, key + '.bands ' + label + '.' + member + '.json')
+                           for member in TREE_MEMBERS)
+        try:
+            tree_written = max(os.stat(file).st_mtime_ns for file in files)
+            if min(os.stat(file).st_mtime_ns for file in band_files) >= tree_written:
+                return band_files
+        except FileNotFoundError:
+            pass
+
+        data = {}
+        for file, member in zip(files, TREE_MEMBERS):
+            with open(file, 'r', encoding='utf-8') as f:
+                data[member] = json.load(f)
+        data = band_tree(data, bands)
+        for file, member in zip(band_files, TREE_MEMBERS):
+            with open(file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(data[member], f)
+            os.replace(file + '.tmp', file)
+        return band_files
+
+    # Removes expired entries, then least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        entries = {}
+        names = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name.split('.')[0]
+            names.setdefault(key, []).append(name)
+            stat = os.stat(os.path.join(self.directory, name))
+            size, used, created = entries.get(key, (0, 0, float('inf')))
+            entries[key] = (size + stat.st_size, max(used, stat.st_atime), min(created, stat.st_mtime))
+
+        now = time.time()
+        total = sum(size for size, used, created in entries.values())
+        removed = 0
+        for key, (size, used, created) in sorted(entries.items(), key=lambda item: item[1][1]):
+            expired = self.ttl and now - created > self.ttl
+            if not expired and total <= self.max_bytes:
+                continue
+            for name in names[key]:
+                os.remove(os.path.join(self.directory, name))
+            total -= size
+            removed += 1
+        return removed
+
+    def summary(self):
+        return ('Walkshed cache: ' + str(self.hits) + ' hits, ' + str(self.misses) + ' misses ('
+                + self.directory + ')')
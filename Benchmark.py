@@ -0,0 +1,804 @@
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import urlopen
+
+from AccessMap import ConnectionPool, ResponseCache, build_query, fetch_tree, fetch_trees
+
+### Benchmarks for the walkshed scripts
+### Nothing here needs QGIS - run from a terminal, e.g. "python Benchmark.py fetch"
+### "python Benchmark.py suite --baseline Baseline.json" times the main stages on synthetic files and compares them
+### to a stored run, to catch regressions without QGIS, the C:\ folders or the AccessMap server
+### Timings depend on the machine, so no baseline is kept with the scripts - the first run writes Baseline.json
+
+
+## Local stub of the AccessMap "reachable_tree/custom.json" endpoint
+# Returns a small synthetic tree around the requested point after "latency" seconds
+class StubAccessMapHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.05
+    edge_count = 200
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if not parts.path.endswith('/reachable_tree/custom.json'):
+            self.send_error(404)
+            return
+        query = {key: value[0] for key, value in parse_qs(parts.query).items()}
+        try:
+            lon = float(query['lon'])
+            lat = float(query['lat'])
+        except (KeyError, ValueError):
+            self.reply(422, {'error': 'lon and lat are required'})
+            return
+
+        time.sleep(self.latency)
+        self.reply(200, stub_body(lon, lat, self.edge_count))
+
+    def reply(self, status, data):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Builds a synthetic reachable tree shaped like an AccessMap response
+def stub_tree(lon, lat, edge_count):
+    step = 0.0001
+    edges = []
+    node_costs = []
+    for i in range(edge_count):
+        x = lon + step * (i % 20)
+        y = lat + step * (i // 20)
+        edges.append({'type': 'Feature',
+                      'geometry': {'type': 'LineString', 'coordinates': [[x, y], [x + step, y]]},
+                      'properties': {'cost': float(i), 'footway': 'sidewalk'}})
+        node_costs.append({'type': 'Feature',
+                           'geometry': {'type': 'Point', 'coordinates': [x, y]},
+                           'properties': {'cost': float(i)}})
+    return {'edges': {'type': 'FeatureCollection', 'features': edges},
+            'node_costs': {'type': 'FeatureCollection', 'features': node_costs},
+            'origin': {'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lon, lat]}, 'properties': {}}]}}
+
+
+# Encoded stub responses are kept so serving them does not count against the client being measured
+@functools.lru_cache(maxsize=64)
+def stub_body(lon, lat, edge_count):
+    return json.dumps(stub_tree(lon, lat, edge_count)).encode()
+
+
+# Starts the stub server on a free local port and returns (server, url)
+def start_stub(latency=0.05, edge_count=200):
+    handler = type('Handler', (StubAccessMapHandler,), {'latency': latency, 'edge_count': edge_count})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:' + str(server.server_port) + '/api/v1/routing/reachable_tree/custom.json'
+    return server, url
+
+
+# Synthetic location x profile matrix in the same shape as CreateWalkshed.py
+def stub_requests(count):
+    return [dict(lon=-122.3 + 0.001 * i, lat=47.6, uphill=0.08, downhill=0.1, avoidCurbs=1,
+                 streetAvoidance=1, max_cost=900, name='Place' + str(i), profile='Control')
+            for i in range(count)]
+
+
+# Compares the original serial urlopen loop against the concurrent pooled fetch
+def bench_fetch(args):
+    server, url = start_stub(args.latency, args.edges)
+    requests = stub_requests(args.requests)
+    try:
+        start = time.perf_counter()
+        for request in requests:
+            query = build_query(*[request[key] for key in ('lon', 'lat', 'uphill', 'downhill',
+                                                           'avoidCurbs', 'streetAvoidance', 'max_cost')])
+            json.loads(urlopen(url + query).read())
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        count = sum(1 for _ in fetch_trees(requests, url, args.concurrency, args.timeout))
+        pooled = time.perf_counter() - start
+    finally:
+        server.shutdown()
+
+    print("requests: " + str(count) + "  serial: " + format(serial, '.2f') + "s  pooled: "
+          + format(pooled, '.2f') + "s  speedup: " + format(serial / pooled, '.1f') + "x")
+
+
+# Compares peak memory of json.loads + three json.dump passes against streaming the response into the cache
+def bench_split(args):
+    server, url = start_stub(0, args.edges)
+    request = stub_requests(1)[0]
+    query = build_query(*[request[key] for key in ('lon', 'lat', 'uphill', 'downhill',
+                                                   'avoidCurbs', 'streetAvoidance', 'max_cost')])
+    stub_body(request['lon'], request['lat'], args.edges)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            tracemalloc.start()
+            start = time.perf_counter()
+            data = json.loads(urlopen(url + query).read())
+            for member in ('edges', 'node_costs', 'origin'):
+                with open(os.path.join(directory, member + '.json'), 'w', encoding='utf-8') as f:
+                    json.dump(data[member], f)
+            del data
+            loaded = time.perf_counter() - start
+            loaded_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            cache = ResponseCache(directory)
+            pool = ConnectionPool(url, size=1)
+            tracemalloc.start()
+            start = time.perf_counter()
+            files, message = fetch_tree(pool, request, cache)
+            streamed = time.perf_counter() - start
+            streamed_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            pool.close()
+            size = sum(os.path.getsize(file) for file in files)
+    finally:
+        server.shutdown()
+
+    print("response: " + format(size / 1e6, '.1f') + "MB")
+    print("json.loads: " + format(loaded, '.2f') + "s  peak " + format(loaded_peak / 1e6, '.1f') + "MB")
+    print("streamed:   " + format(streamed, '.2f') + "s  peak " + format(streamed_peak / 1e6, '.1f') + "MB")
+
+
+# Synthetic amenity points and buffered walkshed polygons in a 10 km square (EPSG:32610)
+def synthetic_frames(points, walksheds, seed=0):
+    import geopandas as gpd
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    x0, y0 = 550000, 5270000
+    amenities = gpd.GeoDataFrame({'name': ['Amenity ' + str(i) for i in range(points)]},
+        geometry=gpd.points_from_xy(x0 + rng.random(points) * 10000, y0 + rng.random(points) * 10000),
+        crs='EPSG:32610')
+    centers = gpd.points_from_xy(x0 + rng.random(walksheds) * 10000, y0 + rng.random(walksheds) * 10000)
+    buffered = gpd.GeoDataFrame({'cost': rng.random(walksheds) * 900},
+        geometry=gpd.GeoSeries(centers).buffer(800, 5), crs='EPSG:32610')
+    return amenities, buffered
+
+
+# Compares the original double gpd.sjoin against the single-pass splitReachable
+def bench_join(args):
+    import geopandas as gpd
+    import pandas as pd
+    from SpatialJoin import splitReachable
+
+    amenities, buffered = synthetic_frames(args.points, args.walksheds)
+
+    start = time.perf_counter()
+    reachable = gpd.sjoin(amenities, buffered, how="inner", predicate='intersects')
+    unreachable = gpd.sjoin(amenities, buffered, how="left", predicate='intersects')
+    unreachable = unreachable[unreachable.index_right.isnull()]
+    reachable.drop(columns=['index_right'], inplace=True)
+    unreachable.drop(columns=['index_right'], inplace=True)
+    double = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single_reachable, single_unreachable = splitReachable(amenities, buffered)
+    single = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(reachable, single_reachable)
+    pd.testing.assert_frame_equal(unreachable, single_unreachable)
+    print("points: " + str(args.points) + "  walksheds: " + str(args.walksheds) + "  reachable rows: "
+          + str(len(reachable)))
+    print("double sjoin: " + format(double, '.2f') + "s  single pass: " + format(single, '.2f')
+          + "s  speedup: " + format(double / single, '.1f') + "x  (results identical)")
+
+
+# Writes buffered walksheds and amenities named the way SpatialJoin.py expects
+# e.g. "Buffer MaryPilgrim RT Cane.geojson" and "Buffer Joined North Amenity 0.geojson"
+def make_sweep_dirs(root, dict_location, dict_profile, categories, points, seed=0):
+    import numpy as np
+
+    dir_walkshed = os.path.join(root, 'Buffered Walksheds')
+    dir_amenity = os.path.join(root, 'Buffered Amenities')
+    dir_output = os.path.join(root, 'Final Joined Files')
+    for directory in (dir_walkshed, dir_amenity, dir_output):
+        os.makedirs(directory, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    for region in sorted(set(dict_location.values())):
+        for category in range(categories):
+            amenities, buffered = synthetic_frames(points, 1, seed=rng.integers(1 << 31))
+            amenities.to_file(os.path.join(dir_amenity, 'Buffer Joined ' + region + ' Amenity ' + str(category)
+                                           + '.geojson'), driver='GeoJSON')
+
+    for location in dict_location:
+        for profile in dict_profile:
+            amenities, buffered = synthetic_frames(0, 1, seed=rng.integers(1 << 31))
+            buffered.to_file(os.path.join(dir_walkshed, 'Buffer ' + location + ' RT ' + profile + '.geojson'),
+                             driver='GeoJSON')
+
+    return dir_walkshed, dir_amenity, dir_output
+
+
+# Times the SpatialJoin.py directory sweep in one process, across a process pool and as one matrix join
+def bench_sweep(args):
+    import SpatialJoin
+
+    with tempfile.TemporaryDirectory() as root:
+        dir_walkshed, dir_amenity, dir_output = make_sweep_dirs(
+            root, SpatialJoin.dict_location, SpatialJoin.dict_profile, args.categories, args.points)
+        pairs = SpatialJoin.findPairs(dir_walkshed, dir_amenity, dir_output, SpatialJoin.dict_location)
+
+        timings = []
+        for processes in (1, args.processes):
+            SpatialJoin.layer_cache = SpatialJoin.LayerCache(SpatialJoin.layer_cache.max_bytes)
+            table = SpatialJoin.ReachabilityTable(None, SpatialJoin.dict_location, SpatialJoin.dict_profile)
+            start = time.perf_counter()
+            SpatialJoin.runJoins(pairs, table, processes)
+            timings.append((processes, time.perf_counter() - start, table.counts))
+
+        SpatialJoin.layer_cache = SpatialJoin.LayerCache(SpatialJoin.layer_cache.max_bytes)
+        table = SpatialJoin.ReachabilityTable(None, SpatialJoin.dict_location, SpatialJoin.dict_profile)
+        start = time.perf_counter()
+        SpatialJoin.reachabilityMatrix(pairs, table)
+        matrix = time.perf_counter() - start
+        matrix_counts = table.counts
+
+    (serial_processes, serial, serial_counts), (pool_processes, pooled, pooled_counts) = timings
+    assert serial_counts == pooled_counts
+    assert serial_counts == matrix_counts
+    print("pairs: " + str(len(pairs)) + "  1 process: " + format(serial, '.2f') + "s  " + str(pool_processes)
+          + " processes: " + format(pooled, '.2f') + "s  speedup: " + format(serial / pooled, '.1f') + "x")
+    print("matrix (counts only, one join): " + format(matrix, '.2f') + "s  speedup: "
+          + format(serial / matrix, '.1f') + "x  (counts identical)")
+
+
+# Compares write time, read time, bbox read time and file size of each layer format in LayerIO.py
+def bench_formats(args):
+    from LayerIO import LAYER_EXTENSIONS, readLayer, writeLayer
+
+    amenities, buffered = synthetic_frames(args.points, 1)
+    bbox = tuple(buffered.total_bounds)
+    print("format      write(s)  read(s)  bbox read(s)  bbox rows   size(MB)")
+    with tempfile.TemporaryDirectory() as directory:
+        for ext in LAYER_EXTENSIONS:
+            path = os.path.join(directory, 'amenities' + ext)
+            start = time.perf_counter()
+            writeLayer(amenities, path)
+            write = time.perf_counter() - start
+
+            start = time.perf_counter()
+            readLayer(path)
+            read = time.perf_counter() - start
+
+            start = time.perf_counter()
+            rows = len(readLayer(path, bbox, buffered.crs))
+            bbox_read = time.perf_counter() - start
+
+            print(ext.ljust(10) + format(write, '10.2f') + format(read, '9.2f') + format(bbox_read, '14.2f')
+                  + str(rows).rjust(11) + format(os.path.getsize(path) / 1e6, '11.1f'))
+
+
+# Runs produceJoin on one pair with a batch size (None joins the whole layer) and measures the process
+# Runs in a fresh process per call so each peak RSS is its own
+def chunked_join(directory, ext, batch_size):
+    import SpatialJoin
+    from Instruments import peakMemory
+
+    SpatialJoin.output_ext = ext
+    SpatialJoin.join_batch_size = batch_size
+    output_name = 'Chunked ' + str(batch_size)
+    table = SpatialJoin.ReachabilityTable(None, None, None)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        SpatialJoin.produceJoin(directory, 'walksheds' + ext, directory, 'amenities' + ext, directory, output_name,
+                                table, 'Location', 'Profile', 'Amenity')
+        elapsed = time.perf_counter() - start
+    peak = peakMemory()
+    rows = [len(SpatialJoin.readLayer(os.path.join(directory, prefix + output_name + ext)))
+            for prefix in ('Reachable ', 'Unreachable ')]
+    return elapsed, peak, table.counts, rows
+
+
+# Writes the synthetic amenities and walksheds for chunked_join
+def chunked_inputs(directory, ext, points, walksheds):
+    from LayerIO import writeLayer
+
+    amenities, buffered = synthetic_frames(points, walksheds)
+    writeLayer(amenities, os.path.join(directory, 'amenities' + ext))
+    writeLayer(buffered, os.path.join(directory, 'walksheds' + ext))
+
+
+# Compares time and peak memory of produceJoin on a whole amenity layer against join_batch_size batches
+# Inputs are also written in a child process - peak RSS carries over from a parent to the processes it starts
+def bench_chunked(args):
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        with context.Pool(1) as pool:
+            pool.apply(chunked_inputs, (directory, args.format, args.points, args.walksheds))
+        results = []
+        for batch_size in [None] + args.batch_size:
+            with context.Pool(1) as pool:
+                results.append((batch_size, pool.apply(chunked_join, (directory, args.format, batch_size))))
+
+    whole = results[0][1]
+    print("points: " + str(args.points) + "  walksheds: " + str(args.walksheds) + "  format: " + args.format
+          + "  reachable rows: " + str(whole[3][0]))
+    for batch_size, (elapsed, peak, counts, rows) in results:
+        assert counts == whole[2] and rows == whole[3]
+        print(("whole layer" if batch_size is None else "batches of " + str(batch_size)).ljust(20)
+              + format(elapsed, '8.2f') + "s  peak " + format(peak / 1e6, '8.1f') + "MB")
+    print("(counts and rows identical)")
+
+
+# Synthetic sidewalk grid around a point with blocks of "spacing" meters
+# Lines along the grid are sidewalks with random inclines, every fourth line crossing the block edge is a
+# crossing (half of them with curb ramps) and every tenth row is a street
+def synthetic_network(size, spacing=20, lon=-122.3, lat=47.6, seed=0):
+    import geopandas as gpd
+    import numpy as np
+    import shapely
+
+    rng = np.random.default_rng(seed)
+    dy = spacing / 111320
+    dx = dy / np.cos(np.radians(lat))
+    i, j = np.meshgrid(np.arange(size), np.arange(size), indexing='ij')
+    i, j = i.ravel(), j.ravel()
+    x0, y0 = lon - dx * size / 2, lat - dy * size / 2
+
+    starts = []
+    ends = []
+    footway = []
+    highway = []
+    for di, dj in ((1, 0), (0, 1)):
+        keep = (i + di < size) & (j + dj < size)
+        starts.append(np.column_stack([x0 + dx * i[keep], y0 + dy * j[keep]]))
+        ends.append(np.column_stack([x0 + dx * (i[keep] + di), y0 + dy * (j[keep] + dj)]))
+        crossing = (i[keep] if di else j[keep]) % 4 == 3
+        street = (j[keep] % 10 == 5) & (dj == 0)
+        footway.append(np.where(crossing, 'crossing', np.where(street, '', 'sidewalk')))
+        highway.append(np.where(street, 'residential', 'footway'))
+
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    count = len(starts)
+    return gpd.GeoDataFrame({
+        'footway': np.concatenate(footway),
+        'highway': np.concatenate(highway),
+        'incline': rng.normal(0, 0.04, count).round(3),
+        'curbramps': rng.random(count) < 0.5},
+        geometry=shapely.linestrings(np.stack([starts, ends], axis=1)), crs='EPSG:4326')
+
+
+# Times loading a pedestrian network into WalkGraph.py and computing walksheds on it locally
+def bench_local(args):
+    from WalkGraph import WalkGraph, compute_trees
+
+    network = synthetic_network(args.size)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'network.parquet')
+        network.to_parquet(path)
+
+        start = time.perf_counter()
+        graph = WalkGraph.load(path)
+        loaded = time.perf_counter() - start
+
+        graph.save(os.path.join(directory, 'network.npz'))
+        start = time.perf_counter()
+        graph = WalkGraph.load(os.path.join(directory, 'network.npz'))
+        reloaded = time.perf_counter() - start
+
+        requests = stub_requests(args.requests)
+        for request in requests:
+            request['lon'] = -122.3 + 0.0001 * (hash(request['name']) % 20)
+
+        start = time.perf_counter()
+        edges = sum(len(data['edges']['features']) for request, data, message in compute_trees(requests, graph))
+        computed = time.perf_counter() - start
+
+    print("network: " + str(len(graph.x)) + " nodes, " + str(len(graph.length)) + " edges  load: "
+          + format(loaded, '.2f') + "s  load .npz: " + format(reloaded, '.2f') + "s")
+    print("walksheds: " + str(len(requests)) + " in " + format(computed, '.2f') + "s  ("
+          + format(1000 * computed / len(requests), '.1f') + " ms each, " + str(edges // len(requests))
+          + " edges each)")
+
+
+# Times the five CreateWalkshed.py profiles computed one at a time against one multi-profile sweep per location
+def bench_profiles(args):
+    from WalkGraph import WalkGraph
+
+    graph = WalkGraph.from_frame(synthetic_network(args.size))
+    # Profile values from CreateWalkshed.py (Control, Walking, Cane, Powered, Manual)
+    profiles = [dict(uphill=up, downhill=down, avoidCurbs=curb, streetAvoidance=street)
+                for up, down, curb, street in zip([0.15, 0.15, 0.14, 0.12, 0.08], [0.15, 0.15, 0.14, 0.12, 0.1],
+                                                  [0, 0, 0, 1, 1], [0, 1, 1, 1, 1])]
+    origins = [(-122.3 + 0.0002 * i, 47.6 - 0.0001 * i) for i in range(args.locations)]
+    graph.output_lists
+
+    # Searches alone, without building the trees
+    searches = 0
+    sweeps = 0
+    for lon, lat in origins:
+        origin, distance = graph.snap(lon, lat)
+        start = time.perf_counter()
+        for profile in profiles:
+            graph.search(origin, graph.arc_costs(**profile)[1], args.max_cost)
+        searches += time.perf_counter() - start
+
+        start = time.perf_counter()
+        graph.sweep(origin, graph.cost_matrix(profiles), args.max_cost)
+        sweeps += time.perf_counter() - start
+
+    one_at_a_time = 0
+    together = 0
+    for lon, lat in origins:
+        start = time.perf_counter()
+        single = [graph.reachable_tree(lon, lat, max_cost=args.max_cost, **profile) for profile in profiles]
+        one_at_a_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        swept = graph.reachable_trees(lon, lat, profiles, args.max_cost)
+        together += time.perf_counter() - start
+
+        for (data, message), (swept_data, swept_message) in zip(single, swept):
+            assert len(data['node_costs']['features']) == len(swept_data['node_costs']['features'])
+            assert len(data['edges']['features']) == len(swept_data['edges']['features'])
+
+    print("locations: " + str(len(origins)) + " x " + str(len(profiles)) + " profiles  one at a time: "
+          + format(one_at_a_time, '.2f') + "s  one sweep per location: " + format(together, '.2f') + "s  speedup: "
+          + format(one_at_a_time / together, '.1f') + "x  (trees identical)")
+    print("search only  one at a time: " + format(searches, '.2f') + "s  one sweep per location: "
+          + format(sweeps, '.2f') + "s  speedup: " + format(searches / sweeps, '.1f') + "x")
+
+
+# Compares buffering and dissolving walkshed edges against polygonizing them, and the join cost of each result
+def bench_polygonize(args):
+    import geopandas as gpd
+    import numpy as np
+    import shapely
+    from Pipeline import bufferFrame, polygonizeFrame, reprojectFrame
+    from SpatialJoin import splitReachable
+    from WalkGraph import WalkGraph
+
+    graph = WalkGraph.from_frame(synthetic_network(args.size))
+    data, message = graph.reachable_tree(-122.3, 47.6, 0.15, 0.15, 0, 0, args.max_cost)
+    edges = reprojectFrame(gpd.GeoDataFrame.from_features(data['edges']['features'], crs='EPSG:4326'), 'EPSG:32610')
+    bounds = edges.total_bounds
+    rng = np.random.default_rng(0)
+    amenities = gpd.GeoDataFrame(geometry=gpd.points_from_xy(rng.uniform(bounds[0], bounds[2], args.points),
+                                                             rng.uniform(bounds[1], bounds[3], args.points)),
+                                 crs='EPSG:32610')
+
+    start = time.perf_counter()
+    dissolved = bufferFrame(edges, dissolve=True)
+    buffer_time = time.perf_counter() - start
+    start = time.perf_counter()
+    polygon = polygonizeFrame(edges, args.tolerance)
+    polygonize_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reachable = len(splitReachable(amenities, dissolved)[0])
+    dissolved_join = time.perf_counter() - start
+    start = time.perf_counter()
+    polygon_reachable = len(splitReachable(amenities, polygon)[0])
+    polygon_join = time.perf_counter() - start
+
+    print("edges: " + str(len(edges)) + "  vertices: " + str(polygon['vertices_before'].iloc[0]) + " edges, "
+          + str(shapely.get_num_coordinates(dissolved.geometry.values).sum()) + " dissolved buffer, "
+          + str(polygon['vertices_after'].iloc[0]) + " polygon")
+    print("buffer + dissolve: " + format(buffer_time, '.2f') + "s  join " + format(dissolved_join, '.3f') + "s  ("
+          + str(reachable) + " reachable)")
+    print("polygonize:        " + format(polygonize_time, '.2f') + "s  join " + format(polygon_join, '.3f') + "s  ("
+          + str(polygon_reachable) + " reachable)")
+
+
+# Times one walkshed per isochrone band against one walkshed split into bands, each polygonized and joined
+def bench_bands(args):
+    import geopandas as gpd
+    import numpy as np
+    from Pipeline import polygonizeFrame, reprojectFrame
+    from SpatialJoin import ReachabilityTable, countReachable, splitReachable
+    from WalkGraph import WalkGraph, band_tree
+
+    graph = WalkGraph.from_frame(synthetic_network(args.size))
+    bands = sorted(args.bands)
+    profile = dict(uphill=0.12, downhill=0.12, avoidCurbs=1, streetAvoidance=1)
+    data, message = graph.reachable_tree(-122.3, 47.6, max_cost=bands[-1], **profile)
+    edges = reprojectFrame(gpd.GeoDataFrame.from_features(data['edges']['features'], crs='EPSG:4326'), 'EPSG:32610')
+    bounds = edges.total_bounds
+    rng = np.random.default_rng(0)
+    amenities = gpd.GeoDataFrame(geometry=gpd.points_from_xy(rng.uniform(bounds[0], bounds[2], args.points),
+                                                             rng.uniform(bounds[1], bounds[3], args.points)),
+                                 crs='EPSG:32610')
+
+    start = time.perf_counter()
+    separate = {}
+    for band in bands:
+        data, message = graph.reachable_tree(-122.3, 47.6, max_cost=band, **profile)
+        edges = gpd.GeoDataFrame.from_features(data['edges']['features'], crs='EPSG:4326')
+        polygon = polygonizeFrame(reprojectFrame(edges, 'EPSG:32610'), args.tolerance)
+        separate[band] = len(splitReachable(amenities, polygon)[0])
+    separate_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    data, message = graph.reachable_tree(-122.3, 47.6, max_cost=bands[-1], **profile)
+    edges = gpd.GeoDataFrame.from_features(band_tree(data, bands)['edges']['features'], crs='EPSG:4326')
+    polygons = polygonizeFrame(reprojectFrame(edges, 'EPSG:32610'), args.tolerance)
+    table = ReachabilityTable(None, None, None)
+    countReachable(table, splitReachable(amenities, polygons)[0], polygons, 'Site', 'Profile', 'Amenity')
+    banded_time = time.perf_counter() - start
+
+    print("bands: " + ", ".join(format(band, 'g') for band in bands) + "  amenities: " + str(args.points))
+    print("one walkshed per band: " + format(separate_time, '.2f') + "s  one walkshed split into bands: "
+          + format(banded_time, '.2f') + "s  speedup: " + format(separate_time / banded_time, '.1f') + "x")
+    print("reachable per band:    " + "  ".join(str(separate[band]) for band in bands))
+    print("split into bands:      " + "  ".join(str(table.counts[('Site', 'Profile', 'Amenity', band)])
+                                               for band in bands))
+
+
+## Scales for the "suite" benchmark - walkshed files are locations x profiles, amenity files are regions x categories
+# "points" is the number of amenities in each amenity file and "requests" the number of stub AccessMap requests
+# Only 5 profiles and 5 amenity categories fit the rows and columns of the xlsx table SpatialJoin.py fills in
+SUITE_SCALES = {
+    'small': dict(locations=4, profiles=3, regions=2, categories=3, points=1000, requests=20),
+    'medium': dict(locations=40, profiles=5, regions=4, categories=5, points=10000, requests=200),
+    'large': dict(locations=400, profiles=5, regions=20, categories=5, points=100000, requests=2000),
+}
+
+# Timings slower than the baseline by more than this fraction are reported as regressions
+SUITE_TOLERANCE = 0.25
+SUITE_NOISE = 0.01
+
+
+# Housing locations and mobility profiles shaped like dict_location and dict_profile in SpatialJoin.py
+# Locations take turns between regions, e.g. {"Site0": "Region0", "Site1": "Region1", ...}
+def synthetic_matrix(locations, profiles, regions, dict_profile):
+    dict_location = {'Site' + str(i): 'Region' + str(i % regions) for i in range(locations)}
+    return dict_location, dict(list(dict_profile.items())[:profiles])
+
+
+# Writes an empty comparison table with one amenity category per column, the way ReachabilityTable.save reads it
+def make_workbook(path, categories):
+    import openpyxl
+
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.cell(column=1, row=1, value='Location')
+    ws.cell(column=2, row=1, value='Profile')
+    for category in range(min(categories, 5)):
+        ws.cell(column=3 + category, row=1, value='Amenity ' + str(category))
+    wb.save(path)
+    return path
+
+
+# Times a call "repeat" times and returns (best time in seconds, result of the last call)
+# Output printed by the call (e.g. produceJoin and ReachabilityTable.save report every file and cell) is dropped
+def best_of(repeat, function, *args):
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function(*args)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+# Times produceJoin, insertXLSX, the directory sweep and the fetch path on synthetic files of the chosen scale
+# Returns {'scale': ..., 'seconds': {...}, 'results': {...}} - results are checked against the baseline exactly
+def run_suite(scale, processes, latency, repeat):
+    import SpatialJoin
+
+    dict_location, dict_profile = synthetic_matrix(scale['locations'], scale['profiles'], scale['regions'],
+                                                   SpatialJoin.dict_profile)
+    seconds = {}
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        dir_walkshed, dir_amenity, dir_output = make_sweep_dirs(
+            root, dict_location, dict_profile, scale['categories'], scale['points'])
+        seconds['generate'] = time.perf_counter() - start
+        workbook = make_workbook(os.path.join(root, 'Amenity Reachability Comparison Table.xlsx'),
+                                 scale['categories'])
+
+        start = time.perf_counter()
+        pairs = SpatialJoin.findPairs(dir_walkshed, dir_amenity, dir_output, dict_location)
+        seconds['findPairs'] = time.perf_counter() - start
+        results['pairs'] = len(pairs)
+
+        # One pair read from disk, as the first join of a run reads it
+        def produce_join():
+            SpatialJoin.layer_cache = SpatialJoin.LayerCache(SpatialJoin.layer_cache.max_bytes)
+            return SpatialJoin.produceJoin(*pairs[0][:6])
+        seconds['produceJoin'], file_path = best_of(repeat, produce_join)
+
+        location, profile, amenity = pairs[0][6:]
+        seconds['insertXLSX'], _ = best_of(repeat, SpatialJoin.insertXLSX, workbook, file_path, location, profile,
+                                           amenity, dict_location, dict_profile)
+
+        # Every pair joined and written, then the table saved once, as "SpatialJoin.py" runs
+        def sweep():
+            SpatialJoin.layer_cache = SpatialJoin.LayerCache(SpatialJoin.layer_cache.max_bytes)
+            table = SpatialJoin.ReachabilityTable(workbook, dict_location, dict_profile)
+            SpatialJoin.runJoins(pairs, table, processes)
+            table.save()
+            return table.counts
+        seconds['sweep'], counts = best_of(repeat, sweep)
+        results['reachable'] = sum(counts.values())
+
+        def matrix():
+            SpatialJoin.layer_cache = SpatialJoin.LayerCache(SpatialJoin.layer_cache.max_bytes)
+            table = SpatialJoin.ReachabilityTable(None, dict_location, dict_profile)
+            SpatialJoin.reachabilityMatrix(pairs, table)
+            return table.counts
+        seconds['matrix'], matrix_counts = best_of(repeat, matrix)
+        assert matrix_counts == counts
+
+        # Requests streamed into an empty response cache, as CreateWalkshed.py fetches them
+        server, url = start_stub(latency)
+        requests = stub_requests(scale['requests'])
+        try:
+            def fetch():
+                with tempfile.TemporaryDirectory() as directory:
+                    cache = ResponseCache(directory, url=url)
+                    return sum(1 for request, files, message in fetch_trees(requests, url, cache=cache)
+                               if files is not None)
+            seconds['fetch'], results['trees'] = best_of(repeat, fetch)
+        finally:
+            server.shutdown()
+
+    return {'scale': scale, 'seconds': seconds, 'results': results}
+
+
+# Prints the timings next to the baseline ones and returns the names of the stages that got slower than tolerance
+# Results (pair, reachable amenity and tree counts) must match the baseline exactly
+def compare_suite(report, baseline, tolerance):
+    if report['scale'] != baseline['scale']:
+        raise SystemExit("Baseline was recorded at another scale: " + json.dumps(baseline['scale']))
+    for name, value in baseline['results'].items():
+        if report['results'].get(name) != value:
+            raise SystemExit("Result " + name + " changed: " + str(value) + " in the baseline, "
+                             + str(report['results'].get(name)) + " now")
+
+    regressions = []
+    print("stage         baseline(s)  now(s)   change")
+    for name, seconds in report['seconds'].items():
+        before = baseline['seconds'].get(name)
+        if before is None:
+            print(name.ljust(12) + "-".rjust(12) + format(seconds, '9.3f'))
+            continue
+        change = seconds / before - 1
+        flag = ""
+        # Stages that take a few milliseconds are left out, their timings are mostly noise
+        if change > tolerance and seconds - before > SUITE_NOISE:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(name.ljust(12) + format(before, '12.3f') + format(seconds, '9.3f') + format(change, '+9.0%') + flag)
+    return regressions
+
+
+# Runs the suite and compares it to a stored baseline json, or stores it as the new baseline
+# Exits with status 1 if any stage regressed, so the suite can run as a check before merging
+def bench_suite(args):
+    scale = dict(SUITE_SCALES[args.scale])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+
+    report = run_suite(scale, args.processes, args.latency, args.repeat)
+    print(args.scale + " scale: " + json.dumps(scale))
+    print("pairs: " + str(report['results']['pairs']) + "  reachable: " + str(report['results']['reachable'])
+          + "  trees: " + str(report['results']['trees']))
+
+    if args.baseline is None or args.save or not os.path.exists(args.baseline):
+        for name, seconds in report['seconds'].items():
+            print(name.ljust(12) + format(seconds, '9.3f') + "s")
+        if args.baseline is not None:
+            with open(args.baseline, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=1)
+            print("Saved baseline " + args.baseline)
+        return
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare_suite(report, baseline, args.tolerance)
+    if regressions:
+        print("Slower than the baseline: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the walkshed scripts")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fetch = commands.add_parser('fetch', help="serial vs concurrent AccessMap requests against a local stub")
+    fetch.add_argument('--requests', type=int, default=30)
+    fetch.add_argument('--concurrency', type=int, default=8)
+    fetch.add_argument('--timeout', type=float, default=60)
+    fetch.add_argument('--latency', type=float, default=0.05, help="stub response delay in seconds")
+    fetch.add_argument('--edges', type=int, default=200, help="edges per stub tree")
+    fetch.set_defaults(run=bench_fetch)
+
+    split = commands.add_parser('split', help="peak memory of parsing vs streaming a large reachable tree")
+    split.add_argument('--edges', type=int, default=100000, help="edges in the stub tree")
+    split.set_defaults(run=bench_split)
+
+    join = commands.add_parser('join', help="double gpd.sjoin vs single-pass join in SpatialJoin.produceJoin")
+    join.add_argument('--points', type=int, default=300000, help="amenity points")
+    join.add_argument('--walksheds', type=int, default=5, help="buffered walkshed polygons")
+    join.set_defaults(run=bench_join)
+
+    sweep = commands.add_parser('sweep', help="SpatialJoin directory sweep in one process vs a process pool vs matrix mode")
+    sweep.add_argument('--categories', type=int, default=5, help="amenity files per region")
+    sweep.add_argument('--points', type=int, default=20000, help="points per amenity file")
+    sweep.add_argument('--processes', type=int, default=os.cpu_count())
+    sweep.set_defaults(run=bench_sweep)
+
+    formats = commands.add_parser('formats', help="GeoJSON vs GeoParquet vs FlatGeobuf read/write time and size")
+    formats.add_argument('--points', type=int, default=300000, help="amenity points")
+    formats.set_defaults(run=bench_formats)
+
+    chunked = commands.add_parser('chunked', help="peak memory of produceJoin on a whole amenity layer vs in batches")
+    chunked.add_argument('--points', type=int, default=1000000, help="amenity points")
+    chunked.add_argument('--walksheds', type=int, default=5, help="buffered walkshed polygons")
+    chunked.add_argument('--format', choices=['.parquet', '.fgb', '.geojson'], default='.parquet')
+    chunked.add_argument('--batch-size', type=int, nargs='+', default=[50000, 200000])
+    chunked.set_defaults(run=bench_chunked)
+
+    local = commands.add_parser('local', help="walksheds computed from a local network with WalkGraph.py")
+    local.add_argument('--size', type=int, default=400, help="grid nodes along each side of the network")
+    local.add_argument('--requests', type=int, default=300)
+    local.set_defaults(run=bench_local)
+
+    profiles = commands.add_parser('profiles', help="one search per mobility profile vs one sweep per location")
+    profiles.add_argument('--size', type=int, default=400, help="grid nodes along each side of the network")
+    profiles.add_argument('--locations', type=int, default=30)
+    profiles.add_argument('--max-cost', type=float, default=900)
+    profiles.set_defaults(run=bench_profiles)
+
+    polygonize = commands.add_parser('polygonize', help="buffer + dissolve vs polygonized walksheds and their join cost")
+    polygonize.add_argument('--size', type=int, default=400, help="grid nodes along each side of the network")
+    polygonize.add_argument('--max-cost', type=float, default=900)
+    polygonize.add_argument('--tolerance', type=float, default=2, help="simplification tolerance in meters")
+    polygonize.add_argument('--points', type=int, default=200000, help="amenity points around the walkshed")
+    polygonize.set_defaults(run=bench_polygonize)
+
+    bands = commands.add_parser('bands', help="one walkshed per isochrone band vs one walkshed split into bands")
+    bands.add_argument('--size', type=int, default=400, help="grid nodes along each side of the network")
+    bands.add_argument('--bands', type=float, nargs='+', default=[300, 600, 900])
+    bands.add_argument('--tolerance', type=float, default=2, help="simplification tolerance in meters")
+    bands.add_argument('--points', type=int, default=200000, help="amenity points around the walkshed")
+    bands.set_defaults(run=bench_bands)
+
+    suite = commands.add_parser('suite', help="produceJoin, insertXLSX, sweep and fetch timings against a stored baseline")
+    suite.add_argument('--scale', choices=list(SUITE_SCALES), default='small')
+    suite.add_argument('--locations', type=int, help="housing locations (walkshed files are locations x profiles)")
+    suite.add_argument('--profiles', type=int, help="mobility profiles, at most 5")
+    suite.add_argument('--regions', type=int, help="amenity regions (amenity files are regions x categories)")
+    suite.add_argument('--categories', type=int, help="amenity files per region")
+    suite.add_argument('--points', type=int, help="points per amenity file")
+    suite.add_argument('--requests', type=int, help="stub AccessMap requests")
+    suite.add_argument('--processes', type=int, default=1, help="processes for the sweep")
+    suite.add_argument('--latency', type=float, default=0.01, help="stub response delay in seconds")
+    suite.add_argument('--repeat', type=int, default=3, help="runs of each stage, the fastest is kept")
+    suite.add_argument('--baseline', help="baseline json to compare against (written if it does not exist)")
+    suite.add_argument('--save', action='store_true', help="overwrite the baseline with this run")
+    suite.add_argument('--tolerance', type=float, default=SUITE_TOLERANCE,
+                       help="fraction a stage may be slower than the baseline")
+    suite.set_defaults(run=bench_suite)
+
+    args = parser.parse_args()
+    args.run(args)
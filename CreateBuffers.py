@@ -1,112 +1,198 @@
-from qgis.PyQt.QtCore import QCoreApplication
-from qgis.core import (QgsProcessing,
-                       QgsProcessingException,
-                       QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSource,
-                       QgsProcessingParameterVectorDestination)
-from qgis import processing
-
-import os
-
-### This class uses the QGIS ExampleProcessingAlgorithm as a base
-### https://docs.qgis.org/3.34/en/docs/user_manual/processing/scripts.html#extending-qgsprocessingalgorithm
-
-## Run script in QGIS
-## Input file specified in popup is ignored, but a file must be inserted to run the script
-class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
-
-    INPUT = 'INPUT'
-    OUTPUT = 'OUTPUT'
-
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return ExampleProcessingAlgorithm()
-
-    def name(self):
-        return 'CreateBuffers'
-
-    def displayName(self):
-        return self.tr('Create Buffers')
-
-    def group(self):
-        return self.tr('Personal Script')
-
-    def groupId(self):
-        return 'PersonalScript'
-
-    def shortHelpString(self):
-        return self.tr("Create buffers for multiple files")
-
-    def initAlgorithm(self, config=None):
-
-        # Add the input vector features source with any geometry
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.INPUT,
-                self.tr('Input layer'),
-                [QgsProcessing.TypeVectorAnyGeometry]
-            )
-        )
-
-        # We add a feature sink in which to store our processed features (this
-        # usually takes the form of a newly created vector layer when the
-        # algorithm is run in QGIS).
-        self.addParameter(
-            QgsProcessingParameterVectorDestination(
-                self.OUTPUT,
-                self.tr('Output layer')
-            )
-        )
-
-    def processAlgorithm(self, parameters, context, feedback):
-
-        ## Change the directories to input and output file folder locations
-        ## Naming convention assumes each input file begins with "RP "
-        ## Naming convention produces each output file to begin with "Buffer "
-        # Assign directories
-        dir_input = r"C:\QGIS Projects\Walkshed Sim\Amenities"
-        dir_output = r"C:\QGIS Projects\Walkshed Sim\Buffered Amenities"
-
-        # Iterate over files in directory
-        for name in os.listdir(dir_input):
-            
-            # Determine file extension - must be geojson
-            file_name, file_ext = os.path.splitext(name)
-            if file_ext == ".geojson":
-
-                """
-                # Determine file projection
-                with open(dir_input + "\\" + name, 'r') as file:
-                    data = json.load(file)
-
-                crs = data.get('crs', {})
-                crs_properties = crs.get('properties', {})
-
-                epsg_name = crs_properties.get('name', '')
-                epsg_code = ""
-                if 'urn:ogc:def:crs:EPSG::' in epsg_name:
-                    epsg_code = epsg_name.split('::')[-1]
-                
-                if epsg_code == "32610":
-                    # Run buffer script
-                """
-
-
-                # Run buffer script
-                outputFile = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
-                buffered_layer = processing.runAndLoadResults("native:buffer", {
-                    'INPUT': dir_input + "\\" + name, # name example: RP Joined Burbridge Library.geojson
-                    'DISTANCE': 10, # units in meters for EPSG:32610, note units differ depending on projection
-                    'SEGMENTS': 5,
-                    'END_CAP_STYLE': 0,
-                    'JOIN_STYLE': 0,
-                    'MITER_LIMIT': 2,
-                    'DISSOLVE': False, # True for walksheds, False for amenities
-                    'OUTPUT': dir_output + "\\Buffer" + name[2:] # [2:] because of naming convention, deleting "RP"
-                })['OUTPUT']
-
-
-        # Return the results of the algorithm
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsProcessing,
+                       QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterVectorDestination)
+from qgis import processing
+
+import os, sys
+
+# Helper modules live next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from Manifest import Manifest
+from Instruments import Recorder
+
+### This class uses the QGIS ExampleProcessingAlgorithm as a base
+### https://docs.qgis.org/3.34/en/docs/user_manual/processing/scripts.html#extending-qgsprocessingalgorithm
+
+## Run script in QGIS
+## Input file specified in popup is ignored, but a file must be inserted to run the script
+class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
+
+    INPUT = 'INPUT'
+    OUTPUT = 'OUTPUT'
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return ExampleProcessingAlgorithm()
+
+    def name(self):
+        return 'CreateBuffers'
+
+    def displayName(self):
+        return self.tr('Create Buffers')
+
+    def group(self):
+        return self.tr('Personal Script')
+
+    def groupId(self):
+        return 'PersonalScript'
+
+    def shortHelpString(self):
+        return self.tr("Create buffers for multiple files")
+
+    def initAlgorithm(self, config=None):
+
+        # Add the input vector features source with any geometry
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT,
+                self.tr('Input layer'),
+                [QgsProcessing.TypeVectorAnyGeometry]
+            )
+        )
+
+        # We add a feature sink in which to store our processed features (this
+        # usually takes the form of a newly created vector layer when the
+        # algorithm is run in QGIS).
+        self.addParameter(
+            QgsProcessingParameterVectorDestination(
+                self.OUTPUT,
+                self.tr('Output layer')
+            )
+        )
+
+        # Buffer every file in one vectorized pass and write the results without adding them to the map
+        # Needs geopandas in the QGIS Python environment
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                'BATCH',
+                self.tr('Batch buffer all files without loading them (needs geopandas)'),
+                defaultValue=False
+            )
+        )
+
+        # Profile the run with cProfile - the stats are written next to the timing report in the output folder
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                'PROFILE',
+                self.tr('Profile the run with cProfile'),
+                defaultValue=False
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        recorder = Recorder("CreateBuffers", self.parameterAsBoolean(parameters, 'PROFILE', context))
+        try:
+            return self.bufferFolder(parameters, context, feedback, recorder)
+        finally:
+            recorder.stop()
+
+    def bufferFolder(self, parameters, context, feedback, recorder):
+
+        ## Change the directories to input and output file folder locations
+        ## Naming convention assumes each input file begins with "RP "
+        ## Naming convention produces each output file to begin with "Buffer "
+        # Assign directories
+        dir_input = r"C:\QGIS Projects\Walkshed Sim\Amenities"
+        dir_output = r"C:\QGIS Projects\Walkshed Sim\Buffered Amenities"
+
+        ## Change output_ext to write buffers as GeoParquet (".parquet") or FlatGeobuf (".fgb") instead of GeoJSON
+        # GeoParquet needs a QGIS build with GDAL 3.5 or later
+        output_ext = ".geojson"
+        layer_exts = (".geojson", ".parquet", ".fgb")
+
+        # Files that were buffered with the same inputs and parameters before are not buffered again
+        manifest = Manifest(dir_output + "\\Buffer Manifest.json")
+        buffered_layer = None
+
+        # In batch mode files are collected here and buffered together after the loop
+        batch = self.parameterAsBoolean(parameters, 'BATCH', context)
+        batch_inputs = []
+        batch_outputs = []
+
+        # Iterate over files in directory
+        for name in os.listdir(dir_input):
+            
+            # Determine file extension - must be geojson, parquet or fgb
+            file_name, file_ext = os.path.splitext(name)
+            if file_ext in layer_exts:
+
+                """
+                # Determine file projection
+                with open(dir_input + "\\" + name, 'r') as file:
+                    data = json.load(file)
+
+                crs = data.get('crs', {})
+                crs_properties = crs.get('properties', {})
+
+                epsg_name = crs_properties.get('name', '')
+                epsg_code = ""
+                if 'urn:ogc:def:crs:EPSG::' in epsg_name:
+                    epsg_code = epsg_name.split('::')[-1]
+                
+                if epsg_code == "32610":
+                    # Run buffer script
+                """
+
+
+                # Buffer parameters (INPUT and OUTPUT are added per file)
+                buffer_params = {
+                    'DISTANCE': 10, # units in meters for EPSG:32610, note units differ depending on projection
+                    'SEGMENTS': 5,
+                    'END_CAP_STYLE': 0,
+                    'JOIN_STYLE': 0,
+                    'MITER_LIMIT': 2,
+                    'DISSOLVE': False # True for walksheds, False for amenities
+                }
+                input_file = dir_input + "\\" + name # name example: RP Joined Burbridge Library.geojson
+                output_file = dir_output + "\\Buffer" + file_name[2:] + output_ext # [2:] because of naming convention, deleting "RP"
+
+                # Skip files whose input and buffer parameters are unchanged since the last run
+                if manifest.current(output_file, [input_file], buffer_params):
+                    feedback.pushInfo("Unchanged, skipping: " + name)
+                    continue
+
+                if batch:
+                    batch_inputs.append(input_file)
+                    batch_outputs.append(output_file)
+                    continue
+
+                # Run buffer script
+                outputFile = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+                with recorder.stage("native:buffer", read=input_file, written=output_file):
+                    buffered_layer = processing.runAndLoadResults("native:buffer", dict(buffer_params,
+                        INPUT=input_file,
+                        OUTPUT=output_file
+                    ))['OUTPUT']
+                manifest.record(output_file, [input_file], buffer_params, [output_file])
+
+
+        if batch_inputs:
+            from Pipeline import bufferFiles
+
+            with recorder.stage("batch buffer", read=batch_inputs, written=batch_outputs):
+                count = bufferFiles(batch_inputs, batch_outputs,
+                    distance=buffer_params['DISTANCE'],
+                    segments=buffer_params['SEGMENTS'],
+                    end_cap_style=buffer_params['END_CAP_STYLE'],
+                    join_style=buffer_params['JOIN_STYLE'],
+                    miter_limit=buffer_params['MITER_LIMIT'],
+                    dissolve=buffer_params['DISSOLVE'])
+            recorder.count("features", count)
+            feedback.pushInfo("Buffered " + str(count) + " features from " + str(len(batch_inputs)) + " files")
+            for input_file, output_file in zip(batch_inputs, batch_outputs):
+                manifest.record(output_file, [input_file], buffer_params, [output_file])
+            buffered_layer = batch_outputs[-1]
+
+        manifest.save()
+        feedback.pushInfo(manifest.summary())
+        feedback.pushInfo(recorder.summary())
+        recorder.save(dir_output + "\\CreateBuffers Report.json")
+
+        # Return the results of the algorithm
         return {self.OUTPUT: buffered_layer}
\ No newline at end of file
@@ -1,194 +1,392 @@
-import json, random
-from urllib.request import urlopen
-from urllib.error import HTTPError
-
-from qgis.PyQt.QtCore import QCoreApplication
-from qgis.core import (QgsProcessing,
-                       QgsFeatureSink,
-                       QgsProcessingException,
-                       QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSource,
-                       QgsProcessingParameterFeatureSink,
-                       QgsVectorLayer,
-                       QgsProject,
-                       QgsSimpleMarkerSymbolLayerBase,
-                       QgsProcessingParameterNumber,
-                       QgsProcessingParameterBoolean,
-                       QgsProcessingParameterPoint)
-from qgis import processing
-
-### This class is derived from the "ReachableTree" script by TCAT
-### The "ReachableTree" script has been edited to automize walkshed creation and identify walksheds by name
-
-## Run script in QGIS
-## Input any point in popup panel - the walkshed from that point will 
-#  not be created and will produce an error that can be ignored
-class AccessMapTreeProcessingAlgorithm(QgsProcessingAlgorithm):
-
-    INPUT = 'INPUT'
-    OUTPUT = 'OUTPUT'
-
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return AccessMapTreeProcessingAlgorithm()
-
-    def name(self):
-        return 'ReachableTree'
-
-    def displayName(self):
-        return self.tr('Reachable Tree')
-
-    def group(self):
-        return self.tr('AccessMap')
-
-    def groupId(self):
-        return 'AccessMap'
-
-    def shortHelpString(self):
-        return self.tr("Reachable Tree from a specific point")
-
-    def initAlgorithm(self, config=None):
-
-        self.addParameter(QgsProcessingParameterPoint(
-            "POINT", "Point"))
-
-        self.addParameter(QgsProcessingParameterNumber(
-            "UPHILL", "Uphill",
-            QgsProcessingParameterNumber.Double,
-            0.08,
-            minValue = 0.0,
-            maxValue = 1.0))
-            
-        self.addParameter(QgsProcessingParameterNumber(
-            "DOWNHILL", "Downhill",
-            QgsProcessingParameterNumber.Double,
-            0.1,
-            minValue = 0.0,
-            maxValue = 1.0))
-            
-        self.addParameter(QgsProcessingParameterBoolean(
-            "AVOIDCURBS", "Avoid Curbs",
-            defaultValue=True))
-            
-        self.addParameter(QgsProcessingParameterNumber(
-            "STREETAVOIDANCE", "Street Avoidance",
-            QgsProcessingParameterNumber.Double,
-            1,
-            minValue = 0.0,
-            maxValue = 1.0))
-            
-        self.addParameter(QgsProcessingParameterNumber(
-            "MAXCOST", "Max Cost",
-            QgsProcessingParameterNumber.Double,
-            1000.0))
-            
-        self.addParameter(QgsProcessingParameterBoolean(
-            "REVERSE", "Reverse Walkshed",
-            defaultValue=False))
-
-    def processAlgorithm(self, parameters, context, feedback):
-
-        def reachable_tree(lon, lat, uphill, downhill, avoidCurbs, streetAvoidance, max_cost, reverse, name, profile):
-            url = 'http://incremental-alpha.westus.cloudapp.azure.com/api/v1/routing/reachable_tree/custom.json?lon='+str(lon)+'&lat='+str(lat)+'&uphill='+str(uphill)+'&downhill='+str(downhill)+'&avoidCurbs='+str(avoidCurbs)+'&streetAvoidance='+str(streetAvoidance)+'&max_cost='+str(max_cost)
-            
-            ## Change downloaded_file_prefix to file folder location
-            downloaded_file_prefix = 'C:\QGIS Projects\Walksheds'
-            ## Can change name of download files to be identifiable (similar to layer_name variables)
-            downloaded_file = downloaded_file_prefix+str(random.randrange(100000))+'.json'
-            downloaded_file2 = downloaded_file_prefix+str(random.randrange(100000))+'.json'
-            downloaded_file3 = downloaded_file_prefix+str(random.randrange(100000))+'.json'
-
-            layer_name = name + ' RT ' + profile
-            layer_name2 = name + ' Cost ' + profile
-            layer_name3 = name + ' Origin ' + profile
-
-            try:
-                r = urlopen(url)
-            except HTTPError as e:
-                if e.code == 422:
-                    feedback.pushInfo('Validation error: ' + e.read().decode())
-                    return
-                else:
-                    raise e
-            
-            data = json.loads(r.read())
-
-            if not "edges" in data:
-                feedback.pushInfo('No results were returned from AccessMap: ' + str(data))
-                return
-                
-            with open(downloaded_file, 'w', encoding='utf-8') as f:
-                json.dump(data["edges"], f)
-
-            with open(downloaded_file2, 'w', encoding='utf-8') as f:
-                json.dump(data["node_costs"], f)
-
-            with open(downloaded_file3, 'w', encoding='utf-8') as f:
-                json.dump(data["origin"], f)
-
-            #Add imported data into QGIS
-            layer = QgsVectorLayer(downloaded_file, layer_name, "ogr")
-            layer.renderer().symbol().setWidth(1)
-            #layer.renderer().symbol().setColor(QColor.fromRgb(255, 0, 0))
-            layer.triggerRepaint()
-            QgsProject.instance().addMapLayer(layer)
-
-            #Add imported data into QGIS
-            layer = QgsVectorLayer(downloaded_file2, layer_name2, "ogr")
-            layer.triggerRepaint()
-            QgsProject.instance().addMapLayer(layer)
-
-            #Add imported data into QGIS
-            layer = QgsVectorLayer(downloaded_file3, layer_name3, "ogr")
-            layer.renderer().symbol().symbolLayer(0).setSize(6)
-            layer.renderer().symbol().symbolLayer(0).setShape(QgsSimpleMarkerSymbolLayerBase.Star)
-            layer.triggerRepaint()
-            QgsProject.instance().addMapLayer(layer)
-
-            QCoreApplication.processEvents()
-
-
-
-        ## Set up location and mobility profile variables
-        place = ["Kirkland", "MaryPilgrim", "Redmond", "SacredMed", "SalmonberryL", "SidneyWilson"]
-        person = ["Control", "Walking", "Cane", "Powered", "Manual"]
-        long = [-122.199038, -122.345688, -122.136845, -122.292986, -122.330440, -122.233181]
-        lati = [47.642723, 47.731363, 47.629664, 47.732567, 47.601212, 47.469499]
-        up = [0.15, 0.15, 0.14, 0.12, 0.08]
-        down = [0.15, 0.15, 0.14, 0.12, 0.1]
-        curb = [0, 0, 0, 1, 1]
-        street = [0, 1, 1, 1, 1]
-
-        # Loop through each HTH location
-        for loc in range(len(place)):
-            # Loop through each mobility profile
-            for prof in range(len(person)):
-                # Call method to create walkshed
-                reachable_tree(lon=long[loc],
-                    lat=lati[loc],
-                    uphill=up[prof],
-                    downhill=down[prof],
-                    avoidCurbs=curb[prof],  # avoidCurbs = 0 means unchecked
-                    streetAvoidance=street[prof],
-                    max_cost=900,
-                    reverse=0,
-                    name=place[loc],
-                    profile=person[prof])
-
-
-
-
-        originPoint = self.parameterAsPoint(parameters, "POINT", context)
-        reachable_tree(lon=originPoint.x(),
-            lat=originPoint.y(),
-            uphill=parameters["UPHILL"],
-            downhill=parameters["DOWNHILL"],
-            avoidCurbs=parameters["AVOIDCURBS"],
-            streetAvoidance=parameters["STREETAVOIDANCE"],
-            max_cost=parameters["MAXCOST"],
-            reverse=parameters["REVERSE"])
-        
-        return {self.OUTPUT: None}
+import os, shutil, sys
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsProcessing,
+                       QgsFeatureSink,
+                       QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterFeatureSink,
+                       QgsVectorLayer,
+                       QgsProject,
+                       QgsSimpleMarkerSymbolLayerBase,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterString,
+                       QgsProcessingParameterPoint)
+from qgis import processing
+from qgis.utils import iface
+
+# Helper modules live next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from AccessMap import ACCESSMAP_URL, ConnectionPool, ResponseCache, fetch_tree, fetch_trees, network_url
+from Instruments import Recorder
+from WalkGraph import WalkGraph, compute_trees
+
+### This class is derived from the "ReachableTree" script by TCAT
+### The "ReachableTree" script has been edited to automize walkshed creation and identify walksheds by name
+
+## Run script in QGIS
+## Input any point in popup panel - the walkshed from that point will 
+#  not be created and will produce an error that can be ignored
+class AccessMapTreeProcessingAlgorithm(QgsProcessingAlgorithm):
+
+    INPUT = 'INPUT'
+    OUTPUT = 'OUTPUT'
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return AccessMapTreeProcessingAlgorithm()
+
+    def name(self):
+        return 'ReachableTree'
+
+    def displayName(self):
+        return self.tr('Reachable Tree')
+
+    def group(self):
+        return self.tr('AccessMap')
+
+    def groupId(self):
+        return 'AccessMap'
+
+    def shortHelpString(self):
+        return self.tr("Reachable Tree from a specific point")
+
+    def initAlgorithm(self, config=None):
+
+        self.addParameter(QgsProcessingParameterPoint(
+            "POINT", "Point"))
+
+        self.addParameter(QgsProcessingParameterNumber(
+            "UPHILL", "Uphill",
+            QgsProcessingParameterNumber.Double,
+            0.08,
+            minValue = 0.0,
+            maxValue = 1.0))
+            
+        self.addParameter(QgsProcessingParameterNumber(
+            "DOWNHILL", "Downhill",
+            QgsProcessingParameterNumber.Double,
+            0.1,
+            minValue = 0.0,
+            maxValue = 1.0))
+            
+        self.addParameter(QgsProcessingParameterBoolean(
+            "AVOIDCURBS", "Avoid Curbs",
+            defaultValue=True))
+            
+        self.addParameter(QgsProcessingParameterNumber(
+            "STREETAVOIDANCE", "Street Avoidance",
+            QgsProcessingParameterNumber.Double,
+            1,
+            minValue = 0.0,
+            maxValue = 1.0))
+            
+        self.addParameter(QgsProcessingParameterNumber(
+            "MAXCOST", "Max Cost",
+            QgsProcessingParameterNumber.Double,
+            1000.0))
+            
+        self.addParameter(QgsProcessingParameterBoolean(
+            "REVERSE", "Reverse Walkshed",
+            defaultValue=False))
+
+        # Nested walksheds for several max costs from one request at the largest - the edges of each walkshed
+        # get a "band" attribute, and the edges of band b are every edge with band <= b
+        self.addParameter(QgsProcessingParameterString(
+            "BANDS", "Isochrone Bands (e.g. 300, 600, 900 - replaces Max Cost)",
+            defaultValue="",
+            optional=True))
+
+        # Number of walksheds requested from AccessMap at the same time
+        self.addParameter(QgsProcessingParameterNumber(
+            "CONCURRENCY", "Concurrent Requests",
+            QgsProcessingParameterNumber.Integer,
+            8,
+            minValue = 1,
+            maxValue = 64))
+
+        # Seconds to wait on AccessMap before a request fails
+        self.addParameter(QgsProcessingParameterNumber(
+            "TIMEOUT", "Request Timeout (s)",
+            QgsProcessingParameterNumber.Double,
+            60.0,
+            minValue = 1.0))
+
+        # Walksheds already downloaded with the same parameters are reused from the cache
+        self.addParameter(QgsProcessingParameterNumber(
+            "CACHESIZE", "Walkshed Cache Size (MB)",
+            QgsProcessingParameterNumber.Integer,
+            1024,
+            minValue = 0))
+
+        # 0 keeps cached walksheds until they are evicted for space
+        self.addParameter(QgsProcessingParameterNumber(
+            "CACHETTL", "Walkshed Cache Expiry (hours)",
+            QgsProcessingParameterNumber.Double,
+            0.0,
+            minValue = 0.0))
+
+        # Adding every layer as soon as it arrives repaints the map each time and freezes QGIS on large batches
+        self.addParameter(QgsProcessingParameterEnum(
+            "LOADING", "Add Walkshed Layers",
+            options=["All at the end, grouped by location",
+                     "One at a time as they arrive",
+                     "Do not add layers (only write files)"],
+            defaultValue=0))
+
+        # Timings are always reported - this also writes cProfile stats beside the report
+        self.addParameter(QgsProcessingParameterBoolean(
+            "PROFILE", "Write cProfile Stats",
+            defaultValue=False))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # Time spent in each stage is reported at the end and written to "CreateWalkshed Report.json" in cache_dir
+        recorder = Recorder("CreateWalkshed", self.parameterAsBoolean(parameters, "PROFILE", context))
+        try:
+            return self.createWalksheds(parameters, context, feedback, recorder)
+        finally:
+            recorder.stop()
+
+    def createWalksheds(self, parameters, context, feedback, recorder):
+
+        concurrency = self.parameterAsInt(parameters, "CONCURRENCY", context)
+        timeout = self.parameterAsDouble(parameters, "TIMEOUT", context)
+
+        ## Change cache_dir to file folder location
+        # Downloaded walksheds are named by a hash of their request parameters so reruns can reuse them
+        cache_dir = r"C:\QGIS Projects\Walkshed Cache"
+
+        ## Change network_file to a pedestrian network (GeoJSON, GeoParquet, FlatGeobuf or a ".npz" saved by
+        #  "WalkGraph.py") to compute walksheds locally instead of requesting them from AccessMap
+        # Leave empty to use AccessMap
+        network_file = r""
+        graph = None
+        if network_file:
+            with recorder.stage("load network", read=network_file):
+                graph = WalkGraph.load(network_file)
+
+        # Local walksheds are cached apart from AccessMap ones
+        cache = ResponseCache(cache_dir,
+            max_bytes=self.parameterAsInt(parameters, "CACHESIZE", context) * 1024 * 1024,
+            ttl=self.parameterAsDouble(parameters, "CACHETTL", context) * 3600,
+            url=network_url(network_file) if network_file else ACCESSMAP_URL)
+
+        ## Change walkshed_dir to the folder walkshed files are written to
+        # Files are named like the layers, e.g. "MaryPilgrim RT Cane.geojson". Layers are loaded from copies in its
+        # "Layers" folder rather than the cache, so evicting cache entries never removes files under open projects
+        walkshed_dir = r"C:\QGIS Projects\Walkshed Sim\Walksheds"
+        loading = self.parameterAsEnum(parameters, "LOADING", context)
+
+        # With bands, each walkshed is requested once at the largest band and split up locally
+        bands = sorted({float(band) for band in
+                        (self.parameterAsString(parameters, "BANDS", context) or "").replace(",", " ").split()})
+
+        # Layers waiting to be added at the end, by location name
+        pending = {}
+
+        # Creates the three layers of a walkshed with their symbology, without adding them to the project
+        def make_layers(files, name, profile):
+            downloaded_file, downloaded_file2, downloaded_file3 = files
+
+            layer_name = name + ' RT ' + profile
+            layer_name2 = name + ' Cost ' + profile
+            layer_name3 = name + ' Origin ' + profile
+
+            layer = QgsVectorLayer(downloaded_file, layer_name, "ogr")
+            layer.renderer().symbol().setWidth(1)
+            #layer.renderer().symbol().setColor(QColor.fromRgb(255, 0, 0))
+
+            layer2 = QgsVectorLayer(downloaded_file2, layer_name2, "ogr")
+
+            layer3 = QgsVectorLayer(downloaded_file3, layer_name3, "ogr")
+            layer3.renderer().symbol().symbolLayer(0).setSize(6)
+            layer3.renderer().symbol().symbolLayer(0).setShape(QgsSimpleMarkerSymbolLayerBase.Star)
+
+            return [layer, layer2, layer3]
+
+        # Links (or copies, where hard links are not supported) the cached files of a walkshed out of the cache
+        # and returns their paths. Without layers they go in walkshed_dir, replacing files of earlier runs. Layers
+        # load from the "Layers" folder in walkshed_dir instead - files there are never replaced, since they may be
+        # open in QGIS, so a walkshed that changed gets the next free name (e.g. "MaryPilgrim RT Cane (2).geojson")
+        def keep_files(files, name, profile):
+            kept_dir = walkshed_dir if loading == 2 else os.path.join(walkshed_dir, "Layers")
+            os.makedirs(kept_dir, exist_ok=True)
+            kept = []
+            for file, kind in zip(files, (' RT ', ' Cost ', ' Origin ')):
+                base = os.path.join(kept_dir, name + kind + profile)
+                kept_file = base + '.geojson'
+                number = 1
+                while loading != 2 and os.path.exists(kept_file) and not same_file(file, kept_file):
+                    number += 1
+                    kept_file = base + ' (' + str(number) + ').geojson'
+
+                if not os.path.exists(kept_file):
+                    link_file(file, kept_file)
+                elif not same_file(file, kept_file):
+                    # Replaced rather than written over, since the old file may be a link to another cache entry
+                    link_file(file, kept_file + '.tmp')
+                    os.replace(kept_file + '.tmp', kept_file)
+                kept.append(kept_file)
+            return kept
+
+        def link_file(file, kept_file):
+            if os.path.exists(kept_file):
+                os.remove(kept_file)
+            try:
+                os.link(file, kept_file)
+            except OSError:
+                shutil.copy2(file, kept_file)
+
+        # Whether a kept file is a link to, or an unchanged copy of, a cache file
+        def same_file(file, kept_file):
+            stat, kept_stat = os.stat(file), os.stat(kept_file)
+            return (os.path.samefile(file, kept_file)
+                    or (stat.st_size == kept_stat.st_size and stat.st_mtime_ns == kept_stat.st_mtime_ns))
+
+        # Copies the written walkshed files to walkshed_dir, then adds them into QGIS or queues them to be added
+        # at the end, depending on the "LOADING" option - must be called from the main thread
+        def load_tree(files, name, profile):
+            if bands:
+                with recorder.stage("bands", read=files):
+                    files = cache.put_bands(files, bands)
+
+            with recorder.stage("copy files", written=files):
+                files = keep_files(files, name, profile)
+            if loading == 2:
+                return
+
+            with recorder.stage("create layers", read=files):
+                layers = make_layers(files, name, profile)
+            if loading == 0:
+                pending.setdefault(name, []).extend(layers)
+                return
+
+            #Add imported data into QGIS
+            with recorder.stage("add layers"):
+                for layer in layers:
+                    layer.triggerRepaint()
+                    QgsProject.instance().addMapLayer(layer)
+
+                QCoreApplication.processEvents()
+
+        # Adds every queued layer in one call, each under a group named after its location, then redraws the map once
+        def add_pending():
+            if not pending:
+                return
+            with recorder.stage("add layers"):
+                project = QgsProject.instance()
+                root = project.layerTreeRoot()
+                project.addMapLayers([layer for layers in pending.values() for layer in layers], False)
+                for name, layers in pending.items():
+                    group = root.findGroup(name) or root.addGroup(name)
+                    for layer in layers:
+                        group.addLayer(layer)
+                pending.clear()
+                if iface is not None:
+                    iface.mapCanvas().refreshAllLayers()
+
+        def reachable_tree(lon, lat, uphill, downhill, avoidCurbs, streetAvoidance, max_cost, reverse, name, profile):
+            request = dict(lon=lon, lat=lat, uphill=uphill, downhill=downhill, avoidCurbs=avoidCurbs,
+                           streetAvoidance=streetAvoidance, max_cost=bands[-1] if bands else max_cost)
+            if graph is not None:
+                request['reverse'] = reverse
+
+            files = cache.get(request)
+            if files is None and graph is not None:
+                request, files, message = next(compute_trees([request], graph, cache, recorder))
+            elif files is None:
+                pool = ConnectionPool(ACCESSMAP_URL, size=1, timeout=timeout)
+                try:
+                    files, message = fetch_tree(pool, request, cache, recorder)
+                finally:
+                    pool.close()
+
+            if files is None:
+                feedback.pushInfo(message)
+                return
+
+            load_tree(files, name, profile)
+
+
+
+        ## Set up location and mobility profile variables
+        place = ["Kirkland", "MaryPilgrim", "Redmond", "SacredMed", "SalmonberryL", "SidneyWilson"]
+        person = ["Control", "Walking", "Cane", "Powered", "Manual"]
+        long = [-122.199038, -122.345688, -122.136845, -122.292986, -122.330440, -122.233181]
+        lati = [47.642723, 47.731363, 47.629664, 47.732567, 47.601212, 47.469499]
+        up = [0.15, 0.15, 0.14, 0.12, 0.08]
+        down = [0.15, 0.15, 0.14, 0.12, 0.1]
+        curb = [0, 0, 0, 1, 1]
+        street = [0, 1, 1, 1, 1]
+
+        # Build one request per HTH location and mobility profile
+        requests = []
+        for loc in range(len(place)):
+            for prof in range(len(person)):
+                requests.append(dict(lon=long[loc],
+                    lat=lati[loc],
+                    uphill=up[prof],
+                    downhill=down[prof],
+                    avoidCurbs=curb[prof],  # avoidCurbs = 0 means unchecked
+                    streetAvoidance=street[prof],
+                    max_cost=bands[-1] if bands else 900,
+                    name=place[loc],
+                    profile=person[prof]))
+
+        # Walksheds found in the cache are loaded without contacting AccessMap
+        missing = []
+        for request in requests:
+            files = cache.get(request)
+            if files is None:
+                missing.append(request)
+            else:
+                load_tree(files, request["name"], request["profile"])
+
+        # Request the remaining walksheds concurrently - responses are streamed into the cache by the
+        # worker threads, and layers are still added to QGIS here on the main thread
+        # With a local network they are computed here instead, one after another
+        if graph is not None:
+            results = compute_trees(missing, graph, cache, recorder)
+        else:
+            results = fetch_trees(missing, ACCESSMAP_URL, concurrency, timeout, cache, recorder)
+        done = 0
+        for request, files, message in results:
+            if feedback.isCanceled():
+                break
+            done += 1
+            feedback.setProgress(100 * done / len(missing))
+            if files is None:
+                feedback.pushInfo(request["name"] + ' ' + request["profile"] + ': ' + message)
+                continue
+            load_tree(files, request["name"], request["profile"])
+
+        # Queued layers are added before eviction can remove any of their files
+        add_pending()
+        cache.evict()
+        feedback.pushInfo(cache.summary())
+
+        recorder.count("walksheds", len(requests))
+        recorder.count("cache hits", cache.hits)
+        feedback.pushInfo(recorder.summary())
+        recorder.save(os.path.join(cache_dir, "CreateWalkshed Report.json"))
+
+
+
+
+        originPoint = self.parameterAsPoint(parameters, "POINT", context)
+        reachable_tree(lon=originPoint.x(),
+            lat=originPoint.y(),
+            uphill=parameters["UPHILL"],
+            downhill=parameters["DOWNHILL"],
+            avoidCurbs=parameters["AVOIDCURBS"],
+            streetAvoidance=parameters["STREETAVOIDANCE"],
+            max_cost=parameters["MAXCOST"],
+            reverse=parameters["REVERSE"])
+        
+        return {self.OUTPUT: None}
     
\ No newline at end of file
@@ -0,0 +1,153 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+### Timers, counters, bytes read and written and peak memory for the walkshed scripts
+### Slow calls (AccessMap requests, json, reading and writing layers, reprojection, joins, buffers, xlsx saves)
+### are wrapped in stages, and a run ends with a summary table and a json report
+### Used by "CreateWalkshed.py", "CreateBuffers.py", "ReprojectLayers.py" and "SpatialJoin.py" - nothing here needs QGIS
+
+
+# Largest amount of memory the process has used so far, in bytes (None if it cannot be read)
+def peakMemory():
+    try:
+        import resource
+    except ImportError:
+        return windowsPeakMemory()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Peak working set of the process on Windows, where QGIS usually runs
+def windowsPeakMemory():
+    try:
+        import ctypes
+        from ctypes import wintypes
+    except ImportError:
+        return None
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in ('PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                                                 'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage',
+                                                 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+# Total size of the files that exist among paths (a single path or a list of them)
+def fileBytes(paths):
+    if paths is None:
+        return 0
+    if isinstance(paths, str):
+        paths = [paths]
+    return sum(os.path.getsize(path) for path in paths if path is not None and os.path.exists(path))
+
+
+# Records how long each stage of a run takes, how often it runs and how many bytes it reads and writes
+# Stages can be recorded from several threads at once. With profile, the run is also profiled with cProfile
+# (in the thread that created the recorder, until stop or save) and the stats are dumped next to the json report
+class Recorder:
+
+    def __init__(self, name, profile=False):
+        self.name = name
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.profiler = None
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    # Times the "with" block as one call of the named stage
+    # read and written are file paths whose sizes are added to the stage once the block is done
+    @contextmanager
+    def stage(self, name, read=None, written=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, read=fileBytes(read), written=fileBytes(written))
+
+    # peak is the process peak memory after the stage ran, read here if not given
+    def add(self, name, seconds=0.0, calls=1, read=0, written=0, peak=None):
+        if peak is None:
+            peak = peakMemory()
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes_read': 0, 'bytes_written': 0})
+            stage['calls'] += calls
+            stage['seconds'] += seconds
+            stage['bytes_read'] += read
+            stage['bytes_written'] += written
+            # The process peak once this stage has run - the first stage where it jumps is the one to look at
+            stage['peak_memory'] = max(stage.get('peak_memory') or 0, peak or 0) or None
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Adds the stages and counters of another report (e.g. one returned by a worker process)
+    def merge(self, report):
+        for name, stage in report['stages'].items():
+            self.add(name, stage['seconds'], stage['calls'], stage['bytes_read'], stage['bytes_written'],
+                     stage['peak_memory'] or 0)
+        for name, amount in report['counters'].items():
+            self.count(name, amount)
+
+    def report(self):
+        with self.lock:
+            return {'name': self.name,
+                    'wall_seconds': time.perf_counter() - self.started,
+                    'peak_memory': peakMemory(),
+                    'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                    'counters': dict(self.counters)}
+
+    # Returns the report and starts over - worker processes send their stages back this way after each task
+    def drain(self):
+        report = self.report()
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+        return report
+
+    # Summary table of the stages, slowest first, for the console or feedback.pushInfo
+    def summary(self):
+        report = self.report()
+        lines = [self.name + ": " + format(report['wall_seconds'], '.2f') + "s"
+                 + ("" if report['peak_memory'] is None else ", peak " + format(report['peak_memory'] / 1e6, '.0f')
+                    + " MB"),
+                 "stage".ljust(24) + "calls   seconds   MB read  MB written"]
+        for name, stage in sorted(report['stages'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append(name.ljust(24) + str(stage['calls']).rjust(5) + format(stage['seconds'], '10.2f')
+                         + format(stage['bytes_read'] / 1e6, '10.1f') + format(stage['bytes_written'] / 1e6, '12.1f'))
+        for name, amount in sorted(report['counters'].items()):
+            lines.append(name + ": " + str(amount))
+        return "\n".join(lines)
+
+    # Writes the json report, and the cProfile stats as a ".prof" file beside it when profiling
+    # The stats can be read with "python -m pstats" or snakeviz. Profiling stops here, so the profiler is not left
+    # hooked into the thread (e.g. the QGIS thread once processAlgorithm returns)
+    # Stops profiling - scripts call this when a run fails, so the profiler does not stay hooked into QGIS
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+
+    def save(self, path):
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=1)
+        os.replace(path + '.tmp', path)
+
+        if self.profiler is not None:
+            self.stop()
+            self.profiler.dump_stats(os.path.splitext(path)[0] + '.prof')
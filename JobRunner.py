@@ -0,0 +1,499 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+from AccessMap import ACCESSMAP_URL, ConnectionPool, ResponseCache, fetch_trees, network_url
+from Instruments import Recorder
+from LayerIO import LAYER_EXTENSIONS, readLayer, writeLayer
+import Pipeline
+import SpatialJoin
+
+### Runs the whole location x profile x amenity matrix headless, from a job spec instead of lists in the scripts
+### The job is expanded into tasks - fetch (one per site, every profile) -> buffer (one per walkshed and one per
+### amenity file) -> join (one per walkshed and amenity in its region) -> tabulate (the xlsx table) - and the tasks
+### run on a pool of worker threads as soon as the tasks they need are done
+### Completed tasks are written to "Checkpoint.jsonl" in the run folder, so an interrupted run picks up where it stopped
+
+## This script does not need to be run in QGIS - run from a terminal, e.g. "python JobRunner.py Job.json"
+## A job spec is a json file like:
+#  {"run_dir": "C:\\QGIS Projects\\Walkshed Sim\\Runs\\Seattle",
+#   "workbook": "C:\\QGIS Projects\\Walkshed Sim\\Amenity Reachability Comparison Table.xlsx",
+#   "max_cost": 900,
+#   "sites": [{"name": "MaryPilgrim", "lon": -122.345688, "lat": 47.731363, "region": "North"}, ...],
+#   "profiles": [{"name": "Control", "uphill": 0.15, "downhill": 0.15, "avoidCurbs": 0, "streetAvoidance": 0}, ...],
+#   "amenities": [{"region": "North", "name": "Library", "file": "C:\\...\\Joined North Library.geojson"}, ...]}
+#  "amenities" can also be a folder of files named like "Joined North Library.geojson"
+#  An amenity's optional "column" is the xlsx header its counts go under, if not its name (e.g. "Grocery Store"
+#  for the amenity "GroceryStore" - a folder file "Joined North Grocery Store.geojson" gets both)
+#  Optional keys: "network" (a pedestrian network for "WalkGraph.py" instead of AccessMap), "accessmap_url",
+#  "concurrency" (AccessMap requests at once across all workers, 8 by default) and "timeout" (seconds, 60),
+#  "crs", "walkshed_buffer", "amenity_buffer" and "walkshed_tolerance" (defaults from "Pipeline.py" - e.g. 2 to
+#  polygonize walksheds instead of buffering them), "output_ext"
+#  (format of the buffered and joined files, see "LayerIO.py"),
+#  and "bands" (e.g. [300, 600, 900]) to fetch each walkshed once at the largest band and count every band
+#  (see WalkGraph.band_tree) - "max_cost" is then ignored, and "join_batch_size" to join large amenity layers
+#  that many features at a time (see SpatialJoin.join_batch_size)
+## Site and amenity names cannot contain spaces - joined files are matched by the words of their names
+## Without "workbook", the counts are only kept in the checkpoint and "Reachability Counts.json"
+
+# Checkpoint log of completed tasks, one json line per task, in the run folder
+CHECKPOINT = "Checkpoint.jsonl"
+
+# Seconds between throughput lines
+REPORT_EVERY = 10
+
+
+# Reads a job spec and fills in the defaults
+def loadJob(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        job = json.load(f)
+
+    job.setdefault('max_cost', 900)
+    job.setdefault('crs', Pipeline.target_crs)
+    job.setdefault('walkshed_buffer', Pipeline.walkshed_buffer)
+    job.setdefault('amenity_buffer', Pipeline.amenity_buffer)
+    job.setdefault('walkshed_tolerance', Pipeline.walkshed_tolerance)
+    job.setdefault('output_ext', SpatialJoin.output_ext)
+    job.setdefault('accessmap_url', ACCESSMAP_URL)
+    job.setdefault('concurrency', 8)
+    job.setdefault('timeout', 60)
+    job['bands'] = sorted(float(band) for band in job.get('bands', []))
+    if job['bands']:
+        job['max_cost'] = job['bands'][-1]
+    if isinstance(job['amenities'], str):
+        job['amenities'] = amenityFolder(job['amenities'])
+
+    for item in job['sites'] + job['profiles'] + job['amenities']:
+        if " " in item['name']:
+            raise ValueError("Names in a job cannot contain spaces: " + item['name'])
+    for amenity in job['amenities']:
+        amenity.setdefault('column', amenity['name'])
+    return job
+
+
+# Lists the amenity files in a folder named like "Joined North Library.geojson" (or "RP Joined North Library")
+def amenityFolder(folder):
+    amenities = []
+    for name in sorted(os.listdir(folder)):
+        file_name, file_ext = os.path.splitext(name)
+        if file_ext not in LAYER_EXTENSIONS:
+            continue
+        tokens = file_name.split(" ")
+        if tokens[0] == "RP":
+            tokens = tokens[1:]
+        if len(tokens) < 3 or tokens[0] != "Joined":
+            print("Error: " + name + " is not named like \"Joined <region> <amenity>\"")
+            continue
+        amenities.append({'region': tokens[1], 'name': "".join(tokens[2:]), 'column': " ".join(tokens[2:]),
+                          'file': os.path.join(folder, name)})
+    return amenities
+
+
+# Fingerprint of a task's settings and the fingerprints of the tasks it needs
+# A checkpointed task is only reused if its fingerprint is unchanged, so editing a site reruns everything after it
+def fingerprint(params, deps):
+    text = json.dumps([params] + [dep.fingerprint for dep in deps], sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+# One step of the job. "work" is called with the results of "deps" (in order) and returns a json-able result
+# "files" lists the files the result needs, so a checkpointed task whose files are gone is run again
+class Task:
+
+    def __init__(self, name, kind, work, deps=(), params=None, files=lambda result: ()):
+        self.name = name
+        self.kind = kind
+        self.work = work
+        self.deps = list(deps)
+        self.files = files
+        self.fingerprint = fingerprint(params, self.deps)
+        self.children = []
+        self.waiting = len(self.deps)
+        self.result = None
+        self.error = None
+        for dep in self.deps:
+            dep.children.append(self)
+
+
+# Expands a job into its tasks, in dependency order
+def buildTasks(job, state):
+    run_dir = job['run_dir']
+    dir_walkshed = os.path.join(run_dir, "Buffered Walksheds")
+    dir_amenity = os.path.join(run_dir, "Buffered Amenities")
+    dir_output = os.path.join(run_dir, "Final Joined Files")
+    for directory in (dir_walkshed, dir_amenity, dir_output):
+        os.makedirs(directory, exist_ok=True)
+    ext = job['output_ext']
+    tasks = []
+
+    # Buffered amenities, once per file however many sites join them
+    amenity_tasks = {}
+    for amenity in job['amenities']:
+        file_name = "Buffer Joined " + amenity['region'] + " " + amenity['name'] + ext
+        params = dict(file=amenity['file'], mtime=os.path.getmtime(amenity['file']), crs=job['crs'],
+                      buffer=job['amenity_buffer'])
+        task = Task("buffer amenity " + amenity['region'] + " " + amenity['name'], "buffer amenity",
+                    lambda a=amenity, f=file_name: bufferAmenity(job, a['file'], os.path.join(dir_amenity, f)),
+                    params=params, files=lambda result: [result])
+        amenity_tasks[amenity['region'], amenity['name']] = task
+        tasks.append(task)
+
+    join_tasks = []
+    for site in job['sites']:
+        requests = [dict(lon=site['lon'], lat=site['lat'], max_cost=job['max_cost'], name=site['name'],
+                         profile=profile['name'],
+                         **{key: profile[key] for key in ('uphill', 'downhill', 'avoidCurbs', 'streetAvoidance')})
+                    for profile in job['profiles']]
+        fetch = Task("fetch " + site['name'], "fetch", lambda r=requests: fetchSite(state, r, job['bands']),
+                     params=dict(requests=requests, source=state['source'],
+                                 bands=job['bands']),
+                     files=lambda result: [file for files in result.values() if isinstance(files, list)
+                                           for file in files])
+        tasks.append(fetch)
+
+        for profile in job['profiles']:
+            walkshed_name = "Buffer " + site['name'] + " RT " + profile['name']
+            buffer = Task("buffer walkshed " + site['name'] + " " + profile['name'], "buffer walkshed",
+                          lambda trees, n=site['name'] + " " + profile['name'], p=profile['name'],
+                                 f=walkshed_name + ext:
+                              bufferWalkshed(job, n, trees.get(p), os.path.join(dir_walkshed, f)),
+                          [fetch],
+                          params=dict(crs=job['crs'], buffer=job['walkshed_buffer'],
+                                      tolerance=job['walkshed_tolerance']),
+                          files=lambda result: [result] if result else [])
+            tasks.append(buffer)
+
+            for amenity in job['amenities']:
+                if amenity['region'] != site['region']:
+                    continue
+                output_name = site['name'] + " RT " + profile['name'] + " " + amenity['name']
+                key = (site['name'], profile['name'], amenity['column'])
+                join = Task("join " + output_name, "join",
+                            lambda walkshed, buffered, o=output_name, k=key:
+                                joinTask(walkshed, buffered, dir_output, o, k, job['bands']),
+                            [buffer, amenity_tasks[amenity['region'], amenity['name']]],
+                            params=dict(ext=ext, bands=job['bands'], key=key),
+                            files=lambda result: [result[0]] if result[0] else [])
+                join_tasks.append(join)
+                tasks.append(join)
+
+    dict_location = {site['name']: site['region'] for site in job['sites']}
+    dict_profile = {profile['name']: index for index, profile in enumerate(job['profiles'], start=1)}
+    tasks.append(Task("tabulate", "tabulate",
+                      lambda *joins: tabulate(job, joins, dict_location, dict_profile),
+                      join_tasks, params=dict(workbook=job.get('workbook'))))
+    return tasks
+
+
+# Fetches (or computes from the local network) every profile of one site into the response cache
+# Returns {profile: [edges, node_costs, origin files]}, with the AccessMap or WalkGraph message instead of the
+# files for profiles without a walkshed (e.g. a site off the network). With bands, the files are the trees split
+# into those bands
+def fetchSite(state, requests, bands=()):
+    cache = state['cache']
+    files = {}
+    missing = []
+    for request in requests:
+        cached = cache.get(request)
+        if cached is None:
+            missing.append(request)
+        else:
+            files[request['profile']] = cached
+
+    if state['graph'] is not None:
+        from WalkGraph import compute_trees
+        results = compute_trees(missing, state['graph'], cache, state['recorder'])
+    else:
+        results = fetch_trees(missing, cache=cache, recorder=state['recorder'], concurrency=len(missing) or 1,
+                              pool=state['pool'])
+    for request, result, message in results:
+        if result is None:
+            print(request['name'] + ' ' + request['profile'] + ': ' + message)
+            files[request['profile']] = message
+            continue
+        files[request['profile']] = list(result)
+
+    if bands:
+        files = {profile: list(cache.put_bands(tree, bands)) if isinstance(tree, list) else tree
+                 for profile, tree in files.items()}
+    return files
+
+
+# Reprojects and polygonizes (or buffers and dissolves) one walkshed, as "PolygonizeWalksheds.py" would
+# "tree" is the fetch result of the walkshed - returns None if it has no walkshed, so its joins count 0
+def bufferWalkshed(job, name, tree, output_file):
+    if not isinstance(tree, list):
+        print("No walkshed for " + name + ": " + str(tree or "not fetched"))
+        return None
+    edges = Pipeline.reprojectFrame(readLayer(tree[0]), job['crs'])
+    if job['walkshed_tolerance']:
+        settings = {key: value for key, value in job['walkshed_buffer'].items() if key != 'dissolve'}
+        buffered = Pipeline.polygonizeFrame(edges, job['walkshed_tolerance'], **settings)
+    else:
+        buffered = Pipeline.bufferFrame(edges, **job['walkshed_buffer'])
+    writeLayer(buffered, output_file)
+    return output_file
+
+
+# Reprojects and buffers one amenity file, as "ReprojectLayers.py" and "CreateBuffers.py" would
+def bufferAmenity(job, input_file, output_file):
+    buffered = Pipeline.bufferFrame(Pipeline.reprojectFrame(readLayer(input_file), job['crs']), **job['amenity_buffer'])
+    writeLayer(buffered, output_file)
+    return output_file
+
+
+# Joins one walkshed and amenity with SpatialJoin.produceJoin
+# Returns [joined file, location, profile, amenity, reachable count, {band: reachable count}]
+# A walkshed that could not be fetched has no joined file and counts 0 in every band
+def joinTask(walkshed_file, amenity_file, dir_output, output_name, key, bands=()):
+    if walkshed_file is None:
+        return [None] + list(key) + [0, {format(band, 'g'): 0 for band in bands}]
+    counts = SpatialJoin.ReachabilityTable(None, None, None)
+    file_name = SpatialJoin.produceJoin(os.path.dirname(walkshed_file), os.path.basename(walkshed_file),
+                                        os.path.dirname(amenity_file), os.path.basename(amenity_file),
+                                        dir_output, output_name, counts, *key)
+    bands = {format(band[3], 'g'): count for band, count in counts.counts.items() if len(band) > 3}
+    return [file_name] + list(key) + [counts.counts[key], bands]
+
+
+# Writes every reachable count into the xlsx table in one save, and into "Reachability Counts.json"
+def tabulate(job, joins, dict_location, dict_profile):
+    table = SpatialJoin.ReachabilityTable(job.get('workbook'), dict_location, dict_profile)
+    for file_name, location, profile, amenity, count, bands in joins:
+        table.add(location, profile, amenity, count)
+        for band, band_count in bands.items():
+            table.add(location, profile, amenity, band_count, float(band))
+
+    path = os.path.join(job['run_dir'], "Reachability Counts.json")
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump([list(key) + [count] for key, count in sorted(table.counts.items())], f, indent=1)
+    os.replace(path + '.tmp', path)
+    if job.get('workbook'):
+        table.save()
+    return len(table.counts)
+
+
+# Runs tasks on worker threads, each with its own deque of ready tasks
+# A worker takes the newest task from its own deque, so the walkshed it just fetched is buffered and joined next
+# while its layers are still cached. A worker with nothing to do steals the oldest task from another worker
+# Tasks whose dependencies failed are not run
+class Scheduler:
+
+    def __init__(self, workers, recorder, checkpoint):
+        self.queues = [deque() for _ in range(workers)]
+        self.condition = threading.Condition()
+        self.recorder = recorder
+        self.checkpoint = checkpoint
+        self.remaining = 0
+        self.done = {}
+        self.total = {}
+        self.failed = []
+        self.ran = 0
+        self.started = None
+        self.reported = None
+
+    # Runs every task not already done and returns the tasks that failed
+    def run(self, tasks):
+        self.remaining = 0
+        for task in tasks:
+            self.total[task.kind] = self.total.get(task.kind, 0) + 1
+            self.done.setdefault(task.kind, 0)
+            if task.result is not None:
+                self.done[task.kind] += 1
+            else:
+                self.remaining += 1
+        for task in tasks:
+            if task.result is not None:
+                for child in task.children:
+                    child.waiting -= 1
+
+        # Tasks that are ready at the start are dealt out across the workers, each taking its share in order
+        ready = [task for task in tasks if task.result is None and task.waiting == 0]
+        for index, task in enumerate(reversed(ready)):
+            self.queues[index % len(self.queues)].append(task)
+
+        self.started = self.reported = time.perf_counter()
+        threads = [threading.Thread(target=self.work, args=(index,), daemon=True) for index in range(len(self.queues))]
+        for thread in threads:
+            thread.start()
+        # Joined with a timeout so Ctrl+C still stops the run - completed tasks are already checkpointed
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+        self.report()
+        return self.failed
+
+    # Takes a task from the worker's own deque, or steals one from another worker
+    def take(self, index):
+        if self.queues[index]:
+            return self.queues[index].pop()
+        victims = [queue for queue in self.queues if queue]
+        if victims:
+            return random.choice(victims).popleft()
+        return None
+
+    def work(self, index):
+        while True:
+            with self.condition:
+                task = self.take(index)
+                while task is None and self.remaining:
+                    self.condition.wait()
+                    task = self.take(index)
+                if task is None:
+                    return
+
+            start = time.perf_counter()
+            try:
+                task.result = task.work(*[dep.result for dep in task.deps])
+            except Exception as error:
+                task.error = error
+                print("Failed " + task.name + ": " + repr(error))
+            self.recorder.add(task.kind, time.perf_counter() - start)
+
+            with self.condition:
+                if task.error is None:
+                    self.checkpoint.write(task)
+                    self.done[task.kind] += 1
+                    self.ran += 1
+                    self.release(task, index)
+                else:
+                    self.fail(task)
+                self.remaining -= 1
+                self.condition.notify_all()
+                if time.perf_counter() - self.reported > REPORT_EVERY:
+                    self.report()
+
+    # Queues the children of a completed task that have nothing left to wait for on the worker that ran it
+    def release(self, task, index):
+        for child in task.children:
+            child.waiting -= 1
+            if child.waiting == 0 and child.result is None:
+                self.queues[index].append(child)
+
+    # Marks a failed task, and every task that needs it, as failed
+    def fail(self, task):
+        self.failed.append(task)
+        for child in task.children:
+            if child.error is None and child.result is None:
+                child.error = "needs " + task.name
+                self.remaining -= 1
+                self.fail(child)
+
+    # Prints the tasks done so far, the rate in this run and the time left at that rate
+    def report(self):
+        self.reported = time.perf_counter()
+        elapsed = self.reported - self.started
+        rate = self.ran / elapsed if elapsed else 0
+        line = (str(sum(self.done.values())) + "/" + str(sum(self.total.values())) + " tasks  "
+                + format(elapsed, '.0f') + "s  " + format(rate, '.2f') + " tasks/s")
+        if rate and self.remaining:
+            line += "  about " + format(self.remaining / rate, '.0f') + "s left"
+        line += "  (" + ", ".join(kind + " " + str(self.done[kind]) + "/" + str(self.total[kind])
+                                  for kind in self.total) + ")"
+        print(line, flush=True)
+
+
+# Log of completed tasks in the run folder, appended to as each task finishes
+# An interrupted run loses at most the tasks that were running - the last line may be cut off and is ignored
+class Checkpoint:
+
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.entries = {}
+        if restart and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[entry['task']] = entry
+        self.file = open(path, 'a', encoding='utf-8')
+
+    # Gives tasks their checkpointed results if their settings are unchanged and their files still exist
+    # Returns the number of tasks restored
+    def restore(self, tasks):
+        restored = 0
+        for task in tasks:
+            entry = self.entries.get(task.name)
+            if entry is None or entry['fingerprint'] != task.fingerprint:
+                continue
+            if not all(os.path.exists(file) for file in task.files(entry['result'])):
+                continue
+            task.result = entry['result']
+            restored += 1
+        return restored
+
+    def write(self, task):
+        self.file.write(json.dumps({'task': task.name, 'fingerprint': task.fingerprint, 'result': task.result}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Runs a job, resuming from its checkpoint unless restart is set
+# Returns the tasks that failed
+def runJob(job, workers=os.cpu_count(), restart=False):
+    run_dir = job['run_dir']
+    os.makedirs(run_dir, exist_ok=True)
+
+    # Stages of the joins go into the same report as the tasks
+    recorder = Recorder("JobRunner")
+    SpatialJoin.instruments = recorder
+    SpatialJoin.join_batch_size = job.get('join_batch_size', SpatialJoin.join_batch_size)
+    SpatialJoin.output_ext = job['output_ext']
+
+    graph = None
+    if job.get('network'):
+        from WalkGraph import WalkGraph
+        with recorder.stage("load network", read=job['network']):
+            graph = WalkGraph.load(job['network'])
+    # Every worker's requests share one pool, so at most "concurrency" requests reach AccessMap at once
+    pool = ConnectionPool(job['accessmap_url'], size=job['concurrency'], timeout=job['timeout'])
+    # Walksheds and fetch fingerprints are keyed on the network file's size and modification time as well
+    source = network_url(job['network']) if job.get('network') else job['accessmap_url']
+    state = dict(cache=ResponseCache(os.path.join(run_dir, "Walkshed Cache"), url=source),
+                 graph=graph, pool=pool, source=source, recorder=recorder)
+
+    tasks = buildTasks(job, state)
+    checkpoint = Checkpoint(os.path.join(run_dir, CHECKPOINT), restart)
+    restored = checkpoint.restore(tasks)
+    if restored:
+        print("Resuming: " + str(restored) + " of " + str(len(tasks)) + " tasks already done")
+
+    try:
+        failed = Scheduler(workers, recorder, checkpoint).run(tasks)
+    finally:
+        checkpoint.close()
+        pool.close()
+
+    for task in failed:
+        print("Not done: " + task.name + " (" + str(task.error) + ")")
+    print(SpatialJoin.layer_cache.summary())
+    print(recorder.summary())
+    recorder.save(os.path.join(run_dir, "JobRunner Report.json"))
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a walkshed job spec headless")
+    parser.add_argument('job', help="job spec json")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="worker threads")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoint and run every task again")
+    args = parser.parse_args()
+
+    try:
+        failed = runJob(loadJob(args.job), args.workers, args.restart)
+    except KeyboardInterrupt:
+        sys.exit("Stopped - run the same job again to resume from the checkpoint")
+    if failed:
+        sys.exit(1)
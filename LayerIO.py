@@ -0,0 +1,210 @@
+import geopandas as gpd
+import json
+import os
+import pyproj
+from shapely.geometry import box
+
+### Reads and writes layers as GeoJSON, GeoParquet or FlatGeobuf, chosen by file extension
+### GeoJSON is kept for compatibility - GeoParquet and FlatGeobuf are much faster to read and write,
+### and both can skip features outside a bounding box without parsing the whole file
+
+## This script does not need to be run in QGIS
+
+# File extensions of the supported layer formats and the OGR driver that writes them
+LAYER_DRIVERS = {
+    ".geojson": "GeoJSON",
+    ".parquet": None, # written with GeoDataFrame.to_parquet
+    ".fgb": "FlatGeobuf"
+}
+LAYER_EXTENSIONS = tuple(LAYER_DRIVERS)
+
+# Features per GeoParquet row group - bbox reads skip whole row groups and readLayerBatches decodes one at a time
+ROW_GROUP_SIZE = 65536
+
+
+# CRS stored in a layer file, read without loading its features
+def layerCRS(path):
+    if os.path.splitext(path)[1] == ".parquet":
+        import pyarrow.parquet as pq
+
+        column = parquetGeometry(pq.read_schema(path))[1]
+        # GeoParquet files without a "crs" entry are longitude/latitude
+        crs = column.get('crs', 'OGC:CRS84')
+        return None if crs is None else pyproj.CRS.from_user_input(crs)
+
+    import pyogrio
+
+    crs = pyogrio.read_info(path)['crs']
+    return None if crs is None else pyproj.CRS.from_user_input(crs)
+
+
+# Reads a layer file
+# bbox (minx, miny, maxx, maxy) only loads features intersecting that box - give bbox_crs if the box is not
+# in the file's own CRS. GeoParquet files written by writeLayer can skip whole row groups outside the box
+# GeoParquet files without a bbox covering column (e.g. written by QGIS or other tools) are read whole and filtered
+def readLayer(path, bbox=None, bbox_crs=None):
+    bbox = fileBBox(path, bbox, bbox_crs)
+    if os.path.splitext(path)[1] == ".parquet":
+        import pyarrow.parquet as pq
+
+        if bbox is not None and parquetCovering(parquetGeometry(pq.read_schema(path))[1]) is None:
+            gdf = gpd.read_parquet(path)
+            return gdf[gdf.intersects(box(*bbox))].reset_index(drop=True)
+        return gpd.read_parquet(path, bbox=bbox)
+    return gpd.read_file(path, bbox=bbox)
+
+
+# Name and "geo" metadata of the primary geometry column in the arrow schema of a GeoParquet file
+def parquetGeometry(schema):
+    geo = json.loads(schema.metadata[b'geo'])
+    return geo['primary_column'], geo['columns'][geo['primary_column']]
+
+
+# Name of the bbox covering column described by the "geo" metadata of a geometry column, or None
+def parquetCovering(column):
+    return column.get('covering', {}).get('bbox', {}).get('xmin', [None])[0]
+
+
+# A bounding box given in bbox_crs, in the CRS of a layer file
+def fileBBox(path, bbox, bbox_crs):
+    if bbox is not None and bbox_crs is not None:
+        file_crs = layerCRS(path)
+        if file_crs is not None and file_crs != bbox_crs:
+            bbox = tuple(gpd.GeoSeries([box(*bbox)], crs=bbox_crs).to_crs(file_crs).total_bounds)
+    return bbox
+
+
+# Reads a layer file batch_size features at a time, yielding a GeoDataFrame per batch
+# Only one batch is held in memory for GeoParquet and FlatGeobuf (GDAL still parses a whole GeoJSON file
+# up front). Features are numbered on from batch to batch, as readLayer would index them
+# bbox and bbox_crs filter features as in readLayer
+def readLayerBatches(path, batch_size, bbox=None, bbox_crs=None):
+    bbox = fileBBox(path, bbox, bbox_crs)
+    if os.path.splitext(path)[1] == ".parquet":
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(path)
+        geometry_name, column = parquetGeometry(parquet.schema_arrow)
+        crs = column.get('crs', 'OGC:CRS84')
+        # The bbox covering column written by writeLayer is not an attribute
+        covering = parquetCovering(column)
+        batches = parquet.iter_batches(batch_size,
+                                       columns=[name for name in parquet.schema_arrow.names if name != covering])
+        return layerBatches(batches, geometry_name, crs, bbox)
+
+    return ogrBatches(path, batch_size, bbox)
+
+
+# Batches read through GDAL, with the file kept open until the last batch
+def ogrBatches(path, batch_size, bbox):
+    import pyogrio
+
+    with pyogrio.open_arrow(path, batch_size=batch_size, bbox=bbox, use_pyarrow=True) as (meta, reader):
+        yield from layerBatches(reader, meta['geometry_name'] or 'wkb_geometry', meta['crs'], None)
+
+
+# GeoDataFrames from arrow batches with a WKB geometry column, skipping batches with nothing in bbox
+def layerBatches(batches, geometry_name, crs, bbox):
+    import shapely
+
+    start = 0
+    for batch in batches:
+        df = batch.to_pandas()
+        position = df.columns.get_loc(geometry_name)
+        geoms = shapely.from_wkb(df.pop(geometry_name).to_numpy())
+        if bbox is not None:
+            inside = shapely.intersects(geoms, box(*bbox))
+            df, geoms = df[inside], geoms[inside]
+        if len(df) == 0:
+            continue
+        df.index = range(start, start + len(df))
+        start += len(df)
+        df.insert(position, 'geometry', geoms)
+        yield gpd.GeoDataFrame(df, geometry='geometry', crs=crs)
+
+
+# Writes a layer file in the format given by its extension
+def writeLayer(gdf, path):
+    ext = os.path.splitext(path)[1]
+    if ext == ".parquet":
+        # The bounding box column lets readers filter on bbox without decoding geometries
+        gdf.to_parquet(path, write_covering_bbox=True, row_group_size=ROW_GROUP_SIZE)
+    else:
+        gdf.to_file(path, driver=LAYER_DRIVERS[ext])
+
+
+# Writes a layer file one GeoDataFrame at a time, in the format given by its extension
+# Batches go straight into a GeoParquet file as row groups, so memory only grows with the largest batch
+# GeoJSON and FlatGeobuf are staged as GeoParquet beside the output and streamed through GDAL on close
+# (appending to them with GDAL rewrites the file each time). Nothing is written until a non-empty batch
+# arrives - close returns whether the file was written
+class LayerWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.ext = os.path.splitext(path)[1]
+        self.staged = path if self.ext == ".parquet" else path + ".tmp.parquet"
+        self.writer = None
+        self.schema = None
+        self.crs = None
+
+    def write(self, gdf):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if gdf.empty:
+            return
+        table = layerTable(gdf, covering=self.ext == ".parquet")
+        if self.writer is None:
+            # Columns without any values in the first batch take strings, since later batches may have some
+            schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                for field in table.schema], metadata=table.schema.metadata)
+            self.schema = schema
+            self.crs = gdf.crs
+            self.writer = pq.ParquetWriter(self.staged, schema)
+        self.writer.write_table(table.cast(self.schema), row_group_size=ROW_GROUP_SIZE)
+
+    def close(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.writer is None:
+            return False
+        self.writer.close()
+        if self.staged == self.path:
+            return True
+
+        import pyogrio
+
+        parquet = pq.ParquetFile(self.staged)
+        reader = pa.RecordBatchReader.from_batches(parquet.schema_arrow, parquet.iter_batches())
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        pyogrio.write_arrow(reader, self.path, driver=LAYER_DRIVERS[self.ext], geometry_name='geometry',
+                            geometry_type='Unknown', crs=None if self.crs is None else self.crs.to_wkt())
+        parquet.close()
+        os.remove(self.staged)
+        return True
+
+
+# Arrow table of a GeoDataFrame with a WKB "geometry" column and GeoParquet metadata
+# With covering, a "bbox" column lets readers filter on bbox as in files written by writeLayer
+def layerTable(gdf, covering=False):
+    import pyarrow as pa
+    import shapely
+
+    geoms = gdf.geometry.values
+    # The WKB column keeps the geometry's place among the columns, as writeLayer does
+    position = gdf.columns.get_loc(gdf.geometry.name)
+    table = pa.Table.from_pandas(gdf.drop(columns=gdf.geometry.name), preserve_index=False)
+    table = table.add_column(position, 'geometry', pa.array(shapely.to_wkb(geoms), pa.binary()))
+    column = {'encoding': 'WKB', 'geometry_types': []}
+    if gdf.crs is not None:
+        column['crs'] = gdf.crs.to_json_dict()
+    if covering:
+        bounds = shapely.bounds(geoms)
+        table = table.append_column('bbox', pa.StructArray.from_arrays(
+            [pa.array(bounds[:, i]) for i in range(4)], ['xmin', 'ymin', 'xmax', 'ymax']))
+        column['covering'] = {'bbox': {key: ['bbox', key] for key in ('xmin', 'ymin', 'xmax', 'ymax')}}
+    geo = {'version': '1.1.0', 'primary_column': 'geometry', 'columns': {'geometry': column}}
+    return table.replace_schema_metadata(dict(table.schema.metadata or {}, geo=json.dumps(geo)))
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+
+### Records which inputs and parameters produced each output, so reruns can skip outputs that are up to date
+### Used by "SpatialJoin.py", "CreateBuffers.py" and "ReprojectLayers.py" - nothing here needs QGIS
+
+
+# Hash of a file's contents, read in blocks
+def fileHash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Manifest of outputs stored as a json file
+# Each entry is keyed by an output name and holds the size, modification time and hash of every input,
+# the parameters used, the output files written and an optional result (e.g. a reachable amenity count)
+class Manifest:
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.hashes = {}
+        self.skipped = 0
+        self.rebuilt = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f).get('outputs', {})
+
+    # Size and modification time of a file - the hash is only computed if these have changed,
+    # and at most once per run for files shared by several outputs
+    def fingerprint(self, path, previous=None):
+        stat = os.stat(path)
+        if previous is not None and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime_ns:
+            return previous
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            self.hashes[key] = fileHash(path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': self.hashes[key]}
+
+    # Returns the entry for an output if its inputs and parameters are unchanged and its output files exist,
+    # otherwise None. outputs_required rejects entries that have no output files (e.g. counts only)
+    def current(self, key, inputs, params, outputs_required=True):
+        entry = self.entries.get(key)
+        if entry is None or entry['params'] != params or set(entry['inputs']) != set(map(os.path.abspath, inputs)):
+            return None
+        if outputs_required and not entry['outputs']:
+            return None
+        if not all(os.path.exists(output) for output in entry['outputs']):
+            return None
+
+        for path, previous in entry['inputs'].items():
+            if not os.path.exists(path):
+                return None
+            fingerprint = self.fingerprint(path, previous)
+            if fingerprint['hash'] != previous['hash']:
+                return None
+            # Same contents with a new modification time - remember it so the hash is not recomputed next run
+            entry['inputs'][path] = fingerprint
+
+        self.skipped += 1
+        return entry
+
+    def record(self, key, inputs, params, outputs=(), result=None):
+        self.entries[key] = {
+            'inputs': {os.path.abspath(path): self.fingerprint(path) for path in inputs},
+            'params': params,
+            'outputs': [os.path.abspath(output) for output in outputs],
+            'result': result}
+        self.rebuilt += 1
+
+    def save(self):
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'outputs': self.entries}, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+    def summary(self):
+        return (os.path.basename(self.path) + ": " + str(self.rebuilt) + " rebuilt, "
+                + str(self.skipped) + " unchanged")
@@ -0,0 +1,277 @@
+import geopandas as gpd
+import numpy as np
+import pyproj
+import shapely
+import functools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
+
+from LayerIO import LAYER_EXTENSIONS, readLayer, writeLayer
+from SpatialJoin import (ReachabilityTable, countReachable, pairNames, splitReachable, writeJoined,
+                         dict_location, dict_profile, dir_output, output_ext, workbook)
+
+### Runs "ReprojectLayers", "CreateBuffers" and "SpatialJoin" as one pipeline with layers passed in memory
+### Only the joined files and the xlsx table are written - no "RP " or "Buffer " GeoJSON in between
+
+## This script does not need to be run in QGIS
+## Input file names follow the naming convention before the "RP " prefix is added
+#  e.g. "MaryPilgrim RT Cane.geojson" for walksheds and "Joined North Library.geojson" for amenities
+
+
+# QGIS native:buffer END_CAP_STYLE and JOIN_STYLE codes as shapely styles
+CAP_STYLES = {0: 'round', 1: 'flat', 2: 'square'}
+JOIN_STYLES = {0: 'round', 1: 'mitre', 2: 'bevel'}
+
+
+# Adds the time spent in a "with" block to timings[name]
+@contextmanager
+def stage(timings, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+
+# Transformer between two CRS, built once per CRS pair in each process
+@functools.lru_cache(maxsize=None)
+def transformerFor(source_crs, target_crs):
+    return pyproj.Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+# Transforms the coordinates of every geometry in an array with one call to the transformer
+# (two calls if some geometries have Z - those are transformed apart, so 2D ones do not get a NaN Z)
+def transformGeometries(geoms, source_crs, target_crs):
+    transformer = transformerFor(source_crs, target_crs)
+    has_z = shapely.has_z(geoms)
+    if not has_z.any():
+        return shapely.transform(geoms, lambda coords: np.column_stack(
+            transformer.transform(coords[:, 0], coords[:, 1])))
+
+    geoms = geoms.copy()
+    geoms[has_z] = shapely.transform(geoms[has_z], lambda coords: np.column_stack(
+        transformer.transform(coords[:, 0], coords[:, 1], coords[:, 2])), include_z=True)
+    if not has_z.all():
+        geoms[~has_z] = shapely.transform(geoms[~has_z], lambda coords: np.column_stack(
+            transformer.transform(coords[:, 0], coords[:, 1])))
+    return geoms
+
+
+# Parsed CRS, built once per input (e.g. "EPSG:32610") in each process
+@functools.lru_cache(maxsize=None)
+def crsFor(crs):
+    return pyproj.CRS.from_user_input(crs)
+
+
+# Reprojects a layer in memory, like native:reprojectlayer in "ReprojectLayers.py"
+def reprojectFrame(gdf, crs):
+    crs = crsFor(crs)
+    if gdf.crs == crs:
+        return gdf
+    geoms = transformGeometries(np.asarray(gdf.geometry.values), gdf.crs, crs)
+    return gdf.set_geometry(gpd.GeoSeries(geoms, index=gdf.index, crs=crs))
+
+
+# Reprojects one layer file to crs (any input pyproj accepts, e.g. "EPSG:32610") and writes it
+# Returns the number of features
+def reprojectFile(input_file, output_file, crs):
+    gdf = reprojectFrame(readLayer(input_file), crs)
+    writeLayer(gdf, output_file)
+    return len(gdf)
+
+
+# Reprojects many layer files, spread across a process pool when processes is more than 1
+# Each worker keeps its transformers, so a CRS pair is only set up once per worker
+# Returns the total number of features
+def reprojectFiles(input_files, output_files, crs, processes=1):
+    if processes <= 1 or len(input_files) <= 1:
+        return sum(map(reprojectFile, input_files, output_files, repeat(crs)))
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return sum(executor.map(reprojectFile, input_files, output_files, repeat(crs)))
+
+
+# Buffers an array of geometries in one vectorized call with native:buffer settings
+def bufferGeometries(geoms, distance=10, segments=5, end_cap_style=0, join_style=0, miter_limit=2):
+    return shapely.buffer(geoms, distance, quad_segs=segments, cap_style=CAP_STYLES[end_cap_style],
+                          join_style=JOIN_STYLES[join_style], mitre_limit=miter_limit)
+
+
+# Replaces the geometries of a layer with their buffers
+# With dissolve, the buffers are merged into a single feature keeping the attributes of the first feature
+# (one feature per band for walksheds split into isochrone bands, see dissolveBands)
+def withBuffers(gdf, buffered, dissolve=False):
+    gdf = gdf.set_geometry(gpd.GeoSeries(buffered, index=gdf.index, crs=gdf.crs))
+    if dissolve and len(gdf) > 0:
+        if 'band' in gdf.columns:
+            return dissolveBands(gdf, buffered, shapely.union_all)
+        gdf = gdf.iloc[:1].set_geometry(gpd.GeoSeries([shapely.union_all(buffered)], index=gdf.index[:1], crs=gdf.crs))
+    return gdf
+
+
+# Merges the geometries of a walkshed split into isochrone bands (see WalkGraph.band_tree) into one feature per band
+# The feature of band b combines every geometry with band <= b, so bands are nested like separate walksheds
+# of each max cost. Each feature keeps the attributes of the first feature of its band
+def dissolveBands(gdf, geoms, combine):
+    values = gdf['band'].to_numpy()
+    bands = np.unique(values)
+    first = gdf.iloc[[int(np.argmax(values == band)) for band in bands]]
+    return first.set_geometry(gpd.GeoSeries([combine(geoms[values <= band]) for band in bands],
+                                            index=first.index, crs=gdf.crs))
+
+
+# Buffers every geometry of a layer in one vectorized call, like native:buffer in "CreateBuffers.py"
+def bufferFrame(gdf, distance=10, segments=5, end_cap_style=0, join_style=0, miter_limit=2, dissolve=False):
+    buffered = bufferGeometries(np.asarray(gdf.geometry.values), distance, segments, end_cap_style, join_style,
+                                miter_limit)
+    return withBuffers(gdf, buffered, dissolve)
+
+
+# Turns a walkshed's reachable tree edges into one simplified polygon
+# Chains of edges are merged and simplified before buffering, so far fewer segments are buffered and unioned,
+# and the union is simplified again with the same tolerance (in layer units, topology preserving)
+def polygonizeGeometries(geoms, tolerance=2, distance=10, segments=5, end_cap_style=0, join_style=0, miter_limit=2):
+    lines = shapely.get_parts(shapely.line_merge(shapely.multilinestrings(geoms)))
+    lines = shapely.simplify(lines, tolerance, preserve_topology=True)
+    polygon = shapely.union_all(bufferGeometries(lines, distance, segments, end_cap_style, join_style, miter_limit))
+    return shapely.simplify(polygon, tolerance, preserve_topology=True)
+
+
+# Polygonizes a walkshed layer into a single feature keeping the attributes of the first feature, like
+# bufferFrame with dissolve. The vertex counts of the edges and of the polygon are added as attributes
+# Walksheds split into isochrone bands get one polygon per band
+def polygonizeFrame(gdf, tolerance=2, distance=10, segments=5, end_cap_style=0, join_style=0, miter_limit=2):
+    geoms = np.asarray(gdf.geometry.values)
+    if len(gdf) == 0:
+        return gdf.assign(vertices_before=0, vertices_after=0)
+    if 'band' in gdf.columns:
+        polygons = dissolveBands(gdf, geoms, lambda band_geoms: polygonizeGeometries(
+            band_geoms, tolerance, distance, segments, end_cap_style, join_style, miter_limit))
+        values = gdf['band'].to_numpy()
+        vertices = shapely.get_num_coordinates(geoms)
+        return polygons.assign(vertices_before=[int(vertices[values <= band].sum()) for band in polygons['band']],
+                               vertices_after=shapely.get_num_coordinates(polygons.geometry.values))
+    polygon = polygonizeGeometries(geoms, tolerance, distance, segments, end_cap_style, join_style, miter_limit)
+    gdf = gdf.iloc[:1].set_geometry(gpd.GeoSeries([polygon], index=gdf.index[:1], crs=gdf.crs))
+    return gdf.assign(vertices_before=int(shapely.get_num_coordinates(geoms).sum()),
+                      vertices_after=int(shapely.get_num_coordinates(polygon)))
+
+
+# Buffers many layer files at once and writes the results, without loading anything into QGIS
+# The geometries of every input are buffered in a single vectorized call, then split back into their files
+# (each dissolved on its own with dissolve). Layers in different CRS are buffered in their own units,
+# as native:buffer would. Returns the number of features buffered
+def bufferFiles(input_files, output_files, distance=10, segments=5, end_cap_style=0, join_style=0,
+                miter_limit=2, dissolve=False):
+    layers = [readLayer(input_file) for input_file in input_files]
+    if not layers:
+        return 0
+
+    geoms = np.concatenate([np.asarray(gdf.geometry.values) for gdf in layers])
+    buffered = bufferGeometries(geoms, distance, segments, end_cap_style, join_style, miter_limit)
+
+    start = 0
+    for gdf, output_file in zip(layers, output_files):
+        writeLayer(withBuffers(gdf, buffered[start:start + len(gdf)], dissolve), output_file)
+        start += len(gdf)
+    return len(geoms)
+
+
+# Reads every layer file (GeoJSON, GeoParquet or FlatGeobuf) in a folder, keyed by file name without extension
+# With "contains", only files whose names contain it are read (e.g. " RT " for walkshed edges)
+def readFolder(folder, contains=None):
+    layers = {}
+    for name in os.listdir(folder):
+        file_name, file_ext = os.path.splitext(name)
+        if contains is not None and contains not in file_name:
+            continue
+        if file_ext in LAYER_EXTENSIONS:
+            layers[file_name] = readLayer(os.path.join(folder, name))
+        else:
+            print("Error: " + name + " is not a geojson, parquet or fgb file")
+    return layers
+
+
+# Reprojects, buffers and joins every walkshed and amenity, then writes the joined files and the xlsx table
+# Returns the time spent in each stage
+# With walkshed_tolerance, walksheds are polygonized (see polygonizeFrame) instead of buffered and dissolved
+def runPipeline(dir_walkshed_input, dir_amenity_input, dir_output, workbook, crs,
+                walkshed_buffer, amenity_buffer, dict_location, dict_profile, ext=".geojson", walkshed_tolerance=None):
+    timings = {}
+
+    with stage(timings, "read"):
+        # Cost and origin files written next to the edges by "CreateWalkshed.py" are not walksheds
+        walksheds = readFolder(dir_walkshed_input, " RT ")
+        amenities = readFolder(dir_amenity_input)
+
+    with stage(timings, "reproject"):
+        walksheds = {name: reprojectFrame(gdf, crs) for name, gdf in walksheds.items()}
+        amenities = {name: reprojectFrame(gdf, crs) for name, gdf in amenities.items()}
+
+    # Buffered layers get the "Buffer " names "CreateBuffers.py" would have given their files
+    with stage(timings, "buffer"):
+        if walkshed_tolerance:
+            polygon_settings = {key: value for key, value in walkshed_buffer.items() if key != 'dissolve'}
+            walksheds = {"Buffer " + name: polygonizeFrame(gdf, walkshed_tolerance, **polygon_settings)
+                         for name, gdf in walksheds.items()}
+        else:
+            walksheds = {"Buffer " + name: bufferFrame(gdf, **walkshed_buffer) for name, gdf in walksheds.items()}
+        amenities = {"Buffer " + name: bufferFrame(gdf, **amenity_buffer) for name, gdf in amenities.items()}
+
+    table = ReachabilityTable(workbook, dict_location, dict_profile)
+    for walkshed_name, buffered_walksheds in walksheds.items():
+        for amenity_name, gdf_amenities in amenities.items():
+            names = pairNames(walkshed_name, amenity_name, dict_location)
+            if names is None:
+                continue
+            output_name, location, profile, amenity = names
+
+            with stage(timings, "join"):
+                reachable_amenities, unreachable_amenities = splitReachable(gdf_amenities, buffered_walksheds)
+                countReachable(table, reachable_amenities, buffered_walksheds, location, profile, amenity)
+
+            with stage(timings, "write"):
+                writeJoined(reachable_amenities, unreachable_amenities, dir_output, output_name, ext)
+
+    with stage(timings, "xlsx"):
+        table.save()
+
+    return timings
+
+
+# Prints the time spent in each stage as a table
+def printTimings(timings):
+    total = sum(timings.values())
+    print("stage        seconds   share")
+    for name, seconds in timings.items():
+        print(name.ljust(12) + format(seconds, '8.2f') + format(100 * seconds / total if total else 0, '7.1f') + "%")
+    print("total".ljust(12) + format(total, '8.2f'))
+
+
+
+## Change file and folder locations below
+## Joined files are written to dir_output (in the format of output_ext) and counts to the workbook set in "SpatialJoin.py"
+# Walksheds and amenities before reprojection
+dir_walkshed_input = r"C:\QGIS Projects\Walkshed Sim\Walksheds"
+dir_amenity_input = r"C:\QGIS Projects\Walkshed Sim\Amenities"
+
+# Projection every layer is reprojected to - buffer distances are in its units
+target_crs = "EPSG:32610"
+
+## Change buffer settings to match "CreateBuffers.py"
+walkshed_buffer = dict(distance=10, segments=5, end_cap_style=0, join_style=0, miter_limit=2, dissolve=True)
+amenity_buffer = dict(distance=10, segments=5, end_cap_style=0, join_style=0, miter_limit=2, dissolve=False)
+
+## By default walksheds are buffered and dissolved exactly like "CreateBuffers.py"
+## Set walkshed_tolerance (in units of target_crs, e.g. 2) to polygonize them instead, as "PolygonizeWalksheds.py"
+## does - much faster, but reachable counts can differ slightly from the QGIS scripts
+walkshed_tolerance = None
+
+
+if __name__ == "__main__":
+    timings = runPipeline(dir_walkshed_input, dir_amenity_input, dir_output, workbook, target_crs,
+                          walkshed_buffer, amenity_buffer, dict_location, dict_profile, output_ext, walkshed_tolerance)
+    printTimings(timings)
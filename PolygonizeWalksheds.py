@@ -0,0 +1,81 @@
+import os
+
+from LayerIO import LAYER_EXTENSIONS, readLayer, writeLayer
+from Manifest import Manifest
+from Pipeline import polygonizeFrame, reprojectFrame, target_crs, walkshed_buffer
+from SpatialJoin import dir_walkshed, output_ext
+
+### Turns the reachable tree edges of each walkshed into one simplified walkshed polygon
+### (one per band for walksheds split into isochrone bands by "CreateWalkshed.py")
+### Replaces reprojecting and buffering walksheds (DISSOLVE True) in "ReprojectLayers.py" and "CreateBuffers.py" -
+### buffering and dissolving thousands of small edge segments was the slowest step, and the simplified polygons
+### keep buffering, dissolving and intersects tests in "SpatialJoin.py" cheap
+
+## This script does not need to be run in QGIS
+## Input files are the edge files written by "CreateWalkshed.py", e.g. "MaryPilgrim RT Cane.geojson"
+#  (files reprojected by "ReprojectLayers.py", e.g. "RP MaryPilgrim RT Cane.geojson", also work)
+## Output files are named the way "CreateBuffers.py" names them, e.g. "Buffer MaryPilgrim RT Cane.geojson",
+#  and are written straight into the walkshed folder of "SpatialJoin.py"
+
+
+# Polygonizes every walkshed edge file in a folder, skipping files that are unchanged since the last run
+# Returns {output name: (vertices before, vertices after)} for the files polygonized in this run
+def polygonizeFolder(dir_input, dir_output, crs, tolerance, buffer_settings, manifest=None, ext=".geojson"):
+    settings = {key: value for key, value in buffer_settings.items() if key != 'dissolve'}
+    params = dict(settings, tolerance=tolerance, crs=crs)
+    counts = {}
+
+    for name in os.listdir(dir_input):
+        file_name, file_ext = os.path.splitext(name)
+        # Cost and origin files written next to the edges are not walksheds
+        if file_ext not in LAYER_EXTENSIONS or " RT " not in file_name:
+            continue
+
+        if file_name.startswith("RP "):
+            file_name = file_name[3:]
+        input_file = os.path.join(dir_input, name)
+        output_name = "Buffer " + file_name
+        output_file = os.path.join(dir_output, output_name + ext)
+
+        if manifest is not None and manifest.current(output_file, [input_file], params):
+            continue
+
+        polygon = polygonizeFrame(reprojectFrame(readLayer(input_file), crs), tolerance, **settings)
+        writeLayer(polygon, output_file)
+
+        before = int(polygon['vertices_before'].sum())
+        after = int(polygon['vertices_after'].sum())
+        counts[output_name] = (before, after)
+        if manifest is not None:
+            manifest.record(output_file, [input_file], params, [output_file],
+                            result={'vertices_before': before, 'vertices_after': after})
+
+    return counts
+
+
+# Prints the vertex counts of each polygonized walkshed as a table
+def printVertexCounts(counts):
+    print("walkshed".ljust(40) + "vertices before   after")
+    for name, (before, after) in sorted(counts.items()):
+        print(name.ljust(40) + str(before).rjust(15) + str(after).rjust(8))
+    before = sum(before for before, after in counts.values())
+    after = sum(after for before, after in counts.values())
+    print("total".ljust(40) + str(before).rjust(15) + str(after).rjust(8))
+
+
+
+## Change the input folder to where "CreateWalkshed.py" writes walkshed files
+## Polygons are written to dir_walkshed of "SpatialJoin.py"; the buffer distance and projection are set in "Pipeline.py"
+dir_walkshed_edges = r"C:\QGIS Projects\Walkshed Sim\Walksheds"
+
+## Change walkshed_tolerance (in units of target_crs) to simplify walkshed polygons more or less
+walkshed_tolerance = 2
+
+
+if __name__ == "__main__":
+    manifest = Manifest(os.path.join(dir_walkshed, "Polygonize Manifest.json"))
+    counts = polygonizeFolder(dir_walkshed_edges, dir_walkshed, target_crs, walkshed_tolerance,
+                              walkshed_buffer, manifest, output_ext)
+    manifest.save()
+    printVertexCounts(counts)
+    print(manifest.summary())
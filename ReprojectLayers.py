@@ -1,89 +1,197 @@
-#native:reprojectlayer -> Reproject layer
-#processing.runAndLoadResults("native:reprojectlayer", {'INPUT': 'C:\QGIS Projects\Reproject test\Walksheds39024.json', 
-										 #'TARGET_CRS': 'ESPG:32610 - WGS 84 / UTM zone 10N', 
-										 #'CONVERT_CURVED_GEOMETRIES': 0,
-										 #'OUTPUT': 'C:\QGIS Projects\Reproject test\ReprojectTestWalkshed.json'})
-
-## This script does not reproject files to EPSG:32610
-## This script correctly reprojects files to EPSG:3031 (the only other projection tested)
-
-from qgis.PyQt.QtCore import QCoreApplication
-from qgis.core import (QgsProcessing,
-                       QgsProcessingException,
-                       QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSource,
-                       QgsProcessingParameterVectorDestination)
-from qgis import processing
-
-import os
-
-## Run script in QGIS
-## Input layer specified in popup is ignored, but a layer must be inserted to run the script
-class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
-
-    INPUT = 'INPUT'
-    OUTPUT = 'OUTPUT'
-
-    def tr(self, string):
-        return QCoreApplication.translate('Processing', string)
-
-    def createInstance(self):
-        return ExampleProcessingAlgorithm()
-
-    def name(self):
-        return 'ReprojectLayers'
-
-    def displayName(self):
-        return self.tr('Reproject Layers')
-
-    def group(self):
-        return self.tr('Personal Script')
-
-    def groupId(self):
-        return 'PersonalScript'
-
-    def shortHelpString(self):
-        return self.tr("Reprojects layer to ESPG:32610")
-
-    def initAlgorithm(self, config=None):
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.INPUT,
-                self.tr('Input layer'),
-                [QgsProcessing.TypeVectorAnyGeometry]
-            )
-        )
-
-        self.addParameter(
-            QgsProcessingParameterVectorDestination(
-                self.OUTPUT,
-                self.tr('Output layer')
-            )
-        )
-
-    def processAlgorithm(self, parameters, context, feedback):
-
-        ## Change the directories to input and output file folder locations
-        # Assign directory
-        dir_input = r"C:\QGIS Projects\Test"
-        dir_output = r"C:\QGIS Projects\Reproject test"
-
-        # Iterate over files in directory
-        for name in os.listdir(dir_input):
-            
-            # Determine file extension - must be geojson
-            file_name, file_ext = os.path.splitext(name)
-            if file_ext == ".geojson":
-
-                # Run reproject layer script
-                outputFile = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
-                reprojected_layer = processing.runAndLoadResults("native:reprojectlayer", {
-					'INPUT': dir_input + "\\" + name, 
-					'TARGET_CRS': 'EPSG:3031', # 'EPSG:32610', 'EPSG::32610', '32610' all did not work
-					'CONVERT_CURVED_GEOMETRIES': 0,
-					'OUTPUT': dir_output + "\\RP " + name})['OUTPUT']
-                
-
-
-        # Return the results of the algorithm
-        return {self.OUTPUT: reprojected_layer}
+#native:reprojectlayer -> Reproject layer
+#processing.runAndLoadResults("native:reprojectlayer", {'INPUT': 'C:\QGIS Projects\Reproject test\Walksheds39024.json', 
+										 #'TARGET_CRS': 'ESPG:32610 - WGS 84 / UTM zone 10N', 
+										 #'CONVERT_CURVED_GEOMETRIES': 0,
+										 #'OUTPUT': 'C:\QGIS Projects\Reproject test\ReprojectTestWalkshed.json'})
+
+## This script does not reproject files to EPSG:32610 when the CRS is passed to native:reprojectlayer as a string
+## This script correctly reprojects files to EPSG:3031 (the only other projection tested)
+## The target CRS is now picked in the popup and passed as a CRS object, and bulk mode reprojects with pyproj,
+#  which handles EPSG:32610 like any other EPSG code
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsProcessing,
+                       QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterCrs,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterVectorDestination)
+from qgis import processing
+
+import multiprocessing, os, sys
+
+# Helper modules live next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from Manifest import Manifest
+from Instruments import Recorder
+
+## Run script in QGIS
+## Input layer specified in popup is ignored, but a layer must be inserted to run the script
+class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
+
+    INPUT = 'INPUT'
+    OUTPUT = 'OUTPUT'
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return ExampleProcessingAlgorithm()
+
+    def name(self):
+        return 'ReprojectLayers'
+
+    def displayName(self):
+        return self.tr('Reproject Layers')
+
+    def group(self):
+        return self.tr('Personal Script')
+
+    def groupId(self):
+        return 'PersonalScript'
+
+    def shortHelpString(self):
+        return self.tr("Reprojects layers to the target CRS (EPSG:32610 by default)")
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT,
+                self.tr('Input layer'),
+                [QgsProcessing.TypeVectorAnyGeometry]
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterVectorDestination(
+                self.OUTPUT,
+                self.tr('Output layer')
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterCrs(
+                'TARGET_CRS',
+                self.tr('Target CRS'),
+                'EPSG:32610'
+            )
+        )
+
+        # Reproject every file with pyproj across worker processes and write the results without adding them
+        # to the map. Needs geopandas in the QGIS Python environment
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                'BULK',
+                self.tr('Bulk reproject all files without loading them (needs geopandas)'),
+                defaultValue=False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                'PROCESSES',
+                self.tr('Worker processes for bulk reprojection'),
+                QgsProcessingParameterNumber.Integer,
+                os.cpu_count(),
+                minValue=1
+            )
+        )
+
+        # Profile the run with cProfile - the stats are written next to the timing report in the output folder
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                'PROFILE',
+                self.tr('Profile the run with cProfile'),
+                defaultValue=False
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        recorder = Recorder("ReprojectLayers", self.parameterAsBoolean(parameters, 'PROFILE', context))
+        try:
+            return self.reprojectFolder(parameters, context, feedback, recorder)
+        finally:
+            recorder.stop()
+
+    def reprojectFolder(self, parameters, context, feedback, recorder):
+
+        ## Change the directories to input and output file folder locations
+        # Assign directory
+        dir_input = r"C:\QGIS Projects\Test"
+        dir_output = r"C:\QGIS Projects\Reproject test"
+
+        ## Change output_ext to write layers as GeoParquet (".parquet") or FlatGeobuf (".fgb") instead of GeoJSON
+        # GeoParquet needs a QGIS build with GDAL 3.5 or later
+        output_ext = ".geojson"
+        layer_exts = (".geojson", ".parquet", ".fgb")
+
+        # Files that were reprojected with the same inputs and CRS before are not reprojected again
+        manifest = Manifest(dir_output + "\\Reproject Manifest.json")
+        reprojected_layer = None
+
+        target_crs = self.parameterAsCrs(parameters, 'TARGET_CRS', context)
+
+        # In bulk mode files are collected here and reprojected together after the loop
+        bulk = self.parameterAsBoolean(parameters, 'BULK', context)
+        bulk_inputs = []
+        bulk_outputs = []
+
+        # Iterate over files in directory
+        for name in os.listdir(dir_input):
+            
+            # Determine file extension - must be geojson, parquet or fgb
+            file_name, file_ext = os.path.splitext(name)
+            if file_ext in layer_exts:
+
+                # Reproject parameters (INPUT and OUTPUT are added per file)
+                reproject_params = {
+					'TARGET_CRS': target_crs.authid(), # 'EPSG:32610', 'EPSG::32610', '32610' all did not work as strings
+					'CONVERT_CURVED_GEOMETRIES': 0}
+                input_file = dir_input + "\\" + name
+                output_file = dir_output + "\\RP " + file_name + output_ext
+
+                # Skip files whose input and target CRS are unchanged since the last run
+                if manifest.current(output_file, [input_file], reproject_params):
+                    feedback.pushInfo("Unchanged, skipping: " + name)
+                    continue
+
+                if bulk:
+                    bulk_inputs.append(input_file)
+                    bulk_outputs.append(output_file)
+                    continue
+
+                # Run reproject layer script
+                outputFile = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+                with recorder.stage("native:reprojectlayer", read=input_file, written=output_file):
+                    reprojected_layer = processing.runAndLoadResults("native:reprojectlayer", dict(reproject_params,
+						TARGET_CRS=target_crs,
+						INPUT=input_file,
+						OUTPUT=output_file))['OUTPUT']
+                manifest.record(output_file, [input_file], reproject_params, [output_file])
+                
+
+        if bulk_inputs:
+            from Pipeline import reprojectFiles
+
+            # Worker processes must start the Python interpreter, not another copy of QGIS
+            if sys.platform == 'win32':
+                multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+
+            with recorder.stage("bulk reproject", read=bulk_inputs, written=bulk_outputs):
+                count = reprojectFiles(bulk_inputs, bulk_outputs, target_crs.toWkt(),
+                                       self.parameterAsInt(parameters, 'PROCESSES', context))
+            recorder.count("features", count)
+            feedback.pushInfo("Reprojected " + str(count) + " features from " + str(len(bulk_inputs)) + " files")
+            for input_file, output_file in zip(bulk_inputs, bulk_outputs):
+                manifest.record(output_file, [input_file], reproject_params, [output_file])
+            reprojected_layer = bulk_outputs[-1]
+
+        manifest.save()
+        feedback.pushInfo(manifest.summary())
+        feedback.pushInfo(recorder.summary())
+        recorder.save(dir_output + "\\ReprojectLayers Report.json")
+
+        # Return the results of the algorithm
+        return {self.OUTPUT: reprojected_layer}
@@ -1,165 +1,671 @@
-import geopandas as gpd
-import json
-import os
-
-### The "produceJoin" method is derived from the "spatial_join_geojson" script
-### https://github.com/wendybw/optimizing-Seattle-PDIS/blob/main/spatial_join_geojson.py
-### This script is edited to allow for automation
-
-## This script does not need to be run in QGIS
-# Replicates the "Join attributes by location" tool in QGIS
-def produceJoin(dir_walkshed, walkshed_name, dir_amenity, amenity_name, dir_output, output_name):
-    # Load your buffered walkshed GeoJSON file
-    buffered_walksheds = gpd.read_file(dir_walkshed + "\\" + walkshed_name)
-
-    # Load your amenities GeoJSON file
-    gdf_amenities = gpd.read_file(dir_amenity + "\\" + amenity_name)
-
-    # Ensure the CRS for amenities matches that of the buffered walksheds, reproject if necessary
-    if gdf_amenities.crs != buffered_walksheds.crs:
-        gdf_amenities = gdf_amenities.to_crs(buffered_walksheds.crs)
-
-    # Perform spatial joins for reachable and unreachable amenities
-    reachable_amenities = gpd.sjoin(gdf_amenities, buffered_walksheds, how="inner", predicate='intersects')
-    unreachable_amenities = gpd.sjoin(gdf_amenities, buffered_walksheds, how="left", predicate='intersects')
-    unreachable_amenities = unreachable_amenities[unreachable_amenities.index_right.isnull()]
-
-    # Cleanup before exporting
-    reachable_amenities.drop(columns=['index_right'], inplace=True)
-    unreachable_amenities.drop(columns=['index_right'], inplace=True)
-
-    # Export results to GeoJSON
-    if not unreachable_amenities.empty:
-        unreachable_file_name = dir_output + "\\Unreachable " + output_name + ".geojson"
-        unreachable_amenities.to_file(unreachable_file_name, driver='GeoJSON')
-    else:
-        print("No unreachable amenities found.")
-
-    if not reachable_amenities.empty:
-        reachable_file_name = dir_output + "\Reachable " + output_name + ".geojson"
-        reachable_amenities.to_file(reachable_file_name, driver='GeoJSON')
-        print("Reachable and unreachable amenities exported successfully.")
-        # Return reachable file name if reachable amenities
-        return reachable_file_name
-        
-    else:
-        print("No reachable amenities found.")
-        print("Reachable and unreachable amenities exported successfully.")
-        # Return unreachable file name if reachable amenities do not exist
-        return unreachable_file_name
-
-   
-   
-# Outputs number of joined features (number of amenities a walkshed intersects) into xlsx file
-def insertXLSX(workbook, file_path, location, profile, amenity, dict_location, dict_profile):
-    import openpyxl
-
-    # Load xlsx file
-    wb = openpyxl.load_workbook(workbook)
-    ws = wb.active
-
-    # Determine row in xlsx to insert data based on housing location and mobility profile of walkshed
-    loc_index = list(dict_location.keys()).index(location)
-    prof_index = dict_profile[profile]
-    row = (loc_index * 6) + 1 + prof_index
-
-    # Insert housing location and mobility profile in xlsx sheet
-    new_data = [location, profile]
-    for col, value in enumerate(new_data, start=1):
-        ws.cell(column=col, row=row, value=value)
-        #print("column: " + str(col) + "  row: " + str(row) + "  value: " + str(value))
-
-
-    # Read geojson file in 'utf-8' encoding
-    with open(file_path, 'r', encoding='utf-8') as json_data:
-        data = json.load(json_data)
-    # Determine how many amenities (features) are intersected by the walkshed
-    val = len(data['features'])
-
-    # Number of amenities intersected by walkshed is 0 if the parameterized joined file is the unreachable amenities
-    # Check if reachable amenities do not exist
-    file_name = os.path.basename(file_path)
-    file_name_tokens = file_name.split(" ")
-    if file_name_tokens[0] == "Unreachable": # First word in basename of parameterized file should be "Reachable" or "Unreachable"
-        val = 0
-
-    # Insert number of reachable amenities into xlsx file
-    for index, column in enumerate(ws.iter_cols(min_col=3, max_col=7), start=3):
-        if column[0].value == amenity:
-            ws.cell(column=index, row=row, value=val)
-            print("column: " + str(index) + "  row: " + str(row) + "  value: " + str(val))
-            
-
-    wb.save(workbook)
-
-
-
-## Change file and folder locations below
-## All input file names should begin with "Buffer " - naming convention directly follows from "CreateBuffers" script
-# File location of xlsx sheet to store number of amenities that intersect walkshed
-workbook = r"C:\QGIS Projects\Walkshed Sim\Amenity Reachability Comparison Table.xlsx"
-
-# Assume folders only have walksheds and only have amenities
-dir_walkshed = r"C:\QGIS Projects\Walkshed Sim\Buffered Walksheds"
-dir_amenity = r"C:\QGIS Projects\Walkshed Sim\Buffered Amenities"
-
-dir_output = r"C:\QGIS Projects\Walkshed Sim\Final Joined Files"
-
-## Change dictionaries to match user preferences
-# Housing region/location of each walkshed : location of each amenity
-dict_location = { 
-    "Argyle": "South",
-    "BerthaPitts": "South",
-    "Burbridge": "Burbridge",
-    "E.Republican": "South",
-    "MaryPilgrim": "North",
-    "NorthStar": "North",
-    "SacredMed": "North",
-    "SalmonberryL": "South"
-}
-
-# Assign order of mobility profiles to be inserted into the xlsx file
-dict_profile = {
-    "Control": 1,
-    "Walking": 2,
-    "Cane": 3,
-    "Powered": 4,
-    "Manual": 5
-}
-
-
-# Loop through every walkshed in walkshed directory
-for walkshed in os.listdir(dir_walkshed):
-    walkshed_name, walkshed_ext = os.path.splitext(walkshed)
-
-    # Check if walkshed file is a geojson
-    if walkshed_ext == ".geojson":
-        walkshed_name_tokens = walkshed_name.split(" ")
-        # Determine housing location of walkshed
-        location_w = walkshed_name_tokens[1]
-
-        # Loop through every amenity in amenity directory corresponding to walkshed
-        for amenity in os.listdir(dir_amenity):
-            amenity_name, amenity_ext = os.path.splitext(amenity)
-
-            # Check if amenity file is a geojson
-            if amenity_ext == ".geojson":
-                amenity_name_tokens = amenity_name.split(" ")
-
-                # Check if amenity location corresponds to walkshed location
-                location_a = amenity_name_tokens[2]
-                if location_a == dict_location[location_w]:
-                    # Create base name for joined file
-                    output_name = " ".join(walkshed_name_tokens[1:]) + " " + " ".join(amenity_name_tokens[3:])
-
-                    # Produce joined walkshed and amenity file, stored in variable "file_name"
-                    file_name = produceJoin(dir_walkshed, walkshed, dir_amenity, amenity, dir_output, output_name)
-
-                    # Insert number of reachable amenities into xlsx file
-                    insertXLSX(workbook, file_name, location_w, walkshed_name_tokens[3], " ".join(amenity_name_tokens[3:]),
-                            dict_location, dict_profile)
-                    
-            else:
-                print("Error: " + amenity + " is not a geojson file")
-    else:
-        print("Error: " + walkshed + " is not a geojson file")
\ No newline at end of file
+import numpy as np
+import pandas as pd
+import shapely
+import json
+import multiprocessing
+import os
+import sys
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from Instruments import Recorder, fileBytes
+from LayerIO import LAYER_EXTENSIONS, LayerWriter, layerCRS, readLayer, readLayerBatches, writeLayer
+from Manifest import Manifest
+
+### The "produceJoin" method is derived from the "spatial_join_geojson" script
+### https://github.com/wendybw/optimizing-Seattle-PDIS/blob/main/spatial_join_geojson.py
+### This script is edited to allow for automation
+
+## This script does not need to be run in QGIS
+# Replicates the "Join attributes by location" tool in QGIS
+# If a ReachabilityTable is given, the number of reachable amenities is added to it under location/profile/amenity
+def produceJoin(dir_walkshed, walkshed_name, dir_amenity, amenity_name, dir_output, output_name,
+                table=None, location=None, profile=None, amenity=None):
+    # Load your buffered walkshed GeoJSON file
+    buffered_walksheds = layer_cache.read(os.path.join(dir_walkshed, walkshed_name))
+
+    # Load your amenities GeoJSON file, reprojected to the CRS of the buffered walksheds if necessary
+    # Files are only read and reprojected the first time a walkshed needs them
+    # With bbox_reads, only amenities within the bounding box of the walksheds are loaded
+    bbox = tuple(buffered_walksheds.total_bounds) if bbox_reads else None
+    if join_batch_size:
+        return joinBatches(buffered_walksheds, os.path.join(dir_amenity, amenity_name), bbox, dir_output, output_name,
+                           table, location, profile, amenity)
+    gdf_amenities = layer_cache.read(os.path.join(dir_amenity, amenity_name), buffered_walksheds.crs, bbox)
+
+    # Perform one spatial join for both reachable and unreachable amenities
+    with instruments.stage("sjoin"):
+        reachable_amenities, unreachable_amenities = splitReachable(gdf_amenities, buffered_walksheds)
+
+    # Record the number of amenities intersected by the walkshed without rereading the output
+    if table is not None:
+        countReachable(table, reachable_amenities, buffered_walksheds, location, profile, amenity)
+
+    return writeJoined(reachable_amenities, unreachable_amenities, dir_output, output_name, output_ext)
+
+
+
+# Exports reachable and unreachable amenities to GeoJSON, or the format of another extension from LayerIO.py
+# Returns the reachable file name, or the unreachable file name if no amenities are reachable
+def writeJoined(reachable_amenities, unreachable_amenities, dir_output, output_name, ext=".geojson"):
+    # Export results to GeoJSON
+    if not unreachable_amenities.empty:
+        unreachable_file_name = os.path.join(dir_output, "Unreachable " + output_name + ext)
+        with instruments.stage("write layer", written=unreachable_file_name):
+            writeLayer(unreachable_amenities, unreachable_file_name)
+    else:
+        print("No unreachable amenities found.")
+
+    if not reachable_amenities.empty:
+        reachable_file_name = os.path.join(dir_output, "Reachable " + output_name + ext)
+        with instruments.stage("write layer", written=reachable_file_name):
+            writeLayer(reachable_amenities, reachable_file_name)
+        print("Reachable and unreachable amenities exported successfully.")
+        # Return reachable file name if reachable amenities
+        return reachable_file_name
+        
+    else:
+        print("No reachable amenities found.")
+        print("Reachable and unreachable amenities exported successfully.")
+        # Return unreachable file name if reachable amenities do not exist
+        return unreachable_file_name
+
+
+
+# Joins amenities join_batch_size features at a time, writing each batch's reachable and unreachable amenities
+# as it goes, so only one batch of amenities and its join results are in memory at once
+# Gives the same files and counts as produceJoin without batches (amenity layers are not kept in layer_cache)
+def joinBatches(buffered_walksheds, amenity_path, bbox, dir_output, output_name,
+                table=None, location=None, profile=None, amenity=None):
+    # The walkshed index is built once and queried by every batch
+    tree = shapely.STRtree(buffered_walksheds.geometry.values)
+    reachable_file_name = os.path.join(dir_output, "Reachable " + output_name + output_ext)
+    unreachable_file_name = os.path.join(dir_output, "Unreachable " + output_name + output_ext)
+    reachable_writer = LayerWriter(reachable_file_name)
+    unreachable_writer = LayerWriter(unreachable_file_name)
+
+    # Running counts of reachable amenities, summed over batches
+    totals = Counter()
+    batches = readLayerBatches(amenity_path, join_batch_size, bbox, buffered_walksheds.crs)
+    while True:
+        with instruments.stage("read batch"):
+            gdf_amenities = next(batches, None)
+        if gdf_amenities is None:
+            break
+        instruments.count("amenities", len(gdf_amenities))
+        if gdf_amenities.crs != buffered_walksheds.crs:
+            with instruments.stage("to_crs"):
+                gdf_amenities = gdf_amenities.to_crs(buffered_walksheds.crs)
+
+        with instruments.stage("sjoin"):
+            reachable_amenities, unreachable_amenities = splitReachable(gdf_amenities, buffered_walksheds, tree)
+
+        if table is not None:
+            batch_table = ReachabilityTable(None, None, None)
+            countReachable(batch_table, reachable_amenities, buffered_walksheds, location, profile, amenity)
+            totals.update(batch_table.counts)
+
+        with instruments.stage("write batch"):
+            reachable_writer.write(reachable_amenities)
+            unreachable_writer.write(unreachable_amenities)
+
+    # The amenity file is read once across all of its batches
+    instruments.add("read batch", calls=0, read=fileBytes(amenity_path))
+
+    # Keys come from counting an empty join, so pairs without any reachable amenities still get counts of 0
+    if table is not None:
+        batch_table = ReachabilityTable(None, None, None)
+        countReachable(batch_table, buffered_walksheds.iloc[:0], buffered_walksheds, location, profile, amenity)
+        table.merge({key: totals[key] for key in batch_table.counts})
+
+    with instruments.stage("write layer", written=unreachable_file_name):
+        if not unreachable_writer.close():
+            print("No unreachable amenities found.")
+    with instruments.stage("write layer", written=reachable_file_name):
+        reachable = reachable_writer.close()
+    if not reachable:
+        print("No reachable amenities found.")
+    print("Reachable and unreachable amenities exported successfully.")
+    return reachable_file_name if reachable else unreachable_file_name
+
+   
+   
+# Splits amenities into the ones that intersect a walkshed and the ones that do not
+# Gives the same frames as an "inner" gpd.sjoin and a "left" gpd.sjoin filtered on index_right.isnull()
+# (with index_right dropped), but builds the spatial index and tests intersects only once
+# An STRtree of the walksheds can be given to reuse it between calls
+def splitReachable(gdf_amenities, buffered_walksheds, tree=None):
+    # Bulk query every amenity against an STRtree of the walksheds
+    if tree is None:
+        tree = shapely.STRtree(buffered_walksheds.geometry.values)
+    amenity_idx, walkshed_idx = tree.query(gdf_amenities.geometry.values, predicate='intersects')
+    order = np.lexsort((walkshed_idx, amenity_idx))
+    amenity_idx = amenity_idx[order]
+    walkshed_idx = walkshed_idx[order]
+
+    # Walkshed attributes get the same "_left"/"_right" suffixes gpd.sjoin uses for shared column names
+    walkshed_columns = buffered_walksheds.drop(columns=buffered_walksheds.geometry.name)
+    shared = set(walkshed_columns.columns) & set(gdf_amenities.columns)
+    amenities = gdf_amenities.rename(columns={col: str(col) + "_left" for col in shared})
+    walkshed_columns = walkshed_columns.rename(columns={col: str(col) + "_right" for col in shared})
+
+    # Reachable amenities - one row per amenity and walkshed it intersects
+    reachable_amenities = amenities.iloc[amenity_idx]
+    matched = walkshed_columns.iloc[walkshed_idx].set_axis(reachable_amenities.index)
+    reachable_amenities = pd.concat([reachable_amenities, matched], axis=1)
+
+    # Unreachable amenities - every amenity without a match, with empty walkshed attributes
+    mask = np.ones(len(amenities), dtype=bool)
+    mask[amenity_idx] = False
+    unreachable_amenities = amenities[mask]
+    empty = walkshed_columns.iloc[:0].reindex(unreachable_amenities.index)
+    unreachable_amenities = pd.concat([unreachable_amenities, empty], axis=1)
+
+    return reachable_amenities, unreachable_amenities
+
+
+
+# Adds the number of reachable amenities of a pair to a table
+# Walksheds split into isochrone bands (one feature per band, see Pipeline.dissolveBands) are joined once, and
+# each band's count is added under that band. The count of the largest band is also added as the pair's count
+# (reachable amenities then have one row per band they are in - count them by their "band" column)
+def countReachable(table, reachable_amenities, buffered_walksheds, location, profile, amenity):
+    if 'band' not in buffered_walksheds.columns:
+        table.add(location, profile, amenity, len(reachable_amenities))
+        return
+
+    # Amenities with a "band" column of their own get the walkshed's as "band_right", as gpd.sjoin names it
+    column = 'band_right' if 'band_right' in reachable_amenities.columns else 'band'
+    counts = reachable_amenities[column].value_counts()
+    bands = sorted(buffered_walksheds['band'].unique())
+    for band in bands:
+        table.add(location, profile, amenity, int(counts.get(band, 0)), float(band))
+    table.add(location, profile, amenity, int(counts.get(bands[-1], 0)))
+
+
+
+# Keeps recently read layers in memory so each file is read and reprojected once per run
+# Layers are keyed on path, modification time and target CRS, and the least recently used
+# layers are dropped once the cached layers take more than max_bytes
+# Cached frames are shared - callers must not modify them in place
+# The cache can be shared between threads (e.g. the workers of "JobRunner.py")
+class LayerCache:
+
+    def __init__(self, max_bytes=2 * 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.layers = OrderedDict()
+        self.lock = threading.Lock()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Reads a layer, reprojected to crs if given and different from the file's own CRS
+    # bbox (in crs) only loads the features intersecting that box
+    def read(self, path, crs=None, bbox=None):
+        key = (os.path.abspath(path), os.path.getmtime(path), None if crs is None else crs.to_string(), bbox)
+        with self.lock:
+            if key in self.layers:
+                self.layers.move_to_end(key)
+                self.hits += 1
+                return self.layers[key][0]
+            self.misses += 1
+
+        # Read outside the lock so other threads can use the cache meanwhile
+        with instruments.stage("read layer", read=path):
+            gdf = readLayer(path, bbox, crs)
+        if crs is not None and gdf.crs != crs:
+            with instruments.stage("to_crs"):
+                gdf = gdf.to_crs(crs)
+
+        size = layerSize(gdf)
+        with self.lock:
+            if key not in self.layers:
+                self.total += size
+            self.layers[key] = (gdf, size)
+            while self.total > self.max_bytes and len(self.layers) > 1:
+                old_gdf, old_size = self.layers.popitem(last=False)[1]
+                self.total -= old_size
+        return gdf
+
+    def summary(self):
+        return ("Layer cache: " + str(self.hits) + " hits, " + str(self.misses) + " reads, "
+                + str(len(self.layers)) + " layers kept (" + format(self.total / 1e6, '.1f') + " MB)")
+
+
+# Approximate memory used by a GeoDataFrame, counting 16 bytes per coordinate for the geometries
+def layerSize(gdf):
+    coordinates = shapely.get_num_coordinates(gdf.geometry.values).sum()
+    return int(gdf.memory_usage(deep=True).sum() + coordinates * 16)
+
+
+
+# Collects the number of amenities each walkshed intersects and writes them into the xlsx file in one save
+# Rows are ordered by housing location (dict_location) then mobility profile (dict_profile),
+# and each amenity goes in the column (3 to 7) whose header in the first row matches its name
+# Counts of isochrone bands go in the same rows and columns of a sheet per band (e.g. "Band 600"),
+# added with the header of the first sheet if the workbook does not have it yet
+class ReachabilityTable:
+
+    def __init__(self, workbook, dict_location, dict_profile):
+        self.workbook = workbook
+        self.dict_location = dict_location
+        self.dict_profile = dict_profile
+        self.counts = {}
+
+    def add(self, location, profile, amenity, count, band=None):
+        if band is None:
+            self.counts[(location, profile, amenity)] = count
+        else:
+            self.counts[(location, profile, amenity, band)] = count
+
+    # Adds counts collected by another table (e.g. one filled in a worker process)
+    def merge(self, counts):
+        self.counts.update(counts)
+
+    def save(self):
+        import openpyxl
+
+        # Load xlsx file
+        with instruments.stage("xlsx load", read=self.workbook):
+            wb = openpyxl.load_workbook(self.workbook)
+        ws = wb.active
+
+        # Amenity name in the header of each data column
+        amenity_columns = {}
+        for index, column in enumerate(ws.iter_cols(min_col=3, max_col=7), start=3):
+            amenity_columns.setdefault(column[0].value, []).append(index)
+
+        sheets = {None: ws}
+        locations = list(self.dict_location.keys())
+        for key, val in self.counts.items():
+            location, profile, amenity = key[:3]
+            band = key[3] if len(key) > 3 else None
+            if band not in sheets:
+                sheets[band] = bandSheet(wb, ws, band)
+            sheet = sheets[band]
+
+            # Determine row in xlsx to insert data based on housing location and mobility profile of walkshed
+            loc_index = locations.index(location)
+            prof_index = self.dict_profile[profile]
+            row = (loc_index * 6) + 1 + prof_index
+
+            # Insert housing location and mobility profile in xlsx sheet
+            new_data = [location, profile]
+            for col, value in enumerate(new_data, start=1):
+                sheet.cell(column=col, row=row, value=value)
+
+            # Insert number of reachable amenities into xlsx file
+            for index in amenity_columns.get(amenity, []):
+                sheet.cell(column=index, row=row, value=val)
+                print("column: " + str(index) + "  row: " + str(row) + "  value: " + str(val))
+
+        with instruments.stage("xlsx save", written=self.workbook):
+            wb.save(self.workbook)
+
+
+
+# Sheet holding the counts of one isochrone band, created with the header row of the first sheet if missing
+def bandSheet(wb, ws, band):
+    name = "Band " + format(band, 'g')
+    if name in wb.sheetnames:
+        return wb[name]
+    sheet = wb.create_sheet(name)
+    for cell in ws[1]:
+        sheet.cell(column=cell.column, row=1, value=cell.value)
+    return sheet
+
+
+# Outputs number of joined features (number of amenities a walkshed intersects) into xlsx file
+# Saves the workbook once per call - use a ReachabilityTable with produceJoin to write many results at once
+def insertXLSX(workbook, file_path, location, profile, amenity, dict_location, dict_profile):
+    # Read geojson file in 'utf-8' encoding
+    with instruments.stage("json", read=file_path), open(file_path, 'r', encoding='utf-8') as json_data:
+        data = json.load(json_data)
+    # Determine how many amenities (features) are intersected by the walkshed
+    val = len(data['features'])
+
+    # Number of amenities intersected by walkshed is 0 if the parameterized joined file is the unreachable amenities
+    # Check if reachable amenities do not exist
+    file_name = os.path.basename(file_path)
+    file_name_tokens = file_name.split(" ")
+    if file_name_tokens[0] == "Unreachable": # First word in basename of parameterized file should be "Reachable" or "Unreachable"
+        val = 0
+
+    table = ReachabilityTable(workbook, dict_location, dict_profile)
+    table.add(location, profile, amenity, val)
+    table.save()
+
+
+
+# Lists every walkshed/amenity pair to join, matching walksheds to amenities in the same region
+# Each pair is a tuple of produceJoin arguments followed by the location, profile and amenity for the xlsx file
+def findPairs(dir_walkshed, dir_amenity, dir_output, dict_location):
+    pairs = []
+
+    # Loop through every walkshed in walkshed directory
+    for walkshed in os.listdir(dir_walkshed):
+        walkshed_name, walkshed_ext = os.path.splitext(walkshed)
+
+        # The manifest written next to polygonized walksheds is not a layer
+        if walkshed_ext == ".json":
+            continue
+
+        # Check if walkshed file is a geojson (or another layer format from LayerIO.py)
+        if walkshed_ext in LAYER_EXTENSIONS:
+            # Loop through every amenity in amenity directory corresponding to walkshed
+            for amenity in os.listdir(dir_amenity):
+                amenity_name, amenity_ext = os.path.splitext(amenity)
+
+                # Manifests and reports written next to the buffered amenities are not layers
+                if amenity_ext == ".json":
+                    continue
+
+                # Check if amenity file is a geojson (or another layer format from LayerIO.py)
+                if amenity_ext in LAYER_EXTENSIONS:
+                    names = pairNames(walkshed_name, amenity_name, dict_location)
+                    if names is not None:
+                        pairs.append((dir_walkshed, walkshed, dir_amenity, amenity, dir_output) + names)
+                    
+                else:
+                    print("Error: " + amenity + " is not a geojson, parquet or fgb file")
+        else:
+            print("Error: " + walkshed + " is not a geojson, parquet or fgb file")
+
+    return pairs
+
+
+# Matches a buffered walkshed to a buffered amenity by name (without file extensions)
+# e.g. "Buffer MaryPilgrim RT Cane" and "Buffer Joined North Library"
+# Returns (output name, location, profile, amenity) if the amenity is in the walkshed's region, otherwise None
+def pairNames(walkshed_name, amenity_name, dict_location):
+    walkshed_name_tokens = walkshed_name.split(" ")
+    # Determine housing location of walkshed
+    location_w = walkshed_name_tokens[1]
+
+    amenity_name_tokens = amenity_name.split(" ")
+
+    # Check if amenity location corresponds to walkshed location
+    location_a = amenity_name_tokens[2]
+    if location_a != dict_location[location_w]:
+        return None
+
+    # Create base name for joined file
+    output_name = " ".join(walkshed_name_tokens[1:]) + " " + " ".join(amenity_name_tokens[3:])
+    return output_name, location_w, walkshed_name_tokens[3], " ".join(amenity_name_tokens[3:])
+
+
+# Produces the joined files for one pair from findPairs
+# Returns the joined file name and the reachable amenity count, keyed the same way as ReachabilityTable
+def joinPair(pair):
+    results = ReachabilityTable(None, None, None)
+    file_name = produceJoin(*pair[:6], results, *pair[6:])
+    return file_name, results.counts
+
+
+# Joins one pair in a worker process, also returning the stages it recorded
+def joinPairInWorker(pair):
+    return joinPair(pair) + (instruments.drain(),)
+
+
+# Sets the layer cache size of a worker process, and the settings of the main process
+# (spawned workers import this file afresh, so settings changed by callers would otherwise be lost)
+# Workers record stages for the main process to merge, but are never profiled themselves
+def initWorker(max_bytes, settings):
+    global instruments, output_ext, join_batch_size, bbox_reads
+    layer_cache.max_bytes = max_bytes
+    output_ext, join_batch_size, bbox_reads = settings
+    instruments = Recorder("SpatialJoin worker")
+
+
+# Settings that change what a join writes, passed on to worker processes
+def workerSettings():
+    return output_ext, join_batch_size, bbox_reads
+
+
+# Joins every pair and adds the reachable amenity counts to the table
+# With more than one process, pairs are spread across a process pool. Only file names go to the workers
+# and only counts come back - each worker reads (and caches) the layers it needs itself, so large
+# amenity frames are never pickled. Pairs are sorted by amenity so workers tend to reuse cached layers
+def runJoins(pairs, table, processes=1, manifest=None):
+    # With a manifest, pairs whose inputs are unchanged reuse their recorded counts
+    if manifest is not None:
+        pairs = skipCurrent(pairs, table, manifest)
+    pairs = sorted(pairs, key=lambda pair: (pair[3], pair[1]))
+
+    def finish(pair, counts):
+        table.merge(counts)
+        if manifest is not None:
+            manifest.record(pair[5], pairInputs(pair), pairParams(pair), joinedFiles(pair), pairResult(pair, counts))
+
+    if processes <= 1:
+        for pair in pairs:
+            file_name, counts = joinPair(pair)
+            finish(pair, counts)
+        return
+
+    # Worker processes must start the Python interpreter, not another copy of QGIS (e.g. from its Python console)
+    if sys.platform == 'win32' and not os.path.basename(sys.executable).lower().startswith('python'):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+
+    max_bytes = layer_cache.max_bytes // processes
+    with ProcessPoolExecutor(max_workers=processes, initializer=initWorker,
+                             initargs=(max_bytes, workerSettings())) as executor:
+        for pair, (file_name, counts, report) in zip(pairs, executor.map(joinPairInWorker, pairs)):
+            instruments.merge(report)
+            finish(pair, counts)
+
+
+# Input files of a pair from findPairs
+def pairInputs(pair):
+    return [os.path.join(pair[0], pair[1]), os.path.join(pair[2], pair[3])]
+
+
+# Parameters that decide the result of a pair
+def pairParams(pair):
+    return {'predicate': 'intersects', 'location': pair[6], 'profile': pair[7], 'amenity': pair[8],
+            'format': output_ext, 'bbox_reads': bbox_reads}
+
+
+# Joined files produceJoin has written for a pair
+def joinedFiles(pair):
+    files = [os.path.join(pair[4], prefix + pair[5] + output_ext) for prefix in ("Reachable ", "Unreachable ")]
+    return [file for file in files if os.path.exists(file)]
+
+
+# Counts of a pair as recorded in the manifest - the count, or the count and the count of each isochrone band
+def pairResult(pair, counts):
+    count = counts[tuple(pair[6:9])]
+    bands = {format(key[3], 'g'): value for key, value in counts.items() if len(key) > 3 and key[:3] == tuple(pair[6:9])}
+    if not bands:
+        return count
+    return {'count': count, 'bands': bands}
+
+
+# Adds counts recorded by pairResult to a table
+def addResult(table, pair, result):
+    if isinstance(result, dict):
+        for band, count in result['bands'].items():
+            table.add(pair[6], pair[7], pair[8], count, float(band))
+        result = result['count']
+    table.add(pair[6], pair[7], pair[8], result)
+
+
+# Adds the recorded counts of unchanged pairs to the table and returns the pairs that must be joined again
+# outputs_required is False when only counts are needed (matrix mode)
+def skipCurrent(pairs, table, manifest, outputs_required=True):
+    stale = []
+    for pair in pairs:
+        entry = manifest.current(pair[5], pairInputs(pair), pairParams(pair), outputs_required)
+        if entry is None:
+            stale.append(pair)
+        else:
+            addResult(table, pair, entry['result'])
+    return stale
+
+
+
+# Counts reachable amenities for every pair at once instead of joining pair by pair
+# All walksheds (tagged by file) and all amenities (tagged by file) are concatenated, reprojected to the CRS
+# of the first walkshed, and joined with one STRtree query. Matches between files that are not a pair
+# (amenities outside the walkshed's region) are dropped. Counts are the same as produceJoin gives (per band for
+# walksheds split into isochrone bands), but no joined GeoJSON files are written
+def reachabilityMatrix(pairs, table, manifest=None):
+    # With a manifest, pairs whose inputs are unchanged reuse their recorded counts
+    if manifest is not None:
+        pairs = skipCurrent(pairs, table, manifest, outputs_required=False)
+    if not pairs:
+        return
+    walksheds = sorted({(pair[0], pair[1]) for pair in pairs})
+    amenities = sorted({(pair[2], pair[3]) for pair in pairs})
+
+    # Load every walkshed and amenity once, all in the CRS of the first walkshed (read from its header)
+    crs = layerCRS(os.path.join(*walksheds[0]))
+    walkshed_frames = [layer_cache.read(os.path.join(*walkshed), crs) for walkshed in walksheds]
+    amenity_frames = [layer_cache.read(os.path.join(*amenity), crs) for amenity in amenities]
+
+    walkshed_geoms = np.concatenate([np.asarray(frame.geometry.values) for frame in walkshed_frames])
+    walkshed_file = np.repeat(np.arange(len(walksheds)), [len(frame) for frame in walkshed_frames])
+    # Band of each walkshed feature (NaN for walksheds without bands) and the bands of each walkshed file
+    walkshed_band = np.concatenate([frame['band'].to_numpy(dtype=float) if 'band' in frame.columns
+                                    else np.full(len(frame), np.nan) for frame in walkshed_frames])
+    file_bands = [sorted(float(band) for band in frame['band'].unique()) if 'band' in frame.columns else []
+                  for frame in walkshed_frames]
+    amenity_geoms = np.concatenate([np.asarray(frame.geometry.values) for frame in amenity_frames])
+    amenity_file = np.repeat(np.arange(len(amenities)), [len(frame) for frame in amenity_frames])
+
+    # One indexed join of every amenity against every walkshed
+    with instruments.stage("sjoin"):
+        tree = shapely.STRtree(walkshed_geoms)
+        amenity_idx, walkshed_idx = tree.query(amenity_geoms, predicate='intersects')
+
+    # Count matches per walkshed file and amenity file, keeping only files that were paired
+    walkshed_pos = {walkshed: i for i, walkshed in enumerate(walksheds)}
+    amenity_pos = {amenity: i for i, amenity in enumerate(amenities)}
+    paired = np.zeros((len(walksheds), len(amenities)), dtype=bool)
+    for pair in pairs:
+        paired[walkshed_pos[(pair[0], pair[1])], amenity_pos[(pair[2], pair[3])]] = True
+    match_w = walkshed_file[walkshed_idx]
+    match_a = amenity_file[amenity_idx]
+    match_band = walkshed_band[walkshed_idx]
+    keep = paired[match_w, match_a]
+
+    # A banded walkshed's own count is the count of its largest band
+    largest = np.array([bands[-1] if bands else np.nan for bands in file_bands])
+    whole = keep & (np.isnan(match_band) | (match_band == largest[match_w]))
+    counts = np.zeros((len(walksheds), len(amenities)), dtype=np.int64)
+    np.add.at(counts, (match_w[whole], match_a[whole]), 1)
+    banded = keep & ~np.isnan(match_band)
+    band_counts = Counter(zip(match_w[banded].tolist(), match_a[banded].tolist(), match_band[banded].tolist()))
+
+    # Record counts in the same order as the per-pair sweep
+    for pair in pairs:
+        w = walkshed_pos[(pair[0], pair[1])]
+        a = amenity_pos[(pair[2], pair[3])]
+        key = tuple(pair[6:9])
+        pair_counts = {key + (band,): band_counts.get((w, a, band), 0) for band in file_bands[w]}
+        pair_counts[key] = int(counts[w, a])
+        table.merge(pair_counts)
+        if manifest is not None:
+            manifest.record(pair[5], pairInputs(pair), pairParams(pair), result=pairResult(pair, pair_counts))
+
+
+
+## Change file and folder locations below
+## All input file names should begin with "Buffer " - naming convention directly follows from "CreateBuffers" script
+# File location of xlsx sheet to store number of amenities that intersect walkshed
+workbook = r"C:\QGIS Projects\Walkshed Sim\Amenity Reachability Comparison Table.xlsx"
+
+# Assume folders only have walksheds and only have amenities
+dir_walkshed = r"C:\QGIS Projects\Walkshed Sim\Buffered Walksheds"
+dir_amenity = r"C:\QGIS Projects\Walkshed Sim\Buffered Amenities"
+
+dir_output = r"C:\QGIS Projects\Walkshed Sim\Final Joined Files"
+
+## Change dictionaries to match user preferences
+# Housing region/location of each walkshed : location of each amenity
+dict_location = { 
+    "Argyle": "South",
+    "BerthaPitts": "South",
+    "Burbridge": "Burbridge",
+    "E.Republican": "South",
+    "MaryPilgrim": "North",
+    "NorthStar": "North",
+    "SacredMed": "North",
+    "SalmonberryL": "South"
+}
+
+# Assign order of mobility profiles to be inserted into the xlsx file
+dict_profile = {
+    "Control": 1,
+    "Walking": 2,
+    "Cane": 3,
+    "Powered": 4,
+    "Manual": 5
+}
+
+## Change output_ext to write joined files as GeoParquet (".parquet") or FlatGeobuf (".fgb") instead of GeoJSON
+## Inputs can be in any of these formats
+output_ext = ".geojson"
+
+## Set bbox_reads to True to only load the amenities within the bounding box of each walkshed
+## Reachable counts are unchanged, but "Unreachable " files then only hold the unreachable amenities near the walkshed
+bbox_reads = False
+
+## Set join_batch_size to a number of amenities to read, join and write amenity layers that many features at a time
+## Peak memory then grows with the batch size rather than the size of the amenity layer (e.g. 100000 for statewide
+## layers). GeoParquet and FlatGeobuf amenities are streamed - GDAL still reads a whole GeoJSON file at once
+## Matrix mode joins whole layers regardless
+join_batch_size = None
+
+## Change the memory cap (in bytes) for walkshed and amenity layers kept between joins
+layer_cache = LayerCache(max_bytes=2 * 1024 * 1024 * 1024)
+
+
+## Change the number of processes used to join walksheds and amenities (1 joins every pair in this process)
+## e.g. os.cpu_count() to use every core
+processes = 1
+
+## Set matrix to True to only fill in the xlsx file, counting every pair in one join
+## (the "Reachable "/"Unreachable " GeoJSON files are not written in this mode)
+matrix = False
+
+## Set incremental to False to redo every join instead of only the pairs whose inputs changed
+## The inputs and counts of each pair are recorded in "Join Manifest.json" in the output folder
+incremental = True
+
+## Timings of each stage are printed at the end and written to "SpatialJoin Report.json" in the output folder
+## Set profile to True to also write cProfile stats ("SpatialJoin Report.prof") there
+profile = False
+instruments = Recorder("SpatialJoin", profile)
+
+
+if __name__ == "__main__":
+    # The profiler is stopped even if a join fails, e.g. when run from the QGIS Python console
+    try:
+        # Reachable amenity counts are collected here and written into the xlsx file once at the end
+        table = ReachabilityTable(workbook, dict_location, dict_profile)
+
+        # Produce joined walkshed and amenity files, and record the number of reachable amenities
+        manifest = Manifest(os.path.join(dir_output, "Join Manifest.json")) if incremental else None
+        pairs = findPairs(dir_walkshed, dir_amenity, dir_output, dict_location)
+        if matrix:
+            reachabilityMatrix(pairs, table, manifest)
+        else:
+            runJoins(pairs, table, processes, manifest)
+
+        # Insert number of reachable amenities into xlsx file
+        table.save()
+
+        if manifest is not None:
+            manifest.save()
+            print(manifest.summary())
+
+        # Worker processes keep their own layer caches
+        if matrix or processes <= 1:
+            print(layer_cache.summary())
+
+        print(instruments.summary())
+        instruments.save(os.path.join(dir_output, "SpatialJoin Report.json"))
+    finally:
+        instruments.stop()
\ No newline at end of file
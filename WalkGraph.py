@@ -0,0 +1,470 @@
+import functools
+import gc
+import heapq
+import math
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from Instruments import fileBytes
+
+### Computes reachable trees locally from a pedestrian network file, without requesting them from AccessMap
+### The network is loaded once into flat arrays and each walkshed is a cost-bounded Dijkstra search over them
+### All mobility profiles of one location can be searched together in a single sweep (see reachable_trees)
+### Results have the same "edges", "node_costs" and "origin" members as an AccessMap reachable tree response
+### Any reachable tree can be split into nested isochrone bands without searching again (see band_tree)
+
+## Nothing in this file imports QGIS
+## Loading a network from GeoJSON, GeoParquet or FlatGeobuf needs geopandas - a network saved with
+#  WalkGraph.save (".npz") loads with numpy only, and much faster
+## Network edges are LineStrings in the OpenSidewalks schema: "footway" (sidewalk/crossing), "highway",
+#  "incline" (rise over run in the direction the line is drawn), "curbramps" and "length" (meters, optional)
+
+## Change these to tune the cost function - modelled on the AccessMap wheelchair profile
+# Walking speed on flat ground in m/s
+WALK_BASE = 1.3
+# Incline with the fastest walking speed (slightly downhill)
+INCLINE_IDEAL = -0.0087
+# Speed at the uphill/downhill limit is WALK_BASE / DIVISOR
+DIVISOR = 5
+# Seconds added for every street crossing
+CROSSING_DELAY = 30
+# Street costs are multiplied by 1 + STREET_PENALTY * streetAvoidance
+STREET_PENALTY = 4
+# Origins further than this from the network (in meters) get no tree, like AccessMap
+SNAP_DISTANCE = 200
+
+EARTH_RADIUS = 6371008.8
+
+# Edge kinds, decoded once when the network is loaded
+SIDEWALK, CROSSING, STREET, STEPS = 0, 1, 2, 3
+PATH_HIGHWAYS = ('footway', 'path', 'pedestrian', 'living_street', 'cycleway', 'corridor', 'elevator')
+
+# Request parameters that make up a mobility profile
+PROFILE_KEYS = ('uphill', 'downhill', 'avoidCurbs', 'streetAvoidance')
+
+# Arrays stored by WalkGraph.save - everything else is derived from them when loading
+GRAPH_ARRAYS = ('x', 'y', 'edge_source', 'edge_target', 'length', 'incline', 'curbramps',
+                'footway_codes', 'footway_names', 'highway_codes', 'highway_names', 'coords', 'coord_offsets')
+
+
+# Great circle distance in meters between arrays of lon/lat points
+def haversine(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+# Coordinates of the first "fraction" of a line given as a tuple of (lon, lat)
+def cut_line(line, fraction):
+    lengths = [math.hypot((x2 - x1) * math.cos(math.radians(y1)), y2 - y1)
+               for (x1, y1), (x2, y2) in zip(line[:-1], line[1:])]
+    target = fraction * sum(lengths)
+    for i, length in enumerate(lengths):
+        if target <= length or i == len(lengths) - 1:
+            t = target / length if length > 0 else 0
+            (x1, y1), (x2, y2) = line[i], line[i + 1]
+            return line[:i + 1] + ((x1 + t * (x2 - x1), y1 + t * (y2 - y1)),)
+        target -= length
+
+
+# Pauses garbage collection while a tree is built
+# Building a tree creates thousands of dicts without any reference cycles, and collections triggered
+# along the way would rescan every object already alive (including the whole network) for nothing
+@contextmanager
+def paused_gc():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# Integer codes for an array of strings (missing values become "")
+def encode(values):
+    names, codes = np.unique(np.array(['' if value is None or value != value else str(value) for value in values]),
+                             return_inverse=True)
+    return codes.astype(np.int32), names
+
+
+# Pedestrian network stored as flat numpy arrays
+# Every edge can be walked both ways: arc 2 * i follows edge i as drawn and arc 2 * i + 1 walks it backwards
+# Arcs leaving node u are arc_ids[indptr[u]:indptr[u + 1]], so a search never builds per-node python objects
+class WalkGraph:
+
+    def __init__(self, x, y, edge_source, edge_target, length, incline, curbramps,
+                 footway_codes, footway_names, highway_codes, highway_names, coords, coord_offsets):
+        self.x = x
+        self.y = y
+        self.edge_source = edge_source
+        self.edge_target = edge_target
+        self.length = length
+        self.incline = incline
+        self.curbramps = curbramps
+        self.footway_codes = footway_codes
+        self.footway_names = footway_names
+        self.highway_codes = highway_codes
+        self.highway_names = highway_names
+        self.coords = coords
+        self.coord_offsets = coord_offsets
+
+        footway = footway_names[footway_codes]
+        highway = highway_names[highway_codes]
+        self.kind = np.where(footway == 'crossing', CROSSING,
+                    np.where(highway == 'steps', STEPS,
+                    np.where((footway != '') | np.isin(highway, PATH_HIGHWAYS), SIDEWALK, STREET))).astype(np.int8)
+
+        # Arcs sorted by the node they leave from
+        arc_source = np.empty(2 * len(edge_source), dtype=np.int64)
+        arc_source[0::2] = edge_source
+        arc_source[1::2] = edge_target
+        arc_target = np.empty_like(arc_source)
+        arc_target[0::2] = edge_target
+        arc_target[1::2] = edge_source
+        self.arc_ids = np.argsort(arc_source, kind='stable')
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(arc_source, minlength=len(x)))])
+
+        # Python lists are much faster than numpy arrays to index one item at a time in the search loop
+        self.indptr_list = self.indptr.tolist()
+        self.target_list = arc_target[self.arc_ids].tolist()
+
+        # Arc costs in search order for each profile already used
+        self.profile_costs = {}
+        self.profile_matrices = {}
+
+    # Reads a network from a layer file (see LayerIO.py) or from a ".npz" written by save
+    @classmethod
+    def load(cls, path):
+        if os.path.splitext(path)[1] == '.npz':
+            with np.load(path) as arrays:
+                return cls(**{name: arrays[name] for name in GRAPH_ARRAYS})
+
+        from LayerIO import readLayer
+        return cls.from_frame(readLayer(path))
+
+    # Builds a network from a GeoDataFrame of LineStrings
+    # Lines that share an end point (to 7 decimal places) are connected
+    @classmethod
+    def from_frame(cls, gdf):
+        import shapely
+
+        if gdf.crs is not None and not gdf.crs.is_geographic:
+            gdf = gdf.to_crs('EPSG:4326')
+        gdf = gdf.explode(index_parts=False)
+        gdf = gdf[~gdf.geometry.is_empty & gdf.geometry.notna()].reset_index(drop=True)
+
+        coords, index = shapely.get_coordinates(gdf.geometry.values, return_index=True)
+        coord_offsets = np.concatenate([[0], np.cumsum(np.bincount(index, minlength=len(gdf)))])
+
+        ends = np.concatenate([coords[coord_offsets[:-1]], coords[coord_offsets[1:] - 1]])
+        nodes, node_ids = np.unique(np.round(ends, 7), axis=0, return_inverse=True)
+        node_ids = node_ids.reshape(-1)
+
+        # Lengths are measured along the lines where the network does not give them
+        same_line = index[1:] == index[:-1]
+        segments = haversine(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+        measured = np.bincount(index[1:][same_line], weights=segments[same_line], minlength=len(gdf))
+
+        def column(name, default):
+            if name not in gdf:
+                return np.full(len(gdf), default)
+            return gdf[name].to_numpy()
+
+        length = np.asarray(column('length', np.nan), dtype=float)
+        length = np.where(np.isnan(length), measured, length)
+        incline = np.nan_to_num(np.asarray(column('incline', 0), dtype=float))
+        curbramps = np.array([bool(value) and value == value for value in column('curbramps', False)])
+        footway_codes, footway_names = encode(column('footway', None))
+        highway_codes, highway_names = encode(column('highway', None))
+
+        return cls(nodes[:, 0].copy(), nodes[:, 1].copy(), node_ids[:len(gdf)], node_ids[len(gdf):],
+                   length, incline, curbramps, footway_codes, footway_names, highway_codes, highway_names,
+                   coords, coord_offsets)
+
+    # Writes the network arrays so later runs can skip reading and parsing the layer file
+    def save(self, path):
+        np.savez(path, **{name: getattr(self, name) for name in GRAPH_ARRAYS})
+
+    # Cost in seconds of every arc for one profile, in the order arc_ids lists them (inf where impassable)
+    # Costs for all arcs are computed with numpy at once and reused by every walkshed with the same profile
+    def arc_costs(self, uphill, downhill, avoidCurbs, streetAvoidance, reverse=False):
+        key = (float(uphill), float(downhill), bool(avoidCurbs), float(streetAvoidance), bool(reverse))
+        if key in self.profile_costs:
+            return self.profile_costs[key]
+
+        length, incline, kind, curbramps = self.arc_attributes
+        # A reverse walkshed walks every arc backwards
+        if reverse:
+            incline = -incline
+
+        k_up = math.log(DIVISOR) / abs(uphill - INCLINE_IDEAL)
+        k_down = math.log(DIVISOR) / abs(-downhill - INCLINE_IDEAL)
+        k = np.where(incline > INCLINE_IDEAL, k_up, k_down)
+        speed = WALK_BASE * np.exp(-k * np.abs(incline - INCLINE_IDEAL))
+        costs = length / speed
+
+        costs = np.where(kind == CROSSING, costs + CROSSING_DELAY, costs)
+        costs = np.where(kind == STREET, costs * (1 + STREET_PENALTY * streetAvoidance), costs)
+
+        impassable = (incline > uphill) | (incline < -downhill)
+        if avoidCurbs:
+            impassable |= ((kind == CROSSING) & ~curbramps) | (kind == STEPS)
+        costs[impassable] = np.inf
+
+        self.profile_costs[key] = (costs, costs.tolist())
+        return self.profile_costs[key]
+
+    # Arc costs of several profiles as one (profiles, arcs) array, kept for the next location with the same profiles
+    def cost_matrix(self, profiles, reverse=False):
+        key = (tuple(tuple(profile[key] for key in PROFILE_KEYS) for profile in profiles), bool(reverse))
+        if key not in self.profile_matrices:
+            self.profile_matrices[key] = np.stack([self.arc_costs(*values, reverse)[0] for values in key[0]])
+        return self.profile_matrices[key]
+
+    # Edge attributes of every arc in the order arc_ids lists them, decoded once and shared by all profiles
+    # Walking arc 2 * i + 1 goes down what arc 2 * i goes up, so its incline is negated
+    @functools.cached_property
+    def arc_attributes(self):
+        edges = self.arc_ids >> 1
+        incline = np.where(self.arc_ids & 1, -self.incline[edges], self.incline[edges])
+        return self.length[edges], incline, self.kind[edges], self.curbramps[edges]
+
+    # Closest node to a point and its distance in meters
+    def snap(self, lon, lat):
+        scale = math.cos(math.radians(lat))
+        d2 = ((self.x - lon) * scale) ** 2 + (self.y - lat) ** 2
+        node = int(np.argmin(d2))
+        return node, math.radians(math.sqrt(d2[node])) * EARTH_RADIUS
+
+    # Cost-bounded Dijkstra search, returns {node: cost} for every node reachable within max_cost
+    def search(self, origin, costs, max_cost):
+        indptr = self.indptr_list
+        targets = self.target_list
+        reached = {origin: 0.0}
+        heap = [(0.0, origin)]
+        while heap:
+            cost, u = heapq.heappop(heap)
+            if cost > reached[u]:
+                continue
+            for slot in range(indptr[u], indptr[u + 1]):
+                new_cost = cost + costs[slot]
+                if new_cost <= max_cost:
+                    v = targets[slot]
+                    if new_cost < reached.get(v, math.inf):
+                        reached[v] = new_cost
+                        heapq.heappush(heap, (new_cost, v))
+        return reached
+
+    # Reachable tree from a point, returns (data, message) like AccessMap.fetch_tree
+    # Edges are included whole when they can be walked to the end within max_cost, otherwise up to where
+    # max_cost runs out. node_costs holds every reached node and origin the network node the search started from
+    def reachable_tree(self, lon, lat, uphill, downhill, avoidCurbs, streetAvoidance, max_cost, reverse=False):
+        origin, distance = self.snap(lon, lat)
+        if distance > SNAP_DISTANCE:
+            return None, 'No results were returned from the local network: origin is ' + format(distance, '.0f') + \
+                ' m from the nearest node'
+
+        costs, cost_list = self.arc_costs(uphill, downhill, avoidCurbs, streetAvoidance, reverse)
+        reached = self.search(origin, cost_list, float(max_cost))
+        nodes = np.fromiter(reached.keys(), dtype=np.int64, count=len(reached))
+        node_costs = np.fromiter(reached.values(), dtype=float, count=len(reached))
+        return self.tree(origin, nodes, node_costs, costs, float(max_cost)), None
+
+    # Cost-bounded search for several profiles at once from the same origin
+    # costs is a (profiles, arcs) array from cost_matrix. Each round relaxes the arcs leaving every node that
+    # improved in the last round, for all profiles in one numpy step, until no cost improves
+    # Returns a (profiles, nodes) array of costs, inf for nodes not reachable within max_cost
+    def sweep(self, origin, costs, max_cost):
+        targets = self.arc_targets
+        dist = np.full((len(costs), len(self.x)), np.inf)
+        dist[:, origin] = 0
+        frontier = np.array([origin])
+        while frontier.size:
+            counts = self.indptr[frontier + 1] - self.indptr[frontier]
+            slots = np.repeat(self.indptr[frontier] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            ends = targets[slots]
+            new_costs = dist[:, np.repeat(frontier, counts)] + costs[:, slots]
+            profiles, improved = np.nonzero((new_costs <= max_cost) & (new_costs < dist[:, ends]))
+            np.minimum.at(dist, (profiles, ends[improved]), new_costs[profiles, improved])
+            frontier = np.unique(ends[improved])
+        return dist
+
+    # Arc targets in the order arc_ids lists them
+    @functools.cached_property
+    def arc_targets(self):
+        return np.array(self.target_list)
+
+    # Reachable trees from one point for several mobility profiles, returns a list of (data, message)
+    # "profiles" are dicts holding the PROFILE_KEYS (e.g. the request dicts of one location)
+    # The origin is snapped once and all profiles are searched together in one sweep, which costs much less than
+    # searching them one at a time
+    def reachable_trees(self, lon, lat, profiles, max_cost, reverse=False):
+        origin, distance = self.snap(lon, lat)
+        if distance > SNAP_DISTANCE:
+            message = 'No results were returned from the local network: origin is ' + format(distance, '.0f') + \
+                ' m from the nearest node'
+            return [(None, message)] * len(profiles)
+
+        costs = self.cost_matrix(profiles, reverse)
+        dist = self.sweep(origin, costs, float(max_cost))
+
+        # Trees of the same location share the geometry objects of the edges and nodes they have in common
+        geometries = ({}, {})
+        trees = []
+        for profile_costs, profile_dist in zip(costs, dist):
+            nodes = np.flatnonzero(profile_dist <= max_cost)
+            trees.append((self.tree(origin, nodes, profile_dist[nodes], profile_costs, float(max_cost), geometries),
+                          None))
+        return trees
+
+    # Builds the AccessMap response members from the reached nodes and their costs
+    # "geometries" is a pair of dicts of edge and node geometries already built for another tree from the same origin
+    def tree(self, origin, nodes, node_costs, costs, max_cost, geometries=None):
+
+        # Every arc leaving a reached node, with the cost at its far end
+        counts = self.indptr[nodes + 1] - self.indptr[nodes]
+        slots = np.repeat(self.indptr[nodes] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        start_costs = np.repeat(node_costs, counts)
+        end_costs = start_costs + costs[slots]
+        arcs = self.arc_ids[slots]
+
+        whole = end_costs <= max_cost
+        order = np.argsort(end_costs[whole], kind='stable')
+        edges, first = np.unique((arcs[whole] >> 1)[order], return_index=True)
+        edge_costs = end_costs[whole][order][first]
+
+        partial = ~whole & np.isfinite(end_costs) & (start_costs < max_cost) & ~np.isin(arcs >> 1, edges)
+
+        x, y, lines, properties = self.output_lists
+        edge_geometries, node_geometries = geometries if geometries is not None else ({}, {})
+        with paused_gc():
+            features = []
+            for edge, cost in zip(edges.tolist(), edge_costs.tolist()):
+                geometry = edge_geometries.get(edge)
+                if geometry is None:
+                    geometry = edge_geometries[edge] = {'type': 'LineString', 'coordinates': lines[edge]}
+                features.append({'type': 'Feature', 'geometry': geometry, 'properties': dict(properties[edge], cost=cost)})
+            for arc, start, end in zip(arcs[partial].tolist(), start_costs[partial].tolist(),
+                                       end_costs[partial].tolist()):
+                edge = arc >> 1
+                line = lines[edge][::-1] if arc & 1 else lines[edge]
+                features.append({'type': 'Feature',
+                                 'geometry': {'type': 'LineString',
+                                              'coordinates': cut_line(line, (max_cost - start) / (end - start))},
+                                 'properties': dict(properties[edge], cost=max_cost)})
+
+            node_features = []
+            for node, cost in zip(nodes.tolist(), node_costs.tolist()):
+                geometry = node_geometries.get(node)
+                if geometry is None:
+                    geometry = node_geometries[node] = {'type': 'Point', 'coordinates': (x[node], y[node])}
+                node_features.append({'type': 'Feature', 'geometry': geometry, 'properties': {'cost': cost}})
+
+        return {
+            'edges': {'type': 'FeatureCollection', 'features': features},
+            'node_costs': {'type': 'FeatureCollection', 'features': node_features},
+            'origin': {'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [x[origin], y[origin]]},
+                 'properties': {}}]}}
+
+    # Node coordinates, edge lines and edge properties as python objects, built the first time a tree is output
+    # Converting them from numpy once is much faster than converting every edge of every tree
+    @functools.cached_property
+    def output_lists(self):
+        # Tuples of floats are left alone by the garbage collector, lists would be rescanned by every collection
+        coords = list(map(tuple, self.coords.tolist()))
+        offsets = self.coord_offsets.tolist()
+        lines = [tuple(coords[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+        footway = [name or None for name in self.footway_names[self.footway_codes].tolist()]
+        highway = [name or None for name in self.highway_names[self.highway_codes].tolist()]
+        properties = [{'footway': f, 'highway': h, 'incline': i, 'length': l, 'curbramps': c}
+                      for f, h, i, l, c in zip(footway, highway, self.incline.tolist(), self.length.tolist(),
+                                               self.curbramps.tolist())]
+        return self.x.tolist(), self.y.tolist(), lines, properties
+
+
+# Computes many reachable trees on a local network
+# Same arguments and results as AccessMap.fetch_trees, with the network in place of the server
+# Requests from the same point with the same max_cost (e.g. every profile of one location) are computed in one sweep
+# With a cache, each tree is written into it and its file paths are yielded instead of the data
+# With a recorder (see Instruments.py), searches go to its "local search" stage and cache writes to "json"
+def compute_trees(requests, graph, cache=None, recorder=None):
+    groups = {}
+    for request in requests:
+        key = (request['lon'], request['lat'], request['max_cost'], bool(request.get('reverse', False)))
+        groups.setdefault(key, []).append(request)
+
+    for (lon, lat, max_cost, reverse), group in groups.items():
+        start = time.perf_counter()
+        trees = graph.reachable_trees(lon, lat, group, max_cost, reverse)
+        if recorder is not None:
+            recorder.add('local search', time.perf_counter() - start)
+
+        for request, (data, message) in zip(group, trees):
+            if data is not None and cache is not None:
+                start = time.perf_counter()
+                data = cache.put(request, data)
+                if recorder is not None:
+                    recorder.add('json', time.perf_counter() - start, written=fileBytes(data))
+            yield request, data, message
+
+
+# Splits a reachable tree (from AccessMap or a WalkGraph) into nested isochrone bands, e.g. [300, 600, 900]
+# The tree must have been computed with max_cost at least the largest band. Each edge gets a "band" property -
+# the smallest band it is wholly inside - and edges crossing a smaller band's limit also get a piece cut at that
+# limit, so the edges of band b are every edge with "band" <= b. Nodes get the band of their cost
+# Edge end costs come from the node costs at their ends (and the edge's own "cost" where it has one), assuming
+# cost grows evenly along an edge. Edges cut off at the tree's max_cost go in the largest band
+def band_tree(data, bands):
+    bands = sorted(bands)
+    # Nodes are matched to edge ends to 7 decimals, as WalkGraph joins edge ends into nodes
+    node_costs = {tuple(round(value, 7) for value in feature['geometry']['coordinates']): feature['properties']['cost']
+                  for feature in data['node_costs']['features']}
+
+    def band_of(cost):
+        for band in bands:
+            if cost <= band:
+                return band
+        return bands[-1]
+
+    with paused_gc():
+        features = []
+        for feature in data['edges']['features']:
+            line = tuple(map(tuple, feature['geometry']['coordinates']))
+            start = node_costs.get((round(line[0][0], 7), round(line[0][1], 7)))
+            end = node_costs.get((round(line[-1][0], 7), round(line[-1][1], 7)))
+            if start is None and end is None:
+                features.append(dict(feature, properties=dict(feature['properties'], band=bands[-1])))
+                continue
+            # "start" is the cheaper end - the far end of an edge cut off at max_cost is not a node
+            if start is None or (end is not None and end < start):
+                line, start, end = line[::-1], end, start
+            cost = feature['properties'].get('cost')
+            if end is None:
+                cost = bands[-1]
+            elif cost is None:
+                cost = end
+            edge_cost = cost - start
+
+            band = band_of(cost)
+            features.append(dict(feature, properties=dict(feature['properties'], band=band)))
+            if edge_cost <= 0:
+                continue
+            # Pieces of the edge reached from either end before it is wholly inside
+            for smaller in bands[:bands.index(band)]:
+                for side, side_cost in ((line, start), (line[::-1], end)):
+                    if side_cost is not None and side_cost < smaller:
+                        features.append({'type': 'Feature',
+                                         'geometry': {'type': 'LineString',
+                                                      'coordinates': cut_line(side, (smaller - side_cost) / edge_cost)},
+                                         'properties': dict(feature['properties'], cost=smaller, band=smaller)})
+
+        node_features = [dict(feature, properties=dict(feature['properties'], band=band_of(feature['properties']['cost'])))
+                         for feature in data['node_costs']['features']]
+
+    return dict(data, edges={'type': 'FeatureCollection', 'features': features},
+                node_costs={'type': 'FeatureCollection', 'features': node_features})